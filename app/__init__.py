@@ -2,33 +2,46 @@ from flask_jwt_extended import JWTManager
 from flask_cors import CORS, cross_origin
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
-from requests.auth import HTTPBasicAuth
-from socketio import Client
-from requests import post
+from sqlalchemy import text
 from flask import Flask
+from time import sleep
+import threading
 import atexit
 import logging
+import os
 from flask.logging import default_handler
 from logging.handlers import RotatingFileHandler
 
-# socketio connection to northbound server
-northbound_connection = Client()
+from app.northbound_client import NorthboundClient
 
-# northbound client credentials
-northbound_access_token = None
-northbound_refresh_token = None
+# client of the northbound server, with its socketio connection
+northbound_client = NorthboundClient()
+northbound_connection = northbound_client.connection
 
 # database
 db = SQLAlchemy()
 
-# list containing dictionaries of the colorum vehicles
-all_colorum_vehicles = None
+# postgres notification channel used by web workers to tell the ingest process that the northbound credentials
+# stored in the db have changed
+NORTHBOUND_CREDENTIALS_CHANNEL = "northbound_credentials"
+
+# postgres notification channels used by web workers to ask the ingest process to request the routes
+# from the northbound server, and by the ingest process to tell them that it has written the routes to the db
+NORTHBOUND_ROUTES_REQUEST_CHANNEL = "northbound_routes_request"
+NORTHBOUND_ROUTES_RECEIVED_CHANNEL = "northbound_routes_received"
 
 # list that contains the available routes coming from the Northbound Interface for the Colorum app to use
 available_routes = None
 
 
-def create_server(config_type="config.DevelopmentConfig"):
+# dedicated db connection that holds the ingest lock, so that exactly one ingest process owns the northbound stream
+ingest_lock_connection = None
+
+
+# create the flask app
+# web workers (ingest=False) serve HTTP requests and keep their fleet state in sync with the db,
+# while the ingest process (ingest=True) owns the northbound stream, classifies the GPS devices and writes them to the db
+def create_server(config_type="config.DevelopmentConfig", ingest=False):
     # create flask app
     app = Flask(__name__)
 
@@ -38,12 +51,12 @@ def create_server(config_type="config.DevelopmentConfig"):
     # enable logging to file
     configure_logging(app)
 
+    # take the address and credentials of the northbound server from the config
+    northbound_client.configure(app)
+
     # register blueprints
     register_blueprints(app)
 
-    # set program to emit a stop device stream upon exit
-    atexit.register(disconnect_from_northbound)
-
     # initialize JWT and CORS
     jwt = JWTManager(app)
     cors = CORS(app, resources={r"/*": {"origins": "*"}})
@@ -54,54 +67,294 @@ def create_server(config_type="config.DevelopmentConfig"):
     db.init_app(app)
     migrate = Migrate(app, db, compare_type=True)
 
-    # connect to the northbound server
-    if app.config["NORTHBOUND_USERNAME"] and app.config["NORTHBOUND_PASSWORD"]:
-        connect_to_northbound(app)
+    # record metrics if they are enabled, and profile the db queries of requests and northbound events
+    from app.main import metrics, query_profiler
+
+    metrics.configure_metrics(app)
+    query_profiler.configure_query_profiler(app, db)
+
+    # dispatch the northbound socketio events to this app
+    from app.main import event_handler
+
+    event_handler.flask_app = app
+
+    if ingest:
+        start_ingest(app)
+    else:
+        # the fleet state is written by the ingest process, so web workers only load the colorum vehicles,
+        # and periodically load them again from the db
+        from app.main import fleet_state
 
-        # send the start stream event to the northbound server
-        northbound_connection.emit("start_device_location_stream")
+        fleet_state.load_colorum_vehicles_only = True
+        fleet_state.start_refresh(app)
+
+        # push the changes of the colorum vehicles to the subscribed enforcer apps
+        from app.main import colorum_push
+
+        colorum_push.configure_colorum_push(app)
 
     return app
 
 
-# function to connect to the northbound platform via login and socketio connect with token
-def connect_to_northbound(app):
-    # send login request to northbound platform
-    northbound_url = "http://%s:%s" % (
-        app.config["NORTHBOUND_ADDRESS"],
-        app.config["NORTHBOUND_PORT"],
-    )
-    northbound_login_url = "%s/login/" % (northbound_url,)
-    northbound_login = post(
-        northbound_login_url,
-        auth=HTTPBasicAuth(
-            app.config["NORTHBOUND_USERNAME"], app.config["NORTHBOUND_PASSWORD"]
-        ),
-    )
+# function to take over the northbound stream once this process holds the ingest lock
+def start_ingest(app):
+    global ingest_lock_connection
+
+    # wait until no other ingest process holds the ingest lock,
+    # and use the northbound credentials that were last set, if they were set since the config was written
+    with app.app_context():
+        ingest_lock_connection = acquire_ingest_lock(app)
+        load_northbound_credentials(app, ingest_lock_connection)
+
+    # periodically write the in-memory fleet state to the db, and write it one last time upon exit
+    # only the ingest process writes GPS devices, so that web workers never race it
+    from app.main import fleet_state
+
+    fleet_state.start_write_behind(app)
+    atexit.register(flush_fleet_state, app)
+
+    # process the GPS device reports of the northbound socketio events in batches in the background
+    from app.main import ingest_queue
 
-    # get access and refresh tokens from request response
-    global northbound_access_token, northbound_refresh_token
-    northbound_response_json = northbound_login.json()
-    northbound_access_token = northbound_response_json["access_token"]
-    northbound_refresh_token = northbound_response_json["refresh_token"]
-
-    # connect to the northbound platform using socketio connect
-    global northbound_connection
-    bearer_token = "Bearer %s" % (northbound_access_token)
-    northbound_connection.connect(
-        northbound_url, headers={"Authorization": bearer_token}
+    ingest_queue.start_ingest_worker(app)
+
+    # keep the history of the positions of the GPS devices, and its daily partitions
+    if app.config["GPS_HISTORY_ENABLED"]:
+        from app.main import position_history
+
+        position_history.start_position_history(app)
+
+    # mark the GPS devices that stopped reporting as offline
+    if app.config["OFFLINE_TIMEOUT"]:
+        fleet_state.start_offline_detection(app)
+
+    # connect to the northbound server and start the device location stream, reconnecting whenever it drops
+    if northbound_client.has_credentials():
+        northbound_client.start_stream()
+
+    # keep the routes in the db up to date by requesting them from the northbound server on a schedule
+    if app.config["NORTHBOUND_ROUTES_REFRESH_INTERVAL"]:
+        routes_refresh_thread = threading.Thread(
+            target=request_northbound_routes, args=(app,), daemon=True
+        )
+        routes_refresh_thread.start()
+
+    # set program to emit a stop device stream upon exit
+    atexit.register(northbound_client.stop_stream)
+
+    # serve the metrics and ingest stats of this process, since it does not serve HTTP requests otherwise,
+    # and take the GPS devices that web workers forward from their /list_of_gps_devices
+    if app.config["INGEST_HTTP_PORT"]:
+        start_ingest_http_server(app)
+
+    # keep checking the ingest lock and listening for new northbound credentials in the background
+    ingest_lock_thread = threading.Thread(
+        target=watch_ingest_lock, args=(app,), daemon=True
     )
+    ingest_lock_thread.start()
+
 
+# function to periodically send the socketio event that gets the routes to the northbound server
+# the northbound server answers with a list_of_routes event, which updates the routes in the db
+def request_northbound_routes(app):
+    while True:
+        sleep(app.config["NORTHBOUND_ROUTES_REFRESH_INTERVAL"])
+        emit_get_routes(app)
 
-# function to disconnect from the northbound platform upon exit
-def disconnect_from_northbound():
-    global northbound_connection
 
-    # send the stop stream event to the northbound server
-    northbound_connection.emit("stop_device_location_stream")
+# function to send the socketio event that gets the routes to the northbound server, if it is connected
+def emit_get_routes(app):
+    if northbound_connection.connected:
+        try:
+            northbound_connection.emit("get_routes")
+        except Exception as error:
+            app.logger.error(str(error))
 
-    # disconnect from northbound server
-    northbound_connection.disconnect()
+
+# function to serve the app from a background thread of the ingest process
+def start_ingest_http_server(app):
+    from werkzeug.serving import make_server
+
+    ingest_http_server = make_server(
+        app.config["INGEST_HTTP_HOST"],
+        app.config["INGEST_HTTP_PORT"],
+        app,
+        threaded=True,
+    )
+    ingest_http_thread = threading.Thread(
+        target=ingest_http_server.serve_forever, daemon=True
+    )
+    ingest_http_thread.start()
+
+    app.logger.info(
+        "Serving ingest HTTP requests on %s:%s",
+        app.config["INGEST_HTTP_HOST"],
+        app.config["INGEST_HTTP_PORT"],
+    )
+
+
+# function to acquire the ingest lock (a postgres session-level advisory lock) on a dedicated db connection
+# the lock is released by postgres if the connection or the process dies, so that a standby ingest process can take over
+# returns None instead of waiting if wait is False and another process holds the lock
+def acquire_ingest_lock(app, wait=True):
+    connection = db.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+
+    while not connection.execute(
+        text("SELECT pg_try_advisory_lock(:key)"), key=app.config["INGEST_LOCK_KEY"]
+    ).scalar():
+        if not wait:
+            connection.close()
+            return None
+
+        app.logger.info("Ingest lock is held by another process, waiting")
+        sleep(app.config["INGEST_LOCK_RETRY_INTERVAL"])
+
+    # listen for the credentials stored by /set_northbound_credentials/ and the routes requested by /get_routes/,
+    # from any web worker
+    connection.execute(text("LISTEN %s" % NORTHBOUND_CREDENTIALS_CHANNEL))
+    connection.execute(text("LISTEN %s" % NORTHBOUND_ROUTES_REQUEST_CHANNEL))
+
+    app.logger.info("Acquired ingest lock")
+    return connection
+
+
+# function to use the northbound credentials stored by /set_northbound_credentials/, read over a db connection
+# returns whether there were stored credentials, or leaves the credentials from the config in place otherwise
+def load_northbound_credentials(app, connection):
+    from app.models import NorthboundCredentials
+    from app.main import credentials
+
+    northbound_credentials = NorthboundCredentials.__table__
+    stored_credentials = connection.execute(
+        northbound_credentials.select().where(northbound_credentials.c.id == 1)
+    ).first()
+    if stored_credentials is None:
+        return False
+
+    try:
+        password = credentials.decrypt_password(app, stored_credentials.password)
+    except Exception as error:
+        # e.g. the credentials were stored with another NORTHBOUND_CREDENTIALS_KEY or SECRET_KEY
+        app.logger.error(
+            "Could not decrypt the stored Northbound Interface credentials: %r", error
+        )
+        return False
+
+    app.config["NORTHBOUND_USERNAME"] = stored_credentials.username
+    app.config["NORTHBOUND_PASSWORD"] = password
+    northbound_client.set_credentials(stored_credentials.username, password)
+    return True
+
+
+# function to check whether the connection holding the ingest lock still holds it
+# pg_locks shows a bigint advisory lock key with its high 32 bits as classid, its low 32 bits as objid, and objsubid 1
+def ingest_lock_is_held(app, connection):
+    key = app.config["INGEST_LOCK_KEY"]
+
+    return connection.execute(
+        text(
+            "SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' "
+            "AND classid = CAST(:classid AS oid) AND objid = CAST(:objid AS oid) AND objsubid = 1 "
+            "AND pid = pg_backend_pid() AND granted"
+        ),
+        classid=(key >> 32) & 0xFFFFFFFF,
+        objid=key & 0xFFFFFFFF,
+    ).scalar()
+
+
+# function to get the ingest lock back on a new db connection after the connection holding it failed,
+# e.g. because the db restarted, which also released the lock
+# exits if another ingest process took the lock over in the meantime, and keeps retrying while the db is unreachable
+def reacquire_ingest_lock(app):
+    try:
+        ingest_lock_connection.close()
+    except Exception as error:
+        app.logger.error(str(error))
+
+    while True:
+        try:
+            with app.app_context():
+                connection = acquire_ingest_lock(app, wait=False)
+                break
+        except Exception as error:
+            app.logger.error(str(error))
+            sleep(app.config["INGEST_LOCK_RETRY_INTERVAL"])
+
+    if connection is None:
+        # exit right away, so that the ingest process that took over owns the northbound stream alone
+        app.logger.error("Lost ingest lock, exiting")
+        os._exit(1)
+
+    # the credentials may have changed while the notifications could not be received
+    previous_credentials = (northbound_client.username, northbound_client.password)
+    try:
+        with app.app_context():
+            if load_northbound_credentials(app, connection) and (
+                (northbound_client.username, northbound_client.password)
+                != previous_credentials
+            ):
+                northbound_client.restart_stream()
+    except Exception as error:
+        app.logger.error(str(error))
+
+    return connection
+
+
+# function to periodically check that this process still holds the ingest lock,
+# to reconnect to the northbound platform when the stored northbound credentials change,
+# and to request the routes from the northbound platform when a web worker asks for them
+def watch_ingest_lock(app):
+    global ingest_lock_connection
+
+    while True:
+        sleep(app.config["INGEST_LOCK_CHECK_INTERVAL"])
+
+        # an error only means that the lock could not be checked, so get it back on a new connection
+        dbapi_connection = ingest_lock_connection.connection
+        try:
+            lock_is_held = ingest_lock_is_held(app, ingest_lock_connection)
+            dbapi_connection.poll()
+        except Exception as error:
+            app.logger.error(str(error))
+            ingest_lock_connection = reacquire_ingest_lock(app)
+            continue
+
+        if not lock_is_held:
+            # exit right away, so that a standby ingest process can take over the northbound stream
+            app.logger.error("Lost ingest lock, exiting")
+            os._exit(1)
+
+        # several notifications on the same channel in a row are handled once
+        notified_channels = set(
+            notification.channel for notification in dbapi_connection.notifies
+        )
+        del dbapi_connection.notifies[:]
+
+        if NORTHBOUND_CREDENTIALS_CHANNEL in notified_channels:
+            try:
+                # reconnect to the northbound platform using the new credentials
+                with app.app_context():
+                    if load_northbound_credentials(app, ingest_lock_connection):
+                        northbound_client.restart_stream()
+
+                        app.logger.info(
+                            "Reconnected with new Northbound Interface credentials"
+                        )
+            except Exception as error:
+                app.logger.error(str(error))
+
+        # the list_of_routes answer is written to the db by northbound_handler.process_routes,
+        # which notifies the waiting web workers
+        if NORTHBOUND_ROUTES_REQUEST_CHANNEL in notified_channels:
+            emit_get_routes(app)
+
+
+# function to write the remaining changes of the in-memory fleet state to the db upon exit
+def flush_fleet_state(app):
+    from app.main import fleet_state
+
+    with app.app_context():
+        fleet_state.flush_fleet_state()
 
 
 # function to configure logging
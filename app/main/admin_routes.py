@@ -1,11 +1,16 @@
-from app import (
-    db,
-    northbound_connection,
-    northbound_access_token,
-    northbound_refresh_token,
+from app import db, northbound_client, NORTHBOUND_CREDENTIALS_CHANNEL
+from app.models import ColorumAdmin, ColorumUser, NorthboundCredentials, Route
+from . import (
+    main_blueprint,
+    route_cache,
+    route_list,
+    ingest_queue,
+    northbound_handler,
+    calculation_functions,
+    metrics,
+    offload,
+    credentials,
 )
-from app.models import ColorumAdmin, ColorumUser, Route
-from . import main_blueprint
 
 from flask_jwt_extended import (
     get_jwt_identity,
@@ -15,26 +20,14 @@ from flask_jwt_extended import (
 )
 from flask import request, jsonify, current_app
 from werkzeug.utils import secure_filename
-from requests.auth import HTTPBasicAuth
+from sqlalchemy import text
 from passlib.hash import pbkdf2_sha256
 from shortuuid import ShortUUID
 from base64 import b64decode
 from ast import literal_eval
-from socketio import Client
-from requests import post
-from time import sleep
 
 import os
 
-# create local socketio connection to northbound interface
-local_northbound_connection = Client()
-
-
-@local_northbound_connection.on("list_of_routes")
-def handle_get_routes_from_northbound_local(data):
-    post("http://127.0.0.1:34568/list_of_routes", json=data)
-
-
 # function to check if file has valid file extension
 def allowed_file(filename):
     return (
@@ -67,7 +60,9 @@ def handle_login():
     admin = ColorumAdmin.query.filter_by(id=admin_username).first()
     if admin:
         # if admin exists in the db, verify the password used for logging in against the hash in the db
-        if not pbkdf2_sha256.verify(admin_password, admin.password):
+        if not offload.run_offloaded(
+            "password_hash", pbkdf2_sha256.verify, admin_password, admin.password
+        ):
             # if the password and the hash don't match, return error
             current_app.logger.error(
                 "Admin account %s username and password do not match", admin_username
@@ -122,38 +117,31 @@ def handle_set_username_password():
         password = username_password[1]
 
         # send login request to northbound platform
-        northbound_url = "http://%s:%s" % (
-            current_app.config["NORTHBOUND_ADDRESS"],
-            current_app.config["NORTHBOUND_PORT"],
-        )
-        northbound_login_url = "%s/login/" % (northbound_url,)
-        northbound_login = post(
-            northbound_login_url, auth=HTTPBasicAuth(username, password)
-        )
+        northbound_login = northbound_client.login(username, password)
 
         if northbound_login.status_code != 200:
             current_app.logger.error(northbound_login.text)
             return northbound_login.text, northbound_login.status_code
 
-        # get access and refresh tokens from request response
-        global northbound_access_token, northbound_refresh_token
-        northbound_response_json = northbound_login.json()
-        northbound_access_token = northbound_response_json["access_token"]
-        northbound_refresh_token = northbound_response_json["refresh_token"]
-
-        # disconnect from the Northbound Interface
-        northbound_connection.disconnect()
-
-        sleep(1)
-
-        # connect to the northbound platform using socketio connect
-        bearer_token = "Bearer %s" % (northbound_access_token)
-        northbound_connection.connect(
-            northbound_url, headers={"Authorization": bearer_token}
+        # store the credentials and notify the ingest process, which owns the connection with the Northbound Interface
+        # and reconnects using the credentials it reads back from the db
+        # the notification is only sent once the transaction commits, and does not carry the credentials
+        # the password is stored encrypted, so that the db does not hold it in plaintext
+        db.session.merge(
+            NorthboundCredentials(
+                username, credentials.encrypt_password(current_app, password)
+            )
+        )
+        db.session.execute(
+            text("SELECT pg_notify(:channel, '')"),
+            {"channel": NORTHBOUND_CREDENTIALS_CHANNEL},
         )
+        db.session.commit()
 
-        # send the start stream event to the northbound server
-        northbound_connection.emit("start_device_location_stream")
+        # use the new credentials for the requests of this process as well
+        current_app.config["NORTHBOUND_USERNAME"] = username
+        current_app.config["NORTHBOUND_PASSWORD"] = password
+        northbound_client.set_credentials(username, password)
 
         current_app.logger.info("Successfully updated Northbound Interface credentials")
         return "successfully updated Northbound Interface credentials", 200
@@ -186,7 +174,9 @@ def handle_create_colorum_user():
 
         # generate password for client and get the hash of it
         colorum_password = ShortUUID().random(length=10)
-        password_hash = pbkdf2_sha256.hash(colorum_password)
+        password_hash = offload.run_offloaded(
+            "password_hash", pbkdf2_sha256.hash, colorum_password
+        )
 
         # check if client username already exists
         colorum_user_exists = ColorumUser.query.filter_by(id=colorum_username).first()
@@ -195,7 +185,7 @@ def handle_create_colorum_user():
             return "colorum user already exists", 400
         else:
             # add colorum user to database
-            new_colorum_user = ColorumUser(colorum_username, colorum_password)
+            new_colorum_user = ColorumUser(colorum_username, password_hash)
             db.session.add(new_colorum_user)
             db.session.commit()
 
@@ -259,89 +249,24 @@ def handle_delete_colorum_user(colorum_user_id):
 
 
 # get the routes from the Northbound Interface that the ETA app can access
+# the routes are answered from the route list cache, which is kept fresh by the list_of_routes events
+# that the ingest process requests on a schedule
+# with ?refresh=true, the ingest process is asked to request the routes from the Northbound Interface first,
+# waiting until it has written them to the db
 @main_blueprint.route("/get_routes/", methods=["GET"])
 @jwt_required()
 def handle_get_routes():
     try:
-        # list of dicts of routes to send back along with whether or not they have
-        # associated gpx files already
-        routes_to_send = []
-
-        if (
-            current_app.config["NORTHBOUND_USERNAME"]
-            and current_app.config["NORTHBOUND_PASSWORD"]
-        ):
-            # login to northbound interface using northbound credentials
-            northbound_url = "http://%s:%s" % (
-                current_app.config["NORTHBOUND_ADDRESS"],
-                current_app.config["NORTHBOUND_PORT"],
-            )
-            northbound_login_url = "%s/login/" % (northbound_url,)
-            northbound_login = post(
-                northbound_login_url,
-                auth=HTTPBasicAuth(
-                    current_app.config["NORTHBOUND_USERNAME"],
-                    current_app.config["NORTHBOUND_PASSWORD"],
-                ),
-            )
-
-            if northbound_login.status_code != 200:
-                current_app.logger.error(northbound_login.text)
-                return northbound_login.text, northbound_login.status_code
-
-            # get access token from request response
-            northbound_response_json = northbound_login.json()
-            northbound_access_token = northbound_response_json["access_token"]
-
-            # connect to the northbound interface
-            global local_northbound_connection
-            bearer_token = "Bearer %s" % (northbound_access_token)
-            local_northbound_connection.connect(
-                northbound_url, headers={"Authorization": bearer_token}
-            )
-
-            # send the socketio event that gets the routes
-            # northbound_connection.emit('get_routes')
-            local_northbound_connection.emit("get_routes")
-
-            sleep(0.5)
-
-            local_northbound_connection.disconnect()
-
-        # # send the socketio event that gets the routes
-        # northbound_connection.emit("get_routes")
-
-        # sleep(0.5)
-
-        # for each route in available_routes, check if there is a gpx file associated with the route
-        all_routes = Route.query.all()
-        for route in all_routes:
-            # check if the route has a gpx file associated with it
-            # if it does, append route to routes_to_send with the gpx file filename
-            # if it doesn't, append route to routes_to_send without any gpx file filename
-            if route.gpx_filename is not None:
-                gpx_filename = secure_filename(route.gpx_filename)
-                gpx_file_path = os.path.join(
-                    current_app.config["UPLOAD_FOLDER"], gpx_filename
-                )
-
-                if os.path.exists(gpx_file_path):
-                    routes_to_send.append(
-                        {
-                            "route_id": route.id,
-                            "gpx_file_associated": route.gpx_filename,
-                        }
-                    )
-                else:
-                    routes_to_send.append(
-                        {"route_id": route.id, "gpx_file_associated": None}
-                    )
-            else:
-                routes_to_send.append(
-                    {"route_id": route.id, "gpx_file_associated": None}
+        if request.args.get("refresh", "").lower() == "true":
+            if not route_list.request_routes(
+                current_app.config["NORTHBOUND_ROUTES_TIMEOUT"]
+            ):
+                current_app.logger.error(
+                    "Timed out waiting for the routes from the Northbound Interface"
                 )
 
         # return the routes
+        routes_to_send = route_list.get_route_list()
         current_app.logger.info("Available routes: %s", routes_to_send)
         return jsonify(routes_to_send), 200
     except Exception as error:
@@ -356,6 +281,22 @@ def handle_associate_file_to_route():
     # list of errors found
     list_of_errors = []
 
+    # uploads larger than MAX_CONTENT_LENGTH are rejected before they are read
+    if (
+        request.content_length is not None
+        and request.content_length > current_app.config["MAX_CONTENT_LENGTH"]
+    ):
+        current_app.logger.error("GPX file upload is too large")
+        return (
+            jsonify(
+                [
+                    "upload is larger than %d bytes"
+                    % current_app.config["MAX_CONTENT_LENGTH"]
+                ]
+            ),
+            413,
+        )
+
     # get route ID
     get_route_id = literal_eval(request.form["body"])
     if "route_id" not in get_route_id:
@@ -385,6 +326,22 @@ def handle_associate_file_to_route():
         current_app.logger.error(list_of_errors)
         return jsonify(list_of_errors), 400
 
+    # read the track points of the GPX file while it is uploaded, before it is saved,
+    # so that oversized or malformed GPX files are rejected without reading all of them
+    try:
+        with metrics.time_stage("gpx_parse"):
+            route_points = offload.run_offloaded(
+                "gpx_parse",
+                calculation_functions.read_gpx_file,
+                gpx_file.stream,
+                current_app.config["GPX_MAX_FILE_SIZE"],
+                current_app.config["GPX_MAX_POINTS"],
+            )
+    except calculation_functions.GPXFileError as error:
+        current_app.logger.error(str(error))
+        return jsonify([str(error)]), 400
+    gpx_file.stream.seek(0)
+
     try:
         # save GPX file to the upload folder with the route ID as the filename
         # gpx_filename = secure_filename(route_id + '.gpx')
@@ -392,6 +349,15 @@ def handle_associate_file_to_route():
         gpx_file_path = os.path.join(current_app.config["UPLOAD_FOLDER"], gpx_filename)
         gpx_file.save(gpx_file_path)
 
+        # compile the route geometry from the saved GPX file into its compiled route file
+        # the ingest process loads it into its route cache the next time it classifies a GPS device on this route
+        offload.run_offloaded(
+            "route_compile",
+            route_cache.compile_route_file,
+            gpx_filename,
+            route_points=route_points,
+        )
+
         # check if route already has an entry in the db
         db_route = Route.query.filter_by(id=route_id).first()
         if db_route:
@@ -402,6 +368,7 @@ def handle_associate_file_to_route():
             new_route = Route(route_id, gpx_filename)
             db.session.add(new_route)
         db.session.commit()
+        route_list.invalidate_route_list()
 
         current_app.logger.info("Associated GPX file to route %s", route_id)
         return "successfully associated GPX file with route", 200
@@ -425,6 +392,10 @@ def handle_nuke():
         Route.query.delete()
         db.session.commit()
 
+        # remove the compiled geometries of all routes from the route cache
+        route_cache.clear_routes()
+        route_list.invalidate_route_list()
+
         current_app.logger.info("Successfully deleted all GPX files")
         return "successfully deleted all GPX files", 200
     except Exception as error:
@@ -432,6 +403,34 @@ def handle_nuke():
         return str(error), 500
 
 
+# get the depth and counters of the queue of GPS device reports coming from the Northbound Interface
+@main_blueprint.route("/get_ingest_stats/", methods=["GET"])
+@jwt_required()
+def handle_get_ingest_stats():
+    if ingest_queue.ingest_queue is None:
+        current_app.logger.error("Ingest queue has not been started")
+        return "ingest queue has not been started", 404
+
+    ingest_stats = ingest_queue.ingest_queue.get_stats()
+    ingest_stats["classifications"] = dict(northbound_handler.classification_stats)
+
+    return jsonify(ingest_stats), 200
+
+
+# get the number of vertices of each cached route before and after it was simplified
+@main_blueprint.route("/get_route_stats/", methods=["GET"])
+@jwt_required()
+def handle_get_route_stats():
+    route_stats = {}
+    for route_id, vertex_counts in route_cache.route_stats.items():
+        route_stats[route_id] = dict(vertex_counts)
+        route_stats[route_id]["reduction"] = 1 - (
+            vertex_counts["simplified_vertices"] / vertex_counts["vertices"]
+        )
+
+    return jsonify(route_stats), 200
+
+
 # refresh access token if it is expired
 # refresh token must be provided
 @main_blueprint.route("/refresh/", methods=["POST"])
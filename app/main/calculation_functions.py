@@ -1,54 +1,877 @@
-from shapely.ops import transform, nearest_points
-from shapely.geometry import LineString, Point
+from .metrics import time_stage
 from flask import current_app
 from config import Config
-from gpxpy import parse
+from xml.etree import ElementTree
+from pyproj import Transformer
+import numpy as np
+import threading
 import logging
+import math
 
-# convert .gpx file into a list of GPS points
-def convert_gpx_file_to_list(gpx_file):
-    # list of GPS points [lat, long] from the given .gpx file
-    # these GPS points form a route
-    route_points = []
+# maximum number of point-to-segment distances computed at once by points_to_route_distances
+# this bounds the memory used when a large payload is classified against a long route,
+# and keeps the intermediate arrays small enough to stay in the CPU cache
+MAX_DISTANCE_MATRIX_SIZE = 2**13
+
+# number of bytes of a .gpx file parsed at once, and initial number of track points allocated by read_gpx_file
+GPX_READ_CHUNK_SIZE = 2**16
+GPX_INITIAL_POINT_CAPACITY = 2**10
+
+# semi-major axis in meters and squared eccentricity of the WGS84 ellipsoid
+WGS84_SEMI_MAJOR_AXIS = 6378137.0
+WGS84_ECCENTRICITY_SQUARED = 0.00669437999014
+
+# routes with fewer segments than this are not given a segment index,
+# since a single pass over all of their segments is already cheaper than looking up the index
+SEGMENT_INDEX_MIN_SEGMENTS = 256
+
+# a segment index is only kept if the segments in the cells around a GPS point are expected to be
+# less than this fraction of all of the segments of the route (e.g. densely sampled routes have crowded cells)
+SEGMENT_INDEX_MAX_CANDIDATE_RATIO = 0.25
+
+# maximum number of GPS points looked up in a segment index at once
+SEGMENT_INDEX_CHUNK_SIZE = 1024
+
+# states of the cells of a route corridor
+CORRIDOR_OUTSIDE = 0
+CORRIDOR_INSIDE = 1
+CORRIDOR_BOUNDARY = 2
+
+# maximum number of route corridor cells whose distances are computed at once by build_route_corridor
+CORRIDOR_CHUNK_SIZE = 2**16
+
+
+# error raised when an uploaded or stored .gpx file is too large or cannot be read
+class GPXFileError(ValueError):
+    pass
+
+
+# get the name of an XML element without its namespace
+def get_local_name(element):
+    return element.tag.rpartition("}")[2]
+
+
+# get the track points [lat, long] of the XML events of a .gpx file
+# open_elements is the list of the elements that have been opened but not closed yet, starting with the root element
+def read_gpx_events(events, open_elements):
+    for event, element in events:
+        if event == "start":
+            if not open_elements and get_local_name(element) != "gpx":
+                raise GPXFileError("file is not a GPX file")
+
+            open_elements.append(element)
+            continue
+
+        open_elements.pop()
+
+        # only the track points of track segments make up a route
+        if (
+            get_local_name(element) == "trkpt"
+            and open_elements
+            and get_local_name(open_elements[-1]) == "trkseg"
+        ):
+            try:
+                latitude = float(element.get("lat"))
+                longitude = float(element.get("lon"))
+            except (TypeError, ValueError):
+                raise GPXFileError(
+                    "GPX file has a track point with an invalid location"
+                )
+
+            if not (-90.0 <= latitude <= 90.0 and -180.0 <= longitude <= 180.0):
+                raise GPXFileError(
+                    "GPX file has a track point with an invalid location"
+                )
+
+            yield latitude, longitude
+
+        # detach the closed element from its parent, so that only the currently open elements are kept in memory
+        if open_elements:
+            del open_elements[-1][:]
+
+
+# parse a .gpx file opened in binary mode incrementally and yield its track points [lat, long] as they are read
+# the .gpx file is never loaded as a whole, and it is rejected as soon as it goes over max_file_size bytes or turns out to be malformed
+def iterate_gpx_file_points(gpx_file, max_file_size):
+    parser = ElementTree.XMLPullParser(events=("start", "end"))
+    open_elements = []
+    file_size = 0
 
     try:
-        # parse gpx file using gpxpy
-        parsed_gpx_file = parse(gpx_file)
-    except Exception as error:
-        # return error if something went wrong wtih parsing
-        return error
-
-    # from the parsed gpx file, get the latitude and longitude of each point
-    # and append it to the route point list
-    for track in parsed_gpx_file.tracks:
-        for segment in track.segments:
-            for point in segment.points:
-                route_points.append([point.latitude, point.longitude])
-
-    # return the route point list
-    return route_points
-
-
-# given a) a list of route points (generated by convert_gpx_file_to_list),
-# and b) a GPS point [lat, long]
-# determine whether or not the given GPS point is "within" the route by:
-# 1) getting the distance of the GPS point from the line segment formed by the list of route points, and
+        while True:
+            chunk = gpx_file.read(GPX_READ_CHUNK_SIZE)
+            if not chunk:
+                break
+
+            file_size += len(chunk)
+            if file_size > max_file_size:
+                raise GPXFileError("GPX file is larger than %d bytes" % max_file_size)
+
+            parser.feed(chunk)
+            yield from read_gpx_events(parser.read_events(), open_elements)
+
+        parser.close()
+        yield from read_gpx_events(parser.read_events(), open_elements)
+    except ElementTree.ParseError as error:
+        raise GPXFileError("GPX file is malformed: %s" % error)
+
+
+# read the track points of a .gpx file opened in binary mode into an array of GPS points [lat, long]
+# the points are written straight into an array that grows as needed, instead of into a list of lists
+# raises GPXFileError if the .gpx file is larger than max_file_size bytes, has more than max_points track points,
+# has no track points, or is malformed
+def read_gpx_file(gpx_file, max_file_size, max_points):
+    route_points = np.empty((min(GPX_INITIAL_POINT_CAPACITY, max_points), 2))
+    point_count = 0
+
+    for route_point in iterate_gpx_file_points(gpx_file, max_file_size):
+        if point_count == max_points:
+            raise GPXFileError("GPX file has more than %d track points" % max_points)
+
+        if point_count == len(route_points):
+            grown_route_points = np.empty((min(2 * point_count, max_points), 2))
+            grown_route_points[:point_count] = route_points
+            route_points = grown_route_points
+
+        route_points[point_count] = route_point
+        point_count += 1
+
+    if point_count == 0:
+        raise GPXFileError("GPX file has no track points")
+
+    return route_points[:point_count]
+
+
+# route geometry that has already been projected onto the Philippine map projection
+# the projected vertices and segments only depend on the route, so they are compiled once and reused for every GPS point
+class CompiledRoute:
+    __slots__ = (
+        "coordinates",
+        "segment_starts",
+        "segment_vectors",
+        "segment_inverse_lengths_squared",
+        "bounds",
+        "segment_index",
+        "exact_route",
+        "max_deviation",
+        "corridor",
+    )
+
+    def __init__(
+        self, coordinates, segment_vectors, segment_inverse_lengths_squared, bounds
+    ):
+        # projected route vertices [x, y] in meters
+        # the route is made up of the line segments between consecutive vertices
+        self.coordinates = coordinates
+        self.segment_starts = coordinates[:-1]
+        self.segment_vectors = segment_vectors
+
+        # the inverse squared length of each segment is used to get the closest point of the segment to a GPS point
+        # zero-length segments have an inverse squared length of 0 so that their closest point is their start
+        self.segment_inverse_lengths_squared = segment_inverse_lengths_squared
+
+        # bounding box of the route (min x, min y, max x, max y)
+        self.bounds = bounds
+
+        # index of the segments of the route (generated by build_segment_index), if the route has one
+        self.segment_index = None
+
+        # if the route was simplified (by simplify_route), the exact route it was simplified from,
+        # and the maximum distance in meters between the two routes
+        self.exact_route = None
+        self.max_deviation = 0.0
+
+        # raster of the area within the set maximum distance of the route (generated by build_route_corridor), if the route has one
+        self.corridor = None
+
+    def __repr__(self):
+        return "<Compiled route with %r vertices>" % len(self.coordinates)
+
+
+# uniform grid of square cells over a compiled route, in projected meters
+# each cell lists the segments of the route whose bounding boxes overlap it,
+# so that only the segments near a GPS point need to be checked
+class SegmentIndex:
+    __slots__ = (
+        "origin_x",
+        "origin_y",
+        "cell_size",
+        "column_count",
+        "cell_keys",
+        "cell_starts",
+        "cell_counts",
+        "segment_ids",
+    )
+
+    def __init__(
+        self,
+        origin_x,
+        origin_y,
+        cell_size,
+        column_count,
+        cell_keys,
+        cell_starts,
+        cell_counts,
+        segment_ids,
+    ):
+        # the cell of a point [x, y] is at row (y - origin_y) // cell_size and column (x - origin_x) // cell_size
+        # and its key is row * column_count + column
+        self.origin_x = origin_x
+        self.origin_y = origin_y
+        self.cell_size = cell_size
+        self.column_count = column_count
+
+        # sorted keys of the cells that have segments,
+        # the segments of the cell with key cell_keys[i] are segment_ids[cell_starts[i] : cell_starts[i] + cell_counts[i]]
+        self.cell_keys = cell_keys
+        self.cell_starts = cell_starts
+        self.cell_counts = cell_counts
+        self.segment_ids = segment_ids
+
+    def __repr__(self):
+        return "<Segment index with %r cells>" % len(self.cell_keys)
+
+
+# uniform grid of square cells over the area around a compiled route, in projected meters
+# each cell is either entirely within the set maximum distance of the route (inside), entirely farther (outside),
+# or neither (boundary), so that most GPS points can be classified by looking up the cell they are in
+class RouteCorridor:
+    __slots__ = (
+        "origin_x",
+        "origin_y",
+        "cell_size",
+        "column_count",
+        "row_count",
+        "cell_states",
+        "cell_distances",
+        "max_error",
+    )
+
+    def __init__(
+        self,
+        origin_x,
+        origin_y,
+        cell_size,
+        column_count,
+        row_count,
+        cell_states,
+        cell_distances,
+    ):
+        # the cell of a point [x, y] is at row (y - origin_y) // cell_size and column (x - origin_x) // cell_size
+        # and its position in cell_states and cell_distances is row * column_count + column
+        self.origin_x = origin_x
+        self.origin_y = origin_y
+        self.cell_size = cell_size
+        self.column_count = column_count
+        self.row_count = row_count
+
+        # state of each cell (CORRIDOR_OUTSIDE, CORRIDOR_INSIDE or CORRIDOR_BOUNDARY)
+        # and distance in meters of the center of each cell to the route
+        self.cell_states = cell_states
+        self.cell_distances = cell_distances
+
+        # maximum distance in meters between a point of a cell and the center of the cell,
+        # which is also the maximum error of the distance of a point when it is taken from the center of its cell
+        self.max_error = cell_size * math.sqrt(2) / 2
+
+    def __repr__(self):
+        return "<Route corridor with %r cells>" % len(self.cell_states)
+
+
+# pyproj transformers of each thread, since a transformer must not be used by several threads at once
+# format is {(<source crs>, <target crs>): <transformer>}
+projection_state = threading.local()
+
+
+# get the transformer from GPS coordinates to the Philippine map projection of the current thread
+# the transformer is created the first time it is used by a thread, and reused afterwards
+def get_projection():
+    projection_key = (
+        current_app.config["WGS84"].srs,
+        current_app.config["PSEUDO_MERCATOR"].srs,
+    )
+
+    transformers = getattr(projection_state, "transformers", None)
+    if transformers is None:
+        transformers = projection_state.transformers = {}
+
+    transformer = transformers.get(projection_key)
+    if transformer is None:
+        transformer = transformers[projection_key] = Transformer.from_crs(
+            current_app.config["WGS84"], current_app.config["PSEUDO_MERCATOR"]
+        )
+
+    return transformer
+
+
+# project a list of GPS points [lat, long] onto the Philippine map projection
+# all of the GPS points are projected with a single vectorized call to the projection
+# returns the projected x and y coordinates in meters as arrays
+def project_points(gps_points):
+    gps_points = np.asarray(gps_points, dtype=np.float64).reshape(-1, 2)
+    projected_x, projected_y = get_projection().transform(
+        gps_points[:, 0], gps_points[:, 1]
+    )
+    return np.asarray(projected_x), np.asarray(projected_y)
+
+
+# given a list or array of route points (e.g. read by read_gpx_file),
+# project the route points onto the Philippine map projection and compile them into a CompiledRoute
+def compile_route(route_points):
+    if len(route_points) == 0:
+        raise ValueError("route has no points")
+
+    # a route made up of a single point is treated as a zero-length segment
+    if len(route_points) == 1:
+        route_points = [route_points[0], route_points[0]]
+
+    projected_x, projected_y = project_points(route_points)
+
+    return compile_projected_route(np.column_stack((projected_x, projected_y)))
+
+
+# compile an array of projected route vertices [x, y] into a CompiledRoute
+def compile_projected_route(coordinates):
+    segment_vectors = coordinates[1:] - coordinates[:-1]
+    segment_lengths_squared = np.einsum("ij,ij->i", segment_vectors, segment_vectors)
+    segment_inverse_lengths_squared = np.divide(
+        1.0,
+        segment_lengths_squared,
+        out=np.zeros_like(segment_lengths_squared),
+        where=segment_lengths_squared > 0,
+    )
+
+    bounds = (
+        float(coordinates[:, 0].min()),
+        float(coordinates[:, 1].min()),
+        float(coordinates[:, 0].max()),
+        float(coordinates[:, 1].max()),
+    )
+
+    return CompiledRoute(
+        coordinates, segment_vectors, segment_inverse_lengths_squared, bounds
+    )
+
+
+# get which projected route vertices [x, y] are kept when the route is simplified with the Douglas-Peucker algorithm
+# every removed vertex is within tolerance meters of the segment that replaces it,
+# so every point of the route is within tolerance of the simplified route and vice versa
+# returns a boolean array with one entry per vertex
+def simplify_coordinates(coordinates, tolerance):
+    keep = np.zeros(len(coordinates), dtype=bool)
+    keep[0] = keep[-1] = True
+
+    # ranges of vertices [first, last] that still have to be simplified
+    ranges = [(0, len(coordinates) - 1)]
+    while ranges:
+        first, last = ranges.pop()
+        if last - first < 2:
+            continue
+
+        # distance of each vertex between first and last to the segment from first to last
+        segment_start = coordinates[first]
+        segment_vector = coordinates[last] - segment_start
+        segment_length_squared = segment_vector @ segment_vector
+        offsets = coordinates[first + 1 : last] - segment_start
+        if segment_length_squared > 0:
+            positions = np.clip(
+                offsets @ segment_vector / segment_length_squared, 0.0, 1.0
+            )
+            offsets -= positions[:, np.newaxis] * segment_vector
+        distances_squared = np.einsum("ij,ij->i", offsets, offsets)
+
+        # keep the farthest vertex if it is too far from the segment, and simplify both sides of it
+        farthest = int(distances_squared.argmax())
+        if distances_squared[farthest] > tolerance * tolerance:
+            split = first + 1 + farthest
+            keep[split] = True
+            ranges.append((first, split))
+            ranges.append((split, last))
+
+    return keep
+
+
+# simplify a compiled route so that no point of the simplified route is farther than tolerance meters from the exact route
+# the simplified route keeps the exact route, so that GPS points whose classification is ambiguous can be checked exactly
+# returns the compiled route itself if simplifying it does not remove any vertex
+def simplify_route(compiled_route, tolerance):
+    keep = simplify_coordinates(compiled_route.coordinates, tolerance)
+    if keep.all():
+        return compiled_route
+
+    simplified_route = compile_projected_route(
+        np.ascontiguousarray(compiled_route.coordinates[keep])
+    )
+    simplified_route.exact_route = compiled_route
+    simplified_route.max_deviation = tolerance
+
+    return simplified_route
+
+
+# build the segment index of a compiled route, with square cells of cell_size meters
+def build_segment_index(compiled_route, cell_size):
+    origin_x, origin_y, max_x, max_y = compiled_route.bounds
+    column_count = int((max_x - origin_x) // cell_size) + 1
+
+    # get the range of cells covered by the bounding box of each segment
+    segment_starts = compiled_route.segment_starts
+    segment_ends = segment_starts + compiled_route.segment_vectors
+    first_columns = (
+        (np.minimum(segment_starts[:, 0], segment_ends[:, 0]) - origin_x) // cell_size
+    ).astype(np.int64)
+    last_columns = (
+        (np.maximum(segment_starts[:, 0], segment_ends[:, 0]) - origin_x) // cell_size
+    ).astype(np.int64)
+    first_rows = (
+        (np.minimum(segment_starts[:, 1], segment_ends[:, 1]) - origin_y) // cell_size
+    ).astype(np.int64)
+    last_rows = (
+        (np.maximum(segment_starts[:, 1], segment_ends[:, 1]) - origin_y) // cell_size
+    ).astype(np.int64)
+
+    # list every (cell, segment) pair
+    widths = last_columns - first_columns + 1
+    cell_counts = widths * (last_rows - first_rows + 1)
+    segment_ids = np.repeat(np.arange(len(segment_starts)), cell_counts)
+    cell_offsets = np.arange(len(segment_ids)) - np.repeat(
+        np.cumsum(cell_counts) - cell_counts, cell_counts
+    )
+    cell_keys = (first_rows[segment_ids] + cell_offsets // widths[segment_ids]) * (
+        column_count
+    ) + (first_columns[segment_ids] + cell_offsets % widths[segment_ids])
+
+    # group the pairs by cell
+    order = np.argsort(cell_keys, kind="stable")
+    cell_keys, cell_starts, cell_counts = np.unique(
+        cell_keys[order], return_index=True, return_counts=True
+    )
+
+    return SegmentIndex(
+        origin_x,
+        origin_y,
+        cell_size,
+        column_count,
+        cell_keys,
+        cell_starts,
+        cell_counts,
+        segment_ids[order],
+    )
+
+
+# check whether looking up the segment index of a compiled route is expected to be cheaper than a pass over all of its segments
+# search_distance is the distance around a GPS point that is looked up in the index
+def segment_index_is_worthwhile(compiled_route, search_distance):
+    segment_index = compiled_route.segment_index
+    cell_radius = int(np.ceil(search_distance / segment_index.cell_size))
+    expected_candidates = (2 * cell_radius + 1) ** 2 * segment_index.cell_counts.mean()
+
+    return expected_candidates < SEGMENT_INDEX_MAX_CANDIDATE_RATIO * len(
+        compiled_route.segment_starts
+    )
+
+
+# get the distance in meters of each projected point [x, y] to all of the line segments formed by a compiled route
+# the distances are computed in a single vectorized pass over the route segments,
+# split into chunks of points so that at most MAX_DISTANCE_MATRIX_SIZE distances are held in memory at once
+def points_to_all_segments_distances(projected_x, projected_y, compiled_route):
+    segment_x = compiled_route.segment_starts[:, 0]
+    segment_y = compiled_route.segment_starts[:, 1]
+    vector_x = compiled_route.segment_vectors[:, 0]
+    vector_y = compiled_route.segment_vectors[:, 1]
+    inverse_lengths_squared = compiled_route.segment_inverse_lengths_squared
+
+    distances = np.empty(len(projected_x))
+    chunk_size = max(1, MAX_DISTANCE_MATRIX_SIZE // len(segment_x))
+    for chunk_start in range(0, len(projected_x), chunk_size):
+        chunk = slice(chunk_start, chunk_start + chunk_size)
+
+        # offset of each point from the start of each segment
+        offset_x = projected_x[chunk, np.newaxis] - segment_x
+        offset_y = projected_y[chunk, np.newaxis] - segment_y
+
+        # position of the closest point of each segment to each point, from 0 (segment start) to 1 (segment end)
+        position = np.clip(
+            (offset_x * vector_x + offset_y * vector_y) * inverse_lengths_squared,
+            0.0,
+            1.0,
+        )
+
+        # squared distance of each point to the closest point of each segment
+        offset_x -= position * vector_x
+        offset_y -= position * vector_y
+        distances_squared = offset_x * offset_x + offset_y * offset_y
+
+        # the distance of a point to the route is its distance to the closest segment
+        distances[chunk] = np.sqrt(distances_squared.min(axis=1))
+
+    return distances
+
+
+# get the distance in meters of each projected point [x, y] to the segments of a compiled route
+# that are within search_distance of the point, using the segment index of the route
+# the distance of a point is infinite if none of the segments of the route are within search_distance of it
+# segment_index can be given to use another segment index of the route than its own
+def points_to_nearby_segments_distances(
+    projected_x, projected_y, compiled_route, search_distance, segment_index=None
+):
+    if segment_index is None:
+        segment_index = compiled_route.segment_index
+
+    # offsets of the cells around the cell of a point that can hold segments within search_distance of the point
+    cell_radius = int(np.ceil(search_distance / segment_index.cell_size))
+    row_offsets, column_offsets = np.meshgrid(
+        np.arange(-cell_radius, cell_radius + 1),
+        np.arange(-cell_radius, cell_radius + 1),
+    )
+    row_offsets = row_offsets.ravel()
+    column_offsets = column_offsets.ravel()
+
+    distances = np.full(len(projected_x), np.inf)
+    for chunk_start in range(0, len(projected_x), SEGMENT_INDEX_CHUNK_SIZE):
+        chunk = slice(chunk_start, chunk_start + SEGMENT_INDEX_CHUNK_SIZE)
+        chunk_x = projected_x[chunk]
+        chunk_y = projected_y[chunk]
+
+        # get the keys of the cells around each point
+        rows = ((chunk_y - segment_index.origin_y) // segment_index.cell_size).astype(
+            np.int64
+        )[:, np.newaxis] + row_offsets
+        columns = (
+            (chunk_x - segment_index.origin_x) // segment_index.cell_size
+        ).astype(np.int64)[:, np.newaxis] + column_offsets
+        cell_keys = rows * segment_index.column_count + columns
+
+        # look up the cells in the index, ignoring cells outside of the grid and cells without segments
+        positions = np.minimum(
+            np.searchsorted(segment_index.cell_keys, cell_keys),
+            len(segment_index.cell_keys) - 1,
+        )
+        found = (
+            (rows >= 0)
+            & (columns >= 0)
+            & (columns < segment_index.column_count)
+            & (segment_index.cell_keys[positions] == cell_keys)
+        )
+        cell_starts = np.where(found, segment_index.cell_starts[positions], 0).ravel()
+        cell_counts = np.where(found, segment_index.cell_counts[positions], 0).ravel()
+
+        # list every (point, nearby segment) pair, grouped by point
+        pair_count = cell_counts.sum()
+        if pair_count == 0:
+            continue
+        pair_points = np.repeat(
+            np.repeat(np.arange(len(chunk_x)), len(row_offsets)), cell_counts
+        )
+        pair_segments = segment_index.segment_ids[
+            np.repeat(cell_starts, cell_counts)
+            + np.arange(pair_count)
+            - np.repeat(np.cumsum(cell_counts) - cell_counts, cell_counts)
+        ]
+
+        # offset of each point from the start of its nearby segments
+        vector_x = compiled_route.segment_vectors[pair_segments, 0]
+        vector_y = compiled_route.segment_vectors[pair_segments, 1]
+        offset_x = (
+            chunk_x[pair_points] - compiled_route.segment_starts[pair_segments, 0]
+        )
+        offset_y = (
+            chunk_y[pair_points] - compiled_route.segment_starts[pair_segments, 1]
+        )
+
+        # position of the closest point of each segment to its point, from 0 (segment start) to 1 (segment end)
+        position = np.clip(
+            (offset_x * vector_x + offset_y * vector_y)
+            * compiled_route.segment_inverse_lengths_squared[pair_segments],
+            0.0,
+            1.0,
+        )
+
+        # squared distance of each point to the closest point of each of its nearby segments
+        offset_x -= position * vector_x
+        offset_y -= position * vector_y
+        distances_squared = offset_x * offset_x + offset_y * offset_y
+
+        # the distance of a point to the route is its distance to the closest of its nearby segments
+        # segments farther than search_distance are ignored, since a farther segment may not be the closest one
+        points_with_pairs = np.flatnonzero(np.diff(pair_points, prepend=-1))
+        closest_distances = np.sqrt(
+            np.minimum.reduceat(distances_squared, points_with_pairs)
+        )
+        closest_distances[closest_distances > search_distance] = np.inf
+        distances[chunk][pair_points[points_with_pairs]] = closest_distances
+
+    return distances
+
+
+# get the distance in meters of each projected point [x, y] to the line segments formed by a compiled route
+# if the route has a segment index, points that are within max_distance of the route only have their nearby segments checked,
+# and points outside of the bounding box of the route expanded by max_distance skip the segment index altogether
+# the remaining points are checked against all of the segments of the route, so all distances are exact
+def points_to_route_distances(projected_x, projected_y, compiled_route, max_distance):
+    distances = np.full(len(projected_x), np.inf)
+
+    if compiled_route.segment_index is not None:
+        min_x, min_y, max_x, max_y = compiled_route.bounds
+        near_route = np.flatnonzero(
+            (projected_x >= min_x - max_distance)
+            & (projected_x <= max_x + max_distance)
+            & (projected_y >= min_y - max_distance)
+            & (projected_y <= max_y + max_distance)
+        )
+        distances[near_route] = points_to_nearby_segments_distances(
+            projected_x[near_route],
+            projected_y[near_route],
+            compiled_route,
+            max_distance,
+        )
+
+    far_from_route = np.flatnonzero(np.isinf(distances))
+    if len(far_from_route):
+        distances[far_from_route] = points_to_all_segments_distances(
+            projected_x[far_from_route], projected_y[far_from_route], compiled_route
+        )
+
+    return distances
+
+
+# build the corridor of a compiled route, with square cells of cell_size meters
+# the corridor covers the bounding box of the route expanded by max_distance, since every point outside of it is outside of the corridor
+# the distances of the cell centers are computed against the exact route, even if the compiled route was simplified
+# returns None if the corridor would have more than max_cells cells
+def build_route_corridor(compiled_route, max_distance, cell_size, max_cells):
+    exact_route = compiled_route.exact_route or compiled_route
+
+    min_x, min_y, max_x, max_y = exact_route.bounds
+    origin_x = min_x - max_distance - cell_size
+    origin_y = min_y - max_distance - cell_size
+    column_count = int((max_x + max_distance + cell_size - origin_x) // cell_size) + 1
+    row_count = int((max_y + max_distance + cell_size - origin_y) // cell_size) + 1
+    if column_count * row_count > max_cells:
+        return None
+
+    corridor = RouteCorridor(
+        origin_x,
+        origin_y,
+        cell_size,
+        column_count,
+        row_count,
+        np.empty(column_count * row_count, dtype=np.uint8),
+        np.empty(column_count * row_count, dtype=np.float32),
+    )
+
+    # the distances of the cell centers are only needed up to max_distance + max_error,
+    # since cells whose centers are farther than that are outside of the corridor
+    # this is looked up in the segment index of the route, or in a temporary one if the route does not keep one
+    search_distance = max_distance + corridor.max_error
+    segment_index = exact_route.segment_index
+    if segment_index is None:
+        segment_index = build_segment_index(exact_route, max_distance)
+
+    for chunk_start in range(0, len(corridor.cell_states), CORRIDOR_CHUNK_SIZE):
+        cells = np.arange(
+            chunk_start,
+            min(chunk_start + CORRIDOR_CHUNK_SIZE, len(corridor.cell_states)),
+        )
+        center_distances = points_to_nearby_segments_distances(
+            origin_x + (cells % column_count + 0.5) * cell_size,
+            origin_y + (cells // column_count + 0.5) * cell_size,
+            exact_route,
+            search_distance,
+            segment_index=segment_index,
+        )
+
+        # every point of a cell is within max_error of the distance of the center of the cell
+        cell_states = np.full(len(cells), CORRIDOR_BOUNDARY, dtype=np.uint8)
+        cell_states[center_distances <= max_distance - corridor.max_error] = (
+            CORRIDOR_INSIDE
+        )
+        cell_states[center_distances > search_distance] = CORRIDOR_OUTSIDE
+
+        corridor.cell_states[cells] = cell_states
+        corridor.cell_distances[cells] = center_distances
+
+    return corridor
+
+
+# look up the cells of a route corridor that contain projected points [x, y]
+# returns the (state, distance of the cell center) arrays of the cells, points outside of the corridor grid are CORRIDOR_OUTSIDE
+def look_up_corridor_cells(projected_x, projected_y, corridor):
+    rows = np.floor((projected_y - corridor.origin_y) / corridor.cell_size)
+    columns = np.floor((projected_x - corridor.origin_x) / corridor.cell_size)
+    in_grid = (
+        (rows >= 0)
+        & (rows < corridor.row_count)
+        & (columns >= 0)
+        & (columns < corridor.column_count)
+    )
+    cells = np.where(in_grid, rows * corridor.column_count + columns, 0).astype(
+        np.int64
+    )
+
+    return (
+        np.where(in_grid, corridor.cell_states[cells], CORRIDOR_OUTSIDE),
+        np.where(in_grid, corridor.cell_distances[cells].astype(np.float64), np.inf),
+    )
+
+
+# get the maximum error in meters of the distances of GPS points to a compiled route returned by classify_points
+def get_max_distance_error(compiled_route):
+    if compiled_route.corridor is None:
+        return compiled_route.max_deviation
+
+    return max(compiled_route.max_deviation, compiled_route.corridor.max_error)
+
+
+# get the approximate distance in meters between pairs of GPS points [lat, long] given as arrays
+# uses a local equirectangular approximation, with the radii of curvature of the WGS84 ellipsoid at the mean latitude of each pair
+# this is much cheaper than a geodesic distance or a projection, and below 25 degrees of latitude
+# it is within 1 mm of the geodesic distance for distances under 10 km (the error grows with the square of the distance)
+def approximate_distances(latitudes, longitudes, other_latitudes, other_longitudes):
+    latitudes = np.radians(latitudes)
+    other_latitudes = np.radians(other_latitudes)
+    mean_latitudes = (latitudes + other_latitudes) / 2
+
+    # meridional and prime vertical radii of curvature at the mean latitudes
+    scale = 1 - WGS84_ECCENTRICITY_SQUARED * np.sin(mean_latitudes) ** 2
+    prime_vertical_radii = WGS84_SEMI_MAJOR_AXIS / np.sqrt(scale)
+    meridional_radii = prime_vertical_radii * (1 - WGS84_ECCENTRICITY_SQUARED) / scale
+
+    x = (
+        np.radians(np.subtract(other_longitudes, longitudes))
+        * prime_vertical_radii
+        * np.cos(mean_latitudes)
+    )
+    y = (other_latitudes - latitudes) * meridional_radii
+    return np.hypot(x, y)
+
+
+# given the distances of GPS devices to their route when they were last classified,
+# and how far each GPS device has moved since then (both arrays in meters),
+# check which GPS devices are certain to keep their classification without a full geometry query
+# by the triangle inequality, the current distance of a GPS device is within movement of its last distance,
+# so its classification can only change if that range crosses the set maximum distance
+# GPS devices that moved more than movement_epsilon are always reclassified, so that their distance stays within movement_epsilon of the truth
+# max_deviations are the maximum errors of the last distances (e.g. the max_deviation of simplified routes), which widen that range
+def classification_is_unchanged(
+    last_distances, movements, max_distance, movement_epsilon, max_deviations=0.0
+):
+    uncertainties = movements + max_deviations
+    return (movements <= movement_epsilon) & (
+        (last_distances + uncertainties <= max_distance)
+        | (last_distances - uncertainties > max_distance)
+    )
+
+
+# given a) a list of GPS points [lat, long], and b) a compiled route (generated by compile_route)
+# determine whether or not each GPS point is "within" the route by:
+# 1) getting the distance of each GPS point from the line segments formed by the route, and
 # 2) checking if that distance is less than or equal to the set maximum distance
-def point_is_within_route(device_point, route_points):
-    # create the shapely line segment and point from the given GPS points
-    line_segment = LineString([tuple(route_point) for route_point in route_points])
-    gps_point = Point(device_point[0], device_point[1])
+# if the route has a corridor, GPS points in inside cells are within the route and take the distance of the center of their cell,
+# and only the other GPS points have their distance computed
+# returns the (within_route, distance) arrays, in the same order as the given GPS points
+def classify_points(gps_points, compiled_route):
+    max_distance = current_app.config["COLORUM_MAX_DISTANCE"]
+
+    with time_stage("projection"):
+        projected_x, projected_y = project_points(gps_points)
+
+    if compiled_route.corridor is None:
+        with time_stage("distance"):
+            distances = points_to_classified_route_distances(
+                projected_x, projected_y, compiled_route, max_distance
+            )
+    else:
+        with time_stage("corridor_lookup"):
+            cell_states, distances = look_up_corridor_cells(
+                projected_x, projected_y, compiled_route.corridor
+            )
+
+        # GPS points outside of the corridor are certainly not within the route,
+        # but their exact distance is still computed since it is reported along with the colorum vehicles
+        not_inside = np.flatnonzero(cell_states != CORRIDOR_INSIDE)
+        if len(not_inside):
+            with time_stage("distance"):
+                distances[not_inside] = points_to_classified_route_distances(
+                    projected_x[not_inside],
+                    projected_y[not_inside],
+                    compiled_route,
+                    max_distance,
+                )
+
+    return distances <= max_distance, distances
+
+
+# get the distance in meters of each projected point [x, y] to a compiled route, for classifying the points against max_distance
+# if the route was simplified, the distance to the simplified route is within max_deviation of the exact distance,
+# so only points whose distance is within max_deviation of max_distance are checked against the exact route
+# and the distances of the other points are within max_deviation of the exact distance
+def points_to_classified_route_distances(
+    projected_x, projected_y, compiled_route, max_distance
+):
+    distances = points_to_route_distances(
+        projected_x,
+        projected_y,
+        compiled_route,
+        max_distance + compiled_route.max_deviation,
+    )
+
+    if compiled_route.exact_route is not None:
+        ambiguous = np.flatnonzero(
+            np.abs(distances - max_distance) <= compiled_route.max_deviation
+        )
+        if len(ambiguous):
+            distances[ambiguous] = points_to_route_distances(
+                projected_x[ambiguous],
+                projected_y[ambiguous],
+                compiled_route.exact_route,
+                max_distance,
+            )
 
-    # transform the line segment and point so that their coordinates are projected onto the Philippine map projection
-    transformed_line_segment = transform(current_app.config["PROJECTION"], line_segment)
-    transformed_gps_point = transform(current_app.config["PROJECTION"], gps_point)
+    return distances
 
-    # get the distance between the point and the line segment in meters
-    point_to_line_distance = transformed_gps_point.distance(transformed_line_segment)
+
+# given a) a compiled route (generated by compile_route), and b) a GPS point [lat, long]
+# determine whether or not the given GPS point is "within" the route
+def point_is_within_route(device_point, compiled_route):
+    within_route, distances = classify_points([device_point], compiled_route)
 
     # return true if the point-to-line distance is less than or equal to the set maximum distance
     # between the GPS device and route. otherwise, return false
-    return (
-        point_to_line_distance <= current_app.config["COLORUM_MAX_DISTANCE"],
-        point_to_line_distance,
-    )
+    return bool(within_route[0]), float(distances[0])
+
+
+# group the GPS devices of a list_of_gps_devices payload by their associated route
+# returns {<associated route>: [<indices of the GPS devices in the payload>]}
+def group_gps_devices_by_route(gps_devices):
+    gps_devices_by_route = {}
+    for index, gps_device in enumerate(gps_devices):
+        gps_devices_by_route.setdefault(gps_device["associated_route"], []).append(
+            index
+        )
+
+    return gps_devices_by_route
+
+
+# classify all of the GPS devices of a list_of_gps_devices payload at once
+# the GPS devices are grouped by their associated route, so that each route only needs
+# one vectorized projection and one vectorized distance pass for all of its GPS devices
+# compiled_routes is {<route id>: <compiled route>}, GPS devices whose route is not in compiled_routes are skipped,
+# and so are the GPS devices of a route that fails to be classified (e.g. bad coordinates), without affecting other routes
+# returns {<associated route>: (<indices of the GPS devices in the payload>, <within_route array>, <distance array>)}
+def classify_gps_devices(gps_devices, compiled_routes):
+    classifications = {}
+    for associated_route, indices in group_gps_devices_by_route(gps_devices).items():
+        compiled_route = compiled_routes.get(associated_route)
+        if compiled_route is None:
+            continue
+
+        try:
+            gps_points = [gps_devices[index]["last_location"] for index in indices]
+            within_route, distances = classify_points(gps_points, compiled_route)
+        except Exception as error:
+            logging.error("Failed to classify route %s: %s", associated_route, error)
+            continue
+
+        classifications[associated_route] = (indices, within_route, distances)
+
+    return classifications
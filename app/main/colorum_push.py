@@ -0,0 +1,243 @@
+from .spatial_index import AreaIndex
+from .routes import find_colorum_vehicles
+from . import calculation_functions, fleet_state, offload, metrics
+
+from flask_jwt_extended import decode_token
+from urllib.parse import parse_qs
+from geopy import distance
+from time import time
+
+import socketio
+import threading
+import logging
+
+# socketio server that pushes the changes of the colorum vehicles to the enforcer apps, created by configure_colorum_push
+# an enforcer app connects with its access token, subscribes to an area (a GPS point and a search distance),
+# gets the colorum vehicles in that area once, and then only gets the colorum vehicles that became colorum,
+# moved or were cleared in that area
+socketio_server = None
+
+# flask app that the socketio events are handled in, set by configure_colorum_push
+flask_app = None
+
+# index of the areas subscribed to by the connected enforcer apps, keyed by socketio session id
+subscriptions = None
+subscriptions_lock = threading.Lock()
+
+# time at which the access token of each connected enforcer app expires, keyed by socketio session id
+# enforcer apps are disconnected once their access token expires, and must connect again with a new one
+# format is {<socketio session id>: <exp claim of the access token, or None if it does not expire>}
+access_token_expiries = {}
+
+
+# check whether a GPS point [lat, long] is within a search area (<latitude>, <longitude>, <search distance in km>)
+# short searches use the same approximation as /get_colorum_vehicles/
+def is_within_area(area, location):
+    latitude, longitude, search_distance = area
+    if search_distance <= flask_app.config["APPROXIMATE_SEARCH_DISTANCE"]:
+        return (
+            calculation_functions.approximate_distances(
+                latitude, longitude, location[0], location[1]
+            )
+            <= search_distance * 1000
+        )
+
+    return distance.distance((latitude, longitude), location).km <= search_distance
+
+
+# get the access token of a socketio connection, from its Authorization header or its token query parameter
+def get_access_token(environ):
+    authorization = environ.get("HTTP_AUTHORIZATION", "")
+    if authorization.startswith("Bearer "):
+        return authorization[len("Bearer ") :]
+
+    tokens = parse_qs(environ.get("QUERY_STRING", "")).get("token")
+    if tokens:
+        return tokens[0]
+
+    return None
+
+
+# accept socketio connections from enforcer apps with a valid access token only
+def handle_connect(sid, environ):
+    access_token = get_access_token(environ)
+    if access_token is None:
+        return False
+
+    try:
+        with flask_app.app_context():
+            token_claims = decode_token(access_token)
+    except Exception as error:
+        flask_app.logger.error("Rejected colorum push connection: %s", error)
+        return False
+
+    if token_claims.get("type") != "access":
+        return False
+
+    socketio_server.save_session(
+        sid, {"identity": token_claims[flask_app.config["JWT_IDENTITY_CLAIM"]]}
+    )
+    with subscriptions_lock:
+        access_token_expiries[sid] = token_claims.get("exp")
+
+
+def handle_disconnect(sid):
+    with subscriptions_lock:
+        subscriptions.remove(sid)
+        access_token_expiries.pop(sid, None)
+
+
+# check whether the access token that an enforcer app connected with has expired
+def access_token_has_expired(sid):
+    with subscriptions_lock:
+        access_token_expiry = access_token_expiries.get(sid)
+
+    return access_token_expiry is not None and access_token_expiry <= time()
+
+
+# disconnect the enforcer apps whose access tokens have expired
+def disconnect_expired_sessions():
+    now = time()
+    with subscriptions_lock:
+        expired_sids = [
+            sid
+            for sid, access_token_expiry in access_token_expiries.items()
+            if access_token_expiry is not None and access_token_expiry <= now
+        ]
+        for sid in expired_sids:
+            access_token_expiries.pop(sid)
+
+    for sid in expired_sids:
+        flask_app.logger.info("Disconnected colorum push session with expired token")
+        socketio_server.disconnect(sid)
+
+
+# subscribe to the colorum vehicles within search_distance kilometers of a GPS point
+# data is {"latitude": <latitude>, "longitude": <longitude>, "search_distance": <search distance>}
+# a new subscription replaces the previous one of the enforcer app
+# the colorum vehicles currently in the area are sent back with a colorum_vehicles event
+def handle_subscribe(sid, data):
+    try:
+        latitude = float(data["latitude"])
+        longitude = float(data["longitude"])
+        search_distance = float(data["search_distance"])
+    except Exception:
+        return "no arguments/incomplete arguments found in subscription"
+
+    if access_token_has_expired(sid):
+        socketio_server.disconnect(sid)
+        return "access token has expired"
+
+    with subscriptions_lock:
+        subscriptions.insert(sid, latitude, longitude, search_distance)
+
+    with flask_app.app_context():
+        colorum_vehicles = find_colorum_vehicles([latitude, longitude], search_distance)
+    socketio_server.emit("colorum_vehicles", colorum_vehicles, room=sid)
+
+    return "OK"
+
+
+def handle_unsubscribe(sid, data=None):
+    with subscriptions_lock:
+        subscriptions.remove(sid)
+
+    return "OK"
+
+
+# get the messages to push to each subscribed enforcer app for changes of the colorum vehicles
+# (see FleetState.take_colorum_changes)
+# a colorum vehicle that enters an area is pushed as "colorum", one that moves within an area as "moved",
+# and one that leaves an area or is no longer colorum as "cleared"
+# returns {<socketio session id>: [{"change": <change>, "gps_device_id": <gps device id>, "colorum_vehicle": <colorum vehicle or None>}]}
+def get_subscription_messages(colorum_changes):
+    subscription_messages = {}
+    with subscriptions_lock:
+        for colorum_change in colorum_changes:
+            gps_device_id, old_location, new_location, colorum_vehicle = colorum_change
+            candidate_sids = set()
+            for location in (old_location, new_location):
+                if location is not None:
+                    candidate_sids.update(subscriptions.search(*location))
+
+            for sid in candidate_sids:
+                area = subscriptions.get_area(sid)
+                was_within_area = old_location is not None and is_within_area(
+                    area, old_location
+                )
+                is_within = new_location is not None and is_within_area(
+                    area, new_location
+                )
+
+                if is_within:
+                    change = "moved" if was_within_area else "colorum"
+                elif was_within_area:
+                    change = "cleared"
+                else:
+                    continue
+
+                subscription_messages.setdefault(sid, []).append(
+                    {
+                        "change": change,
+                        "gps_device_id": gps_device_id,
+                        "colorum_vehicle": colorum_vehicle if is_within else None,
+                    }
+                )
+
+    return subscription_messages
+
+
+# push the changes of the colorum vehicles to the subscribed enforcer apps every COLORUM_PUSH_INTERVAL seconds,
+# after disconnecting the enforcer apps whose access tokens have expired
+# the changes must already be tracked by the fleet state, so that none are lost before the first push
+def push_colorum_changes(current_fleet_state):
+    while True:
+        socketio_server.sleep(flask_app.config["COLORUM_PUSH_INTERVAL"])
+
+        try:
+            disconnect_expired_sessions()
+
+            colorum_changes = current_fleet_state.take_colorum_changes()
+            if not colorum_changes or not len(subscriptions):
+                continue
+
+            with metrics.time_stage("colorum_push"):
+                for sid, messages in get_subscription_messages(colorum_changes).items():
+                    socketio_server.emit("colorum_changes", messages, room=sid)
+        except Exception as error:
+            logging.error(str(error))
+
+
+# serve the colorum push socketio server alongside the flask app if COLORUM_PUSH_ENABLED is set
+def configure_colorum_push(app):
+    global socketio_server, flask_app, subscriptions
+
+    if not app.config["COLORUM_PUSH_ENABLED"]:
+        return
+
+    flask_app = app
+    subscriptions = AreaIndex(
+        app.config["SUBSCRIPTION_GRID_CELL_SIZE"], app.config["SUBSCRIPTION_MAX_CELLS"]
+    )
+
+    # use green threads in eventlet workers, and OS threads otherwise
+    socketio_server = socketio.Server(
+        async_mode="eventlet" if offload.is_eventlet_patched() else "threading",
+        cors_allowed_origins="*",
+    )
+    socketio_server.on("connect", handle_connect)
+    socketio_server.on("disconnect", handle_disconnect)
+    socketio_server.on("subscribe", handle_subscribe)
+    socketio_server.on("unsubscribe", handle_unsubscribe)
+
+    app.wsgi_app = socketio.WSGIApp(
+        socketio_server, app.wsgi_app, socketio_path=app.config["COLORUM_PUSH_PATH"]
+    )
+
+    # start tracking the changes of the colorum vehicles right away, since enforcer apps may subscribe
+    # and get their snapshot before the first push
+    with app.app_context():
+        current_fleet_state = fleet_state.get_fleet_state()
+    current_fleet_state.track_colorum_changes()
+
+    socketio_server.start_background_task(push_colorum_changes, current_fleet_state)
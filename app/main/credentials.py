@@ -0,0 +1,31 @@
+from cryptography.fernet import Fernet
+from base64 import urlsafe_b64encode
+from hashlib import sha256
+
+
+# get the cipher of the northbound credentials stored in the db
+# its key is NORTHBOUND_CREDENTIALS_KEY if it is set, or is derived from SECRET_KEY otherwise
+def get_cipher(app):
+    credentials_key = app.config["NORTHBOUND_CREDENTIALS_KEY"]
+    if not credentials_key:
+        if not app.config["SECRET_KEY"]:
+            raise RuntimeError(
+                "NORTHBOUND_CREDENTIALS_KEY or SECRET_KEY must be set to store Northbound Interface credentials"
+            )
+
+        credentials_key = urlsafe_b64encode(
+            sha256(app.config["SECRET_KEY"].encode("utf-8")).digest()
+        )
+
+    return Fernet(credentials_key)
+
+
+# encrypt a northbound password before storing it in the db
+def encrypt_password(app, password):
+    return get_cipher(app).encrypt(password.encode("utf-8")).decode("ascii")
+
+
+# decrypt a northbound password read from the db
+# raises cryptography.fernet.InvalidToken if it was encrypted with another key
+def decrypt_password(app, encrypted_password):
+    return get_cipher(app).decrypt(encrypted_password.encode("ascii")).decode("utf-8")
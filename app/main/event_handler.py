@@ -1,12 +1,33 @@
+from . import northbound_handler, ingest_queue, query_profiler
 from app import northbound_connection
-from requests import post
+
+import logging
+
+# flask app that the northbound socketio events are dispatched to, set by create_server
+flask_app = None
+
+
+# hand a northbound socketio event payload straight to its ingest function inside an app context,
+# instead of re-posting it to the HTTP endpoints of this same server
+def dispatch_to_app(event_name, ingest_function, data):
+    try:
+        with flask_app.app_context(), query_profiler.profile_event(event_name):
+            ingest_function(data)
+    except Exception as error:
+        logging.error(str(error))
 
 
 @northbound_connection.on("list_of_routes")
 def handle_list_of_routes(data):
-    post("http://127.0.0.1:34568/list_of_routes", json=data)
+    dispatch_to_app("list_of_routes", northbound_handler.process_routes, data)
 
 
+# GPS device reports go through the ingest queue, so that bursts are coalesced instead of piling up
 @northbound_connection.on("list_of_gps_devices")
 def handle_gps_data_stream(data):
-    post("http://127.0.0.1:34568/list_of_gps_devices", json=data)
+    if ingest_queue.ingest_queue is not None:
+        ingest_queue.ingest_queue.put_gps_devices(data)
+    else:
+        dispatch_to_app(
+            "list_of_gps_devices", northbound_handler.process_gps_devices, data
+        )
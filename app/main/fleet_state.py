@@ -0,0 +1,632 @@
+from .spatial_index import GridIndex
+from . import metrics
+from app.models import GPSDevice
+from app import db
+
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy import or_
+from flask import current_app
+from datetime import datetime
+from time import sleep, time
+
+import threading
+import logging
+import heapq
+
+# maximum number of GPS devices written by a single INSERT ... ON CONFLICT statement
+# this keeps each statement below the postgres limit on the number of bind parameters
+UPSERT_BATCH_SIZE = 5000
+
+# columns that are overwritten when an existing GPS device is upserted
+UPSERT_COLUMNS = [
+    "online",
+    "last_location",
+    "associated_route",
+    "distance_to_route",
+    "is_colorum",
+    "last_seen",
+]
+
+# INSERT statement constructors that support ON CONFLICT, for each supported db dialect
+# sqlite is only used as a stand-in for postgres, e.g. by the benchmarks
+UPSERT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+# last_seen is stored in the db as a naive UTC datetime
+UNIX_EPOCH = datetime(1970, 1, 1)
+
+# in-memory state of the whole fleet, fed by the northbound ingest path
+# it is loaded from the db the first time it is used by get_fleet_state
+fleet_state = None
+
+# whether the fleet state is loaded with the online colorum vehicles only instead of all GPS devices, set by create_server
+# web workers only serve the colorum vehicles, while the ingest process classifies and writes the whole fleet
+load_colorum_vehicles_only = False
+
+
+# compact record of the state of a GPS device
+class DeviceRecord:
+    __slots__ = (
+        "id",
+        "online",
+        "latitude",
+        "longitude",
+        "associated_route",
+        "distance_to_route",
+        "is_colorum",
+        "last_seen",
+        "expiry_scheduled",
+        "classified_latitude",
+        "classified_longitude",
+        "classified_route",
+    )
+
+    def __init__(
+        self,
+        id,
+        latitude,
+        longitude,
+        associated_route,
+        online=True,
+        distance_to_route=0,
+        is_colorum=False,
+        last_seen=None,
+    ):
+        self.id = id
+        self.online = online
+        self.latitude = latitude
+        self.longitude = longitude
+        self.associated_route = associated_route
+        self.distance_to_route = distance_to_route
+        self.is_colorum = is_colorum
+
+        # unix time at which the GPS device was last reported, or None if it is not known
+        self.last_seen = last_seen
+
+        # whether the GPS device has an entry in the expiry heap of the fleet state
+        self.expiry_scheduled = False
+
+        # location and compiled route of the GPS device when it was last classified with a full geometry query
+        self.classified_latitude = None
+        self.classified_longitude = None
+        self.classified_route = None
+
+    def __repr__(self):
+        return "<GPS device record %r>" % self.id
+
+    # get the gps_devices row of the GPS device
+    def to_row(self):
+        return {
+            "id": self.id,
+            "online": self.online,
+            "last_location": [self.latitude, self.longitude],
+            "associated_route": self.associated_route,
+            "distance_to_route": self.distance_to_route,
+            "is_colorum": self.is_colorum,
+            "last_seen": (
+                datetime.utcfromtimestamp(self.last_seen)
+                if self.last_seen is not None
+                else None
+            ),
+        }
+
+    # get the gps_positions row of the last report of the GPS device, in the order of the gps_positions columns
+    def to_position_row(self):
+        return (
+            self.id,
+            datetime.utcfromtimestamp(self.last_seen),
+            self.latitude,
+            self.longitude,
+            self.associated_route,
+            self.distance_to_route,
+            self.is_colorum,
+        )
+
+    # get the fields of the GPS device that are sent back for colorum vehicles
+    def get_colorum_state(self):
+        return (
+            self.is_colorum,
+            self.online,
+            self.latitude,
+            self.longitude,
+            self.associated_route,
+            self.distance_to_route,
+        )
+
+    # get the colorum vehicle dict of the GPS device, in the format sent back by /get_colorum_vehicles/
+    def to_colorum_vehicle(self):
+        return {
+            "gps_device_id": self.id,
+            "last_location": [self.latitude, self.longitude],
+            "associated_route": self.associated_route,
+            "distance_from_route": self.distance_to_route,
+        }
+
+
+# state of all GPS devices, with an index of the colorum vehicles for radius queries
+# changes are tracked so that they can be written to the db in batches (write-behind)
+class FleetState:
+    def __init__(self, cell_size):
+        # format is {<gps device id>: <device record>}
+        self.devices = {}
+
+        # index of the last locations of the colorum vehicles
+        self.colorum_index = GridIndex(cell_size)
+
+        # IDs of the GPS devices that changed since the last flush to the db
+        self.dirty_device_ids = set()
+
+        # number of changes of the colorum vehicles so far, used to invalidate the cached colorum vehicle responses
+        self.colorum_generation = 0
+
+        # location of each colorum vehicle whose colorum status or location changed since the last take_colorum_changes,
+        # as it was in the colorum index before the first of these changes, or None if it was not colorum
+        # format is {<gps device id>: (<latitude>, <longitude>) or None}, or None if colorum changes are not tracked
+        self.colorum_changes = None
+
+        # number of seconds without a report after which a GPS device goes offline, set by track_expiry
+        self.offline_timeout = 0
+
+        # heap of the times at which the online GPS devices expire, with at most one entry per GPS device
+        # an entry is not moved when its GPS device is reported again, but pushed back when it comes up,
+        # so that reports stay O(1) and each expiry check only looks at the entries that are due
+        # format is [(<expiry time>, <gps device id>)], or None if expiry is not tracked
+        self.expiry_heap = None
+
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __repr__(self):
+        return "<Fleet state with %r devices, %r colorum>" % (
+            len(self.devices),
+            len(self.colorum_index),
+        )
+
+    # add the GPS device records loaded from the db, without marking them for writing back
+    def load(self, device_records):
+        with self.lock:
+            for device_record in device_records:
+                self.devices[device_record.id] = device_record
+                self.update_colorum_index(device_record)
+
+    # replace the colorum vehicles with the ones loaded from the db, e.g. when another process owns the northbound stream
+    # GPS devices with changes that have not been written to the db yet keep their in-memory state
+    def refresh_colorum_vehicles(self, device_records):
+        with self.lock:
+            refreshed_device_ids = set()
+            for device_record in device_records:
+                refreshed_device_ids.add(device_record.id)
+
+                # keep the in-memory record of GPS devices that did not change, so that the colorum vehicles
+                # only count as changed when they actually did
+                current_device_record = self.devices.get(device_record.id)
+                if (
+                    current_device_record is not None
+                    and current_device_record.get_colorum_state()
+                    == device_record.get_colorum_state()
+                ):
+                    continue
+
+                if device_record.id not in self.dirty_device_ids:
+                    self.devices[device_record.id] = device_record
+                    self.update_colorum_index(device_record)
+
+            # GPS devices that are no longer colorum in the db
+            for gps_device_id in list(self.colorum_index.locations):
+                if (
+                    gps_device_id not in refreshed_device_ids
+                    and gps_device_id not in self.dirty_device_ids
+                ):
+                    device_record = self.devices[gps_device_id]
+                    device_record.is_colorum = False
+                    self.update_colorum_index(device_record)
+
+    # keep the colorum index in sync with a GPS device record
+    # offline GPS devices are left out of the colorum index, so that they are never sent back as colorum vehicles
+    def update_colorum_index(self, device_record):
+        old_location = self.colorum_index.locations.get(device_record.id)
+        if device_record.is_colorum and device_record.online:
+            new_location = (device_record.latitude, device_record.longitude)
+        else:
+            new_location = None
+
+        if old_location is None and new_location is None:
+            return
+
+        # any change of a colorum vehicle (e.g. of its distance to its route) makes the responses cached for it stale
+        self.colorum_generation += 1
+
+        if new_location == old_location:
+            return
+
+        if (
+            self.colorum_changes is not None
+            and device_record.id not in self.colorum_changes
+        ):
+            self.colorum_changes[device_record.id] = old_location
+
+        if new_location is None:
+            self.colorum_index.remove(device_record.id)
+        else:
+            self.colorum_index.insert(device_record.id, *new_location)
+
+    # get the last full classifications of GPS devices
+    # returns {<gps device id>: (<latitude>, <longitude>, <compiled route>, <distance to route>)}
+    # for the GPS devices that have been classified with a full geometry query
+    def get_last_classifications(self, gps_device_ids):
+        last_classifications = {}
+        with self.lock:
+            for gps_device_id in gps_device_ids:
+                device_record = self.devices.get(gps_device_id)
+                if (
+                    device_record is not None
+                    and device_record.classified_route is not None
+                ):
+                    last_classifications[gps_device_id] = (
+                        device_record.classified_latitude,
+                        device_record.classified_longitude,
+                        device_record.classified_route,
+                        device_record.distance_to_route,
+                    )
+
+        return last_classifications
+
+    # apply a GPS device report coming from the northbound ingest path
+    # classification is (<within route>, <distance to route>), or None if the GPS device could not be classified,
+    # in which case the GPS device keeps its last distance and colorum status
+    # classified_route is the compiled route if the classification came from a full geometry query,
+    # or None if the classification was carried over from the last full classification
+    def update_device(
+        self,
+        gps_device_id,
+        last_location,
+        associated_route,
+        classification,
+        classified_route=None,
+    ):
+        with self.lock:
+            device_record = self.devices.get(gps_device_id)
+            if device_record is None:
+                device_record = DeviceRecord(
+                    gps_device_id, last_location[0], last_location[1], associated_route
+                )
+                self.devices[gps_device_id] = device_record
+            else:
+                device_record.online = True
+                device_record.latitude = last_location[0]
+                device_record.longitude = last_location[1]
+                device_record.associated_route = associated_route
+
+            device_record.last_seen = time()
+            self.schedule_expiry(device_record)
+
+            if classification is not None:
+                within_route, device_record.distance_to_route = classification
+
+                # if a gps device is not within its associated route
+                # (i.e. it is farther from the route than the set maximum distance),
+                # set is_colorum of the gps device to true. otherwise, set it to false
+                device_record.is_colorum = not within_route
+
+            if classified_route is not None:
+                device_record.classified_latitude = last_location[0]
+                device_record.classified_longitude = last_location[1]
+                device_record.classified_route = classified_route
+
+            self.update_colorum_index(device_record)
+            self.dirty_device_ids.add(gps_device_id)
+
+    # get the gps_positions rows of the last reports of GPS devices, e.g. right after they were updated
+    def get_position_rows(self, gps_device_ids):
+        with self.lock:
+            return [
+                self.devices[gps_device_id].to_position_row()
+                for gps_device_id in gps_device_ids
+            ]
+
+    # get the colorum vehicles whose last locations are inside the box that contains the search area
+    # formed by a GPS point and a search distance in kilometers
+    # these are only candidates: the caller still has to check the exact distance of each of them
+    def search_colorum_vehicles(self, latitude, longitude, search_distance):
+        with self.lock:
+            return [
+                self.devices[gps_device_id].to_colorum_vehicle()
+                for gps_device_id in self.colorum_index.search(
+                    latitude, longitude, search_distance
+                )
+            ]
+
+    # start tracking the changes of the colorum vehicles, e.g. to push them to the enforcer apps
+    def track_colorum_changes(self):
+        with self.lock:
+            if self.colorum_changes is None:
+                self.colorum_changes = {}
+
+    # get the colorum vehicles that became colorum, moved or were cleared since the last call, and start over
+    # returns [(<gps device id>, <old location or None>, <new location or None>, <colorum vehicle or None>)]
+    # where the locations are (<latitude>, <longitude>) in the colorum index, and None if the GPS device was not colorum
+    def take_colorum_changes(self):
+        colorum_changes = []
+        with self.lock:
+            if not self.colorum_changes:
+                return colorum_changes
+
+            for gps_device_id, old_location in self.colorum_changes.items():
+                new_location = self.colorum_index.locations.get(gps_device_id)
+                if new_location == old_location:
+                    continue
+
+                if new_location is None:
+                    colorum_vehicle = None
+                else:
+                    colorum_vehicle = self.devices[gps_device_id].to_colorum_vehicle()
+
+                colorum_changes.append(
+                    (gps_device_id, old_location, new_location, colorum_vehicle)
+                )
+            self.colorum_changes = {}
+
+        return colorum_changes
+
+    # get the gps_devices rows of the GPS devices that changed since the last flush, and stop tracking them
+    def take_dirty_rows(self):
+        with self.lock:
+            dirty_rows = [
+                self.devices[gps_device_id].to_row()
+                for gps_device_id in self.dirty_device_ids
+            ]
+            self.dirty_device_ids = set()
+
+        return dirty_rows
+
+    # start tracking when the online GPS devices go silent, e.g. in the ingest process
+    # GPS devices go offline offline_timeout seconds after they were last reported (see expire_devices)
+    def track_expiry(self, offline_timeout):
+        with self.lock:
+            if self.expiry_heap is not None:
+                return
+
+            self.offline_timeout = offline_timeout
+            self.expiry_heap = []
+            for device_record in self.devices.values():
+                self.schedule_expiry(device_record)
+
+    # add an entry for an online GPS device to the expiry heap, unless it already has one
+    def schedule_expiry(self, device_record):
+        if (
+            self.expiry_heap is None
+            or device_record.expiry_scheduled
+            or not device_record.online
+        ):
+            return
+
+        last_seen = device_record.last_seen
+        if last_seen is None:
+            last_seen = time()
+
+        heapq.heappush(
+            self.expiry_heap, (last_seen + self.offline_timeout, device_record.id)
+        )
+        device_record.expiry_scheduled = True
+
+    # mark the GPS devices that have not been reported for offline_timeout seconds as of now (a unix time) as offline,
+    # and get their IDs
+    def expire_devices(self, now):
+        offline_device_ids = []
+        with self.lock:
+            if self.expiry_heap is None:
+                return offline_device_ids
+
+            while self.expiry_heap and self.expiry_heap[0][0] <= now:
+                gps_device_id = heapq.heappop(self.expiry_heap)[1]
+                device_record = self.devices[gps_device_id]
+                device_record.expiry_scheduled = False
+
+                # the GPS device was reported since its entry was pushed, so it expires later
+                if (
+                    device_record.last_seen is not None
+                    and device_record.last_seen + self.offline_timeout > now
+                ):
+                    self.schedule_expiry(device_record)
+                    continue
+
+                device_record.online = False
+                self.update_colorum_index(device_record)
+                offline_device_ids.append(gps_device_id)
+
+        return offline_device_ids
+
+    # track GPS devices as changed again, e.g. if writing them to the db failed
+    def mark_dirty(self, gps_device_ids):
+        with self.lock:
+            self.dirty_device_ids.update(gps_device_ids)
+
+
+# get the fleet state, loading it from the db if it has not been loaded yet
+def get_fleet_state():
+    global fleet_state
+
+    if fleet_state is None:
+        if load_colorum_vehicles_only:
+            gps_device_query = query_colorum_vehicles()
+        else:
+            gps_device_query = GPSDevice.query
+
+        state = FleetState(current_app.config["COLORUM_GRID_CELL_SIZE"])
+        state.load(load_device_records(gps_device_query))
+        fleet_state = state
+
+    return fleet_state
+
+
+# get the query of the gps_devices rows of the online colorum vehicles
+def query_colorum_vehicles():
+    return GPSDevice.query.filter_by(is_colorum=True, online=True)
+
+
+# get the GPS device records of the gps_devices rows returned by a query
+def load_device_records(gps_device_query):
+    return [
+        DeviceRecord(
+            gps_device.id,
+            gps_device.last_location[0],
+            gps_device.last_location[1],
+            gps_device.associated_route,
+            online=gps_device.online,
+            distance_to_route=gps_device.distance_to_route or 0,
+            is_colorum=gps_device.is_colorum,
+            last_seen=(
+                (gps_device.last_seen - UNIX_EPOCH).total_seconds()
+                if gps_device.last_seen is not None
+                else None
+            ),
+        )
+        for gps_device in gps_device_query
+        if gps_device.last_location
+    ]
+
+
+# insert or update GPS devices in the db using INSERT ... ON CONFLICT (id) DO UPDATE statements
+# gps_device_rows is a list of dicts with all of the gps_devices columns
+def upsert_gps_devices(gps_device_rows):
+    insert = UPSERT_INSERTS[db.engine.dialect.name]
+
+    for batch_start in range(0, len(gps_device_rows), UPSERT_BATCH_SIZE):
+        insert_statement = insert(GPSDevice.__table__).values(
+            gps_device_rows[batch_start : batch_start + UPSERT_BATCH_SIZE]
+        )
+        db.session.execute(
+            insert_statement.on_conflict_do_update(
+                index_elements=[GPSDevice.__table__.c.id],
+                set_={
+                    column: insert_statement.excluded[column]
+                    for column in UPSERT_COLUMNS
+                },
+            )
+        )
+
+
+# write the GPS devices that changed since the last flush to the db in one transaction
+def flush_fleet_state():
+    if fleet_state is None:
+        return
+
+    dirty_rows = fleet_state.take_dirty_rows()
+    if not dirty_rows:
+        return
+
+    try:
+        with metrics.time_stage("db_flush"):
+            upsert_gps_devices(dirty_rows)
+            db.session.commit()
+    except Exception:
+        # keep the GPS devices so that they are written on the next flush
+        db.session.rollback()
+        fleet_state.mark_dirty(gps_device_row["id"] for gps_device_row in dirty_rows)
+        raise
+
+
+# set the GPS devices that went offline as offline in the db, in one UPDATE statement per UPSERT_BATCH_SIZE GPS devices
+# GPS devices that were reported again since cutoff (a naive UTC datetime) are left online,
+# since their newer report may have been written by the write-behind before this
+def mark_gps_devices_offline(gps_device_ids, cutoff):
+    gps_devices = GPSDevice.__table__
+    for batch_start in range(0, len(gps_device_ids), UPSERT_BATCH_SIZE):
+        db.session.execute(
+            gps_devices.update()
+            .where(
+                gps_devices.c.id.in_(
+                    gps_device_ids[batch_start : batch_start + UPSERT_BATCH_SIZE]
+                )
+            )
+            .where(
+                or_(gps_devices.c.last_seen < cutoff, gps_devices.c.last_seen.is_(None))
+            )
+            .values(online=False)
+        )
+
+
+# mark the GPS devices that have not been reported for OFFLINE_TIMEOUT seconds as offline, in memory and in the db
+def expire_offline_devices():
+    if fleet_state is None:
+        return
+
+    now = time()
+    offline_device_ids = fleet_state.expire_devices(now)
+    if not offline_device_ids:
+        return
+
+    try:
+        with metrics.time_stage("offline_expiry"):
+            mark_gps_devices_offline(
+                offline_device_ids,
+                datetime.utcfromtimestamp(now - fleet_state.offline_timeout),
+            )
+            db.session.commit()
+    except Exception:
+        # let the write-behind write the GPS devices as offline instead
+        db.session.rollback()
+        fleet_state.mark_dirty(offline_device_ids)
+        raise
+    finally:
+        metrics.count_offline_devices(len(offline_device_ids))
+
+    logging.info("%d GPS devices went offline", len(offline_device_ids))
+
+
+# periodically write the fleet state to the db in the background
+def start_write_behind(app):
+    def write_behind():
+        while True:
+            sleep(app.config["FLEET_STATE_FLUSH_INTERVAL"])
+            with app.app_context():
+                try:
+                    flush_fleet_state()
+                except Exception as error:
+                    logging.error(str(error))
+
+    write_behind_thread = threading.Thread(target=write_behind, daemon=True)
+    write_behind_thread.start()
+
+    return write_behind_thread
+
+
+# periodically load the colorum vehicles from the db in the background
+# this keeps the fleet state of web workers in sync with the fleet state written by the ingest process
+def start_refresh(app):
+    def refresh():
+        while True:
+            sleep(app.config["FLEET_STATE_REFRESH_INTERVAL"])
+            with app.app_context():
+                try:
+                    with metrics.time_stage("db_refresh"):
+                        get_fleet_state().refresh_colorum_vehicles(
+                            load_device_records(query_colorum_vehicles())
+                        )
+                except Exception as error:
+                    logging.error(str(error))
+
+    refresh_thread = threading.Thread(target=refresh, daemon=True)
+    refresh_thread.start()
+
+    return refresh_thread
+
+
+# periodically mark the GPS devices that went silent as offline in the background, in the ingest process
+# only the GPS devices that are due are checked, so each check does not scan the whole fleet
+def start_offline_detection(app):
+    def detect_offline():
+        while True:
+            sleep(app.config["OFFLINE_CHECK_INTERVAL"])
+            with app.app_context():
+                try:
+                    get_fleet_state().track_expiry(app.config["OFFLINE_TIMEOUT"])
+                    expire_offline_devices()
+                except Exception as error:
+                    logging.error(str(error))
+
+    offline_detection_thread = threading.Thread(target=detect_offline, daemon=True)
+    offline_detection_thread.start()
+
+    return offline_detection_thread
@@ -0,0 +1,144 @@
+from . import northbound_handler, metrics, query_profiler
+
+from collections import OrderedDict
+from time import perf_counter
+
+import threading
+import logging
+
+# queue between the northbound socketio event handlers and the classification and persistence of GPS devices
+# it is created by start_ingest_worker
+ingest_queue = None
+
+
+# bounded queue of pending GPS device reports
+# pending reports of the same GPS device are coalesced down to the newest one,
+# and the oldest pending reports are dropped when the queue is full, so that the newest positions always win
+class IngestQueue:
+    def __init__(self, max_size, batch_size):
+        # maximum number of pending GPS devices
+        self.max_size = max_size
+
+        # maximum number of GPS devices taken from the queue at once
+        self.batch_size = batch_size
+
+        # newest pending report of each GPS device and the time it was received, oldest first
+        # format is {<gps device id>: (<time received>, <gps device report>)}
+        self.pending = OrderedDict()
+
+        self.condition = threading.Condition()
+
+        # counters of GPS device reports
+        self.received_count = 0
+        self.coalesced_count = 0
+        self.dropped_count = 0
+        self.processed_count = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __repr__(self):
+        return "<Ingest queue with %r pending GPS devices>" % len(self.pending)
+
+    # add the GPS device reports of a list_of_gps_devices payload to the queue
+    def put_gps_devices(self, gps_devices):
+        received_time = perf_counter()
+        with self.condition:
+            for gps_device in gps_devices:
+                gps_device_id = gps_device["gps_device_id"]
+                self.received_count += 1
+
+                if gps_device_id in self.pending:
+                    # replace the pending report of the GPS device with the newer one,
+                    # keeping its place in the queue so that it is not starved by other GPS devices
+                    self.coalesced_count += 1
+                elif len(self.pending) >= self.max_size:
+                    # drop the oldest pending report to make room for the newer one
+                    self.pending.popitem(last=False)
+                    self.dropped_count += 1
+
+                self.pending[gps_device_id] = (received_time, gps_device)
+
+            self.condition.notify()
+
+    # take up to batch_size of the oldest pending GPS device reports from the queue
+    # waits up to timeout seconds for reports if the queue is empty
+    def take_batch(self, timeout=None):
+        with self.condition:
+            if not self.pending:
+                self.condition.wait(timeout)
+
+            batch = []
+            oldest_received_time = None
+            while self.pending and len(batch) < self.batch_size:
+                received_time, gps_device = self.pending.popitem(last=False)[1]
+                batch.append(gps_device)
+                if oldest_received_time is None or received_time < oldest_received_time:
+                    oldest_received_time = received_time
+
+        # the lag of the northbound stream is how long the oldest report of the batch waited in the queue
+        if batch:
+            metrics.observe_northbound_lag(perf_counter() - oldest_received_time)
+
+        return batch
+
+    # count the GPS device reports of a batch as processed
+    def mark_processed(self, batch):
+        with self.condition:
+            self.processed_count += len(batch)
+
+    # get the depth and counters of the queue
+    def get_stats(self):
+        with self.condition:
+            return {
+                "depth": len(self.pending),
+                "max_size": self.max_size,
+                "received": self.received_count,
+                "coalesced": self.coalesced_count,
+                "dropped": self.dropped_count,
+                "processed": self.processed_count,
+            }
+
+
+# create the ingest queue and start the worker that drains it in batches in the background
+def start_ingest_worker(app):
+    global ingest_queue
+
+    ingest_queue = IngestQueue(
+        app.config["INGEST_QUEUE_MAX_SIZE"], app.config["INGEST_BATCH_SIZE"]
+    )
+
+    # expose the depth and counters of the queue with the other metrics
+    metrics.register_callback(
+        "colorum_ingest_queue_depth",
+        "Number of GPS device reports waiting in the ingest queue",
+        lambda: len(ingest_queue),
+    )
+    for counter_name in ("received", "coalesced", "dropped", "processed"):
+        metrics.register_callback(
+            "colorum_ingest_%s_total" % counter_name,
+            "Number of GPS device reports %s by the ingest queue" % counter_name,
+            lambda counter_name=counter_name: getattr(
+                ingest_queue, "%s_count" % counter_name
+            ),
+            metric_type="counter",
+        )
+
+    def ingest_worker():
+        while True:
+            batch = ingest_queue.take_batch(timeout=1)
+            if not batch:
+                continue
+
+            with app.app_context(), query_profiler.profile_event("ingest_batch"):
+                try:
+                    northbound_handler.process_gps_devices(batch)
+                except Exception as error:
+                    logging.error(str(error))
+
+            ingest_queue.mark_processed(batch)
+
+    ingest_worker_thread = threading.Thread(target=ingest_worker, daemon=True)
+    ingest_worker_thread.start()
+
+    return ingest_worker_thread
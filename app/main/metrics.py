@@ -0,0 +1,474 @@
+from . import main_blueprint
+
+from flask import g, request, Response, current_app
+from time import perf_counter
+
+import threading
+import hmac
+import bisect
+import math
+
+# whether metrics are recorded, set by configure_metrics
+# when metrics are disabled, recording a metric returns right away, so that instrumented code paths stay as fast as before
+metrics_enabled = False
+
+# upper bounds of the histogram buckets of durations in seconds, of numbers of GPS devices, and of numbers of db queries
+DURATION_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+DEVICE_COUNT_BUCKETS = (1, 10, 50, 100, 500, 1000, 5000, 10000, 50000)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+# histogram of observed values, in the Prometheus text format
+# each set of label values (e.g. each stage) gets its own bucket counts, sum and count
+class Histogram:
+    def __init__(self, name, description, buckets, label_names=()):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.label_names = label_names
+
+        # format is {(<label value>, ...): [<bucket counts>, <sum>, <count>]}
+        self.values = {}
+
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Histogram %r>" % self.name
+
+    def observe(self, value, label_values=()):
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            values = self.values.get(label_values)
+            if values is None:
+                values = self.values[label_values] = [[0] * len(self.buckets), 0, 0]
+
+            if bucket < len(self.buckets):
+                values[0][bucket] += 1
+            values[1] += value
+            values[2] += 1
+
+    # get the lines of the histogram in the Prometheus text format
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.description),
+            "# TYPE %s histogram" % self.name,
+        ]
+        with self.lock:
+            for label_values, (bucket_counts, value_sum, value_count) in sorted(
+                self.values.items()
+            ):
+                labels = format_labels(self.label_names, label_values)
+                cumulative_count = 0
+                for upper_bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative_count += bucket_count
+                    lines.append(
+                        "%s_bucket{%s} %d"
+                        % (
+                            self.name,
+                            ",".join(labels + ['le="%s"' % format_number(upper_bound)]),
+                            cumulative_count,
+                        )
+                    )
+                lines.append(
+                    "%s_bucket{%s} %d"
+                    % (self.name, ",".join(labels + ['le="+Inf"']), value_count)
+                )
+                lines.append(
+                    "%s_sum%s %s"
+                    % (self.name, wrap_labels(labels), format_number(value_sum))
+                )
+                lines.append(
+                    "%s_count%s %d" % (self.name, wrap_labels(labels), value_count)
+                )
+
+        return lines
+
+
+# counter of events, in the Prometheus text format
+class Counter:
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+
+        # format is {(<label value>, ...): <count>}
+        self.values = {}
+
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Counter %r>" % self.name
+
+    def increment(self, amount=1, label_values=()):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    # get the lines of the counter in the Prometheus text format
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.description),
+            "# TYPE %s counter" % self.name,
+        ]
+        with self.lock:
+            for label_values, count in sorted(self.values.items()):
+                lines.append(
+                    "%s%s %s"
+                    % (
+                        self.name,
+                        wrap_labels(format_labels(self.label_names, label_values)),
+                        format_number(count),
+                    )
+                )
+
+        return lines
+
+
+# metric whose value is read from a function when the metrics are scraped, in the Prometheus text format
+# e.g. to expose counters that are already kept elsewhere (metric_type "counter") or the size of a queue (metric_type "gauge")
+# the function returns a number, or None if the metric has no value in this process
+class CallbackMetric:
+    def __init__(self, name, description, get_value, metric_type="gauge"):
+        self.name = name
+        self.description = description
+        self.get_value = get_value
+        self.metric_type = metric_type
+
+    def __repr__(self):
+        return "<Callback metric %r>" % self.name
+
+    # get the lines of the metric in the Prometheus text format
+    def render(self):
+        value = self.get_value()
+        if value is None:
+            return []
+
+        return [
+            "# HELP %s %s" % (self.name, self.description),
+            "# TYPE %s %s" % (self.name, self.metric_type),
+            "%s %s" % (self.name, format_number(value)),
+        ]
+
+
+# get the label pairs of a metric, e.g. ['stage="projection"']
+def format_labels(label_names, label_values):
+    return [
+        '%s="%s"'
+        % (label_name, str(label_value).replace("\\", "\\\\").replace('"', '\\"'))
+        for label_name, label_value in zip(label_names, label_values)
+    ]
+
+
+# get the label set of a metric from its label pairs, e.g. '{stage="projection"}', or nothing if it has no labels
+def wrap_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(labels)
+
+
+# format a number the way Prometheus expects it
+def format_number(number):
+    if isinstance(number, float) and math.isinf(number):
+        return "+Inf" if number > 0 else "-Inf"
+    return repr(number)
+
+
+# all of the metrics of this process, in the order they are rendered
+# format is {<metric name>: <metric>}
+registry = {}
+
+
+def register(metric):
+    registry[metric.name] = metric
+    return metric
+
+
+# duration of each stage of the hot paths (e.g. projection, distance computation, db writes)
+stage_durations = register(
+    Histogram(
+        "colorum_stage_duration_seconds",
+        "Duration of each stage of ingesting GPS devices and serving colorum vehicles",
+        DURATION_BUCKETS,
+        ("stage",),
+    )
+)
+
+# duration of each HTTP request, by endpoint
+request_durations = register(
+    Histogram(
+        "colorum_request_duration_seconds",
+        "Duration of HTTP requests",
+        DURATION_BUCKETS,
+        ("endpoint",),
+    )
+)
+
+# number of db queries of each HTTP request, by endpoint
+request_queries = register(
+    Histogram(
+        "colorum_request_db_queries",
+        "Number of db queries of HTTP requests",
+        QUERY_COUNT_BUCKETS,
+        ("endpoint",),
+    )
+)
+
+# time spent waiting on the db by each HTTP request, by endpoint
+request_db_durations = register(
+    Histogram(
+        "colorum_request_db_duration_seconds",
+        "Time HTTP requests spent waiting on the db",
+        DURATION_BUCKETS,
+        ("endpoint",),
+    )
+)
+
+# number of db queries of each northbound socketio event or ingest batch, by event
+event_queries = register(
+    Histogram(
+        "colorum_event_db_queries",
+        "Number of db queries of northbound socketio events and ingest batches",
+        QUERY_COUNT_BUCKETS,
+        ("event",),
+    )
+)
+
+# time spent waiting on the db by each northbound socketio event or ingest batch, by event
+event_db_durations = register(
+    Histogram(
+        "colorum_event_db_duration_seconds",
+        "Time northbound socketio events and ingest batches spent waiting on the db",
+        DURATION_BUCKETS,
+        ("event",),
+    )
+)
+
+# number of GPS devices marked as offline after going silent
+offline_devices = register(
+    Counter(
+        "colorum_devices_offline_total",
+        "Number of GPS devices marked as offline after not being reported for the offline timeout",
+    )
+)
+
+# number of colorum vehicle queries answered from the response cache (hit), computed and cached (miss),
+# answered with 304 Not Modified (not_modified) or not cacheable (uncacheable), and number of cached responses evicted (eviction)
+response_cache_lookups = register(
+    Counter(
+        "colorum_response_cache_total",
+        "Number of colorum vehicle response cache lookups and evictions, by result",
+        ("result",),
+    )
+)
+
+# time CPU-bound calls waited for a thread of the offload pool, by kind of call
+offload_queue_durations = register(
+    Histogram(
+        "colorum_offload_queue_seconds",
+        "Time CPU-bound calls waited for a thread of the offload pool",
+        DURATION_BUCKETS,
+        ("kind",),
+    )
+)
+
+# duration of CPU-bound calls in the offload pool, by kind of call
+offload_durations = register(
+    Histogram(
+        "colorum_offload_duration_seconds",
+        "Duration of CPU-bound calls in the offload pool",
+        DURATION_BUCKETS,
+        ("kind",),
+    )
+)
+
+# number of GPS devices in each list_of_gps_devices payload or ingest batch
+payload_devices = register(
+    Histogram(
+        "colorum_payload_devices",
+        "Number of GPS devices in each list_of_gps_devices payload or ingest batch",
+        DEVICE_COUNT_BUCKETS,
+    )
+)
+
+# time between receiving a GPS device report from the northbound stream and processing it
+northbound_lag = register(
+    Histogram(
+        "colorum_northbound_lag_seconds",
+        "Time GPS device reports from the northbound stream wait before they are processed",
+        DURATION_BUCKETS,
+    )
+)
+
+# number of GPS devices classified, by kind of classification (full or skipped)
+classifications = register(
+    Counter(
+        "colorum_classifications_total",
+        "Number of GPS device classifications, by kind",
+        ("kind",),
+    )
+)
+
+
+# context manager that does nothing, returned by time_stage when metrics are disabled
+class NoOpTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NO_OP_TIMER = NoOpTimer()
+
+
+# context manager that records its duration in a histogram
+class StageTimer:
+    __slots__ = ("histogram", "label_values", "start_time")
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start_time = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(perf_counter() - self.start_time, self.label_values)
+        return False
+
+
+# time a stage of a hot path, e.g. with time_stage("projection"): ...
+def time_stage(stage):
+    if not metrics_enabled:
+        return NO_OP_TIMER
+
+    return StageTimer(stage_durations, (stage,))
+
+
+# record the number of GPS devices of a payload or ingest batch
+def observe_payload(device_count):
+    if metrics_enabled:
+        payload_devices.observe(device_count)
+
+
+# record how long GPS device reports from the northbound stream waited before they were processed
+def observe_northbound_lag(seconds):
+    if metrics_enabled:
+        northbound_lag.observe(seconds)
+
+
+# count GPS device classifications of a kind (full or skipped)
+def count_classifications(kind, count):
+    if metrics_enabled and count:
+        classifications.increment(count, (kind,))
+
+
+def count_offline_devices(count):
+    if metrics_enabled:
+        offline_devices.increment(count)
+
+
+# count a colorum vehicle response cache lookup or eviction
+def count_response_cache(result):
+    if metrics_enabled:
+        response_cache_lookups.increment(1, (result,))
+
+
+# record how long a CPU-bound call waited for a thread of the offload pool, and how long it ran there
+def observe_offload(kind, queue_time, run_time):
+    if metrics_enabled:
+        offload_queue_durations.observe(queue_time, (kind,))
+        offload_durations.observe(run_time, (kind,))
+
+
+# add a metric whose value is read from a function when the metrics are scraped
+def register_callback(name, description, get_value, metric_type="gauge"):
+    return register(CallbackMetric(name, description, get_value, metric_type))
+
+
+# get all of the metrics of this process in the Prometheus text format
+def render_metrics():
+    lines = []
+    for metric in list(registry.values()):
+        lines.extend(metric.render())
+
+    return "\n".join(lines) + "\n"
+
+
+def start_request_timer():
+    g.request_start_time = perf_counter()
+
+
+def observe_request(response):
+    if "request_start_time" in g:
+        request_durations.observe(
+            perf_counter() - g.request_start_time, (request.endpoint or "unknown",)
+        )
+
+    return response
+
+
+# record the db queries of an HTTP request, counted by the query profiler
+def observe_request_queries(endpoint, query_count, db_time):
+    if metrics_enabled:
+        request_queries.observe(query_count, (endpoint,))
+        request_db_durations.observe(db_time, (endpoint,))
+
+
+# record the db queries of a northbound socketio event or ingest batch, counted by the query profiler
+def observe_event_queries(event_name, query_count, db_time):
+    if metrics_enabled:
+        event_queries.observe(query_count, (event_name,))
+        event_db_durations.observe(db_time, (event_name,))
+
+
+# enable metrics if METRICS_ENABLED is set, and hook the request timers into the app
+# the db queries are counted by the query profiler
+def configure_metrics(app):
+    global metrics_enabled
+
+    metrics_enabled = app.config["METRICS_ENABLED"]
+    if not metrics_enabled:
+        return
+
+    app.before_request(start_request_timer)
+    app.after_request(observe_request)
+
+
+# expose the metrics of this process in the Prometheus text format
+# each process (e.g. each gunicorn worker, and the ingest process) has its own metrics, so a scrape only gets
+# the metrics of the process that answered it
+# without METRICS_TOKEN, only the ingest process answers, on its own HTTP server (see INGEST_HTTP_PORT),
+# and with it, every process answers the requests that send it as their bearer token
+@main_blueprint.route("/metrics", methods=["GET"])
+def handle_metrics():
+    from . import ingest_queue
+
+    if not metrics_enabled:
+        return "metrics are disabled", 404
+
+    metrics_token = current_app.config["METRICS_TOKEN"]
+    if metrics_token:
+        if not hmac.compare_digest(
+            request.headers.get("Authorization", ""), "Bearer %s" % metrics_token
+        ):
+            return "invalid metrics token", 401
+    elif ingest_queue.ingest_queue is None:
+        return "metrics are only served by the ingest process", 404
+
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
@@ -1,111 +1,271 @@
-from . import main_blueprint, calculation_functions
-from app.models import GPSDevice, Route
-from app import db
+from . import (
+    main_blueprint,
+    calculation_functions,
+    route_cache,
+    route_list,
+    fleet_state,
+    position_history,
+    metrics,
+    offload,
+)
+from app.models import Route
+from app import db, NORTHBOUND_ROUTES_RECEIVED_CHANNEL
 
 from flask import request, current_app
-from datetime import datetime
-from json import loads, dumps
+from sqlalchemy import text
+from requests import Session
 
+import numpy as np
 import logging
-import os
 
+# number of GPS device reports classified with a full geometry query,
+# and number of GPS device reports whose classification was carried over from their last full classification
+classification_stats = {"full": 0, "skipped": 0}
 
+# HTTP session used by web workers to forward GPS devices to the ingest process, reusing its TCP connections
+ingest_session = Session()
+
+
+# event handler for when the northbound platform sends over GPS device data
+# only the ingest process classifies and writes GPS devices, so web workers forward them to it
 @main_blueprint.route("/list_of_gps_devices", methods=["POST"])
 def handle_gps_data_from_northbound():
-    data = request.get_json()
-
-    for gps_device in data:
-        # for each GPS device coming from the data stream, determine whether it is within the route it is associated with
-        # and also get the distance from the GPS device to its associated route
-
-        associated_route = gps_device["associated_route"]
-        gps_device_id = gps_device["gps_device_id"]
-        last_location = gps_device["last_location"]
-
-        # check if GPS device already exists in the db
-        current_gps_device = GPSDevice.query.filter_by(id=gps_device_id).first()
-        if current_gps_device is None:
-            # if GPS device does not exist, add it to the database
-            current_gps_device = GPSDevice(
-                gps_device_id, last_location, associated_route
-            )
-            db.session.add(current_gps_device)
-            db.session.commit()
-        else:
-            # if GPS device already exists, update its last location and associated route
-            current_gps_device.online = True
-            current_gps_device.associated_route = associated_route
-            current_gps_device.last_location = last_location
-
-            db.session.commit()
-
-        # check if the route associated with the gps device
-        # has a corresponding .gpx file
-        db_route = Route.query.filter_by(id=associated_route).first()
-        if db_route is not None and db_route.gpx_filename is not None:
+    from . import ingest_queue
+
+    if ingest_queue.ingest_queue is None:
+        return forward_gps_devices_to_ingest()
+
+    ingest_queue.ingest_queue.put_gps_devices(request.get_json())
+
+    return "OK"
+
+
+# forward a list_of_gps_devices request to this endpoint on the HTTP server of the ingest process
+def forward_gps_devices_to_ingest():
+    if not current_app.config["INGEST_HTTP_PORT"]:
+        current_app.logger.error("GPS devices sent to a process that does not own ingest")
+        return "GPS devices are only ingested by the ingest process", 409
+
+    ingest_url = "http://%s:%s/list_of_gps_devices" % (
+        current_app.config["INGEST_HTTP_HOST"],
+        current_app.config["INGEST_HTTP_PORT"],
+    )
+    try:
+        ingest_response = ingest_session.post(
+            ingest_url,
+            data=request.get_data(),
+            headers={"Content-Type": "application/json"},
+            timeout=current_app.config["INGEST_HTTP_TIMEOUT"],
+        )
+    except Exception as error:
+        current_app.logger.error(str(error))
+        return "the ingest process is not available", 503
+
+    return ingest_response.text, ingest_response.status_code
+
+
+# classify the GPS devices of a list_of_gps_devices payload and update the fleet state with them
+# this is called by the ingest worker with the batches of the ingest queue, and by the northbound socketio event handlers
+def process_gps_devices(data):
+    # only the latest entry of each GPS device in the payload is kept
+    data = list(
+        {gps_device["gps_device_id"]: gps_device for gps_device in data}.values()
+    )
+    metrics.observe_payload(len(data))
+
+    # get all routes in the payload that have a corresponding .gpx file with a single query
+    with metrics.time_stage("route_lookup"):
+        route_ids = list(calculation_functions.group_gps_devices_by_route(data))
+        db_routes = Route.query.filter(
+            Route.id.in_(route_ids), Route.gpx_filename.isnot(None)
+        ).all()
+
+    # get the compiled route of each of these routes
+    # the .gpx file is only parsed and projected when the route is not cached yet or when it has changed
+    compiled_routes = {}
+    with metrics.time_stage("route_cache"):
+        for db_route in db_routes:
             try:
-                # open the .gpx file and convert it to a route list using convert_gpx_file_to_list
-                gpx_file = open(
-                    os.path.join(
-                        current_app.config["UPLOAD_FOLDER"], db_route.gpx_filename
-                    ),
-                    "r",
+                compiled_routes[db_route.id] = route_cache.get_compiled_route(
+                    db_route.id, db_route.gpx_filename
+                )
+            except Exception as error:
+                logging.error(str(error))
+
+    current_fleet_state = fleet_state.get_fleet_state()
+
+    # GPS devices that have barely moved along the same compiled route since they were last classified
+    # keep their classification if the triangle inequality shows that it cannot have changed
+    # format is {<index of the GPS device in the payload>: (<within route>, <distance to route>)}
+    with metrics.time_stage("incremental_check"):
+        carried_over_classifications = find_unchanged_classifications(
+            data, compiled_routes, current_fleet_state
+        )
+    gps_devices_to_classify = [
+        index for index in range(len(data)) if index not in carried_over_classifications
+    ]
+
+    # for each remaining GPS device coming from the data stream, determine whether it is within the route it is associated with
+    # and also get the distance from the GPS device to its associated route
+    # all GPS devices associated with the same route are classified in a single vectorized pass
+    # the GPS devices of a route that fails to be classified keep their last distance and colorum status
+    # format is {<index of the GPS device in the payload>: (<within route>, <distance to route>)}
+    device_classifications = {}
+    try:
+        # large payloads are classified in the offload pool, so that they do not stall the other requests of this worker
+        with metrics.time_stage("classification"):
+            if len(gps_devices_to_classify) >= current_app.config["OFFLOAD_MIN_POINTS"]:
+                classifications = offload.run_offloaded(
+                    "classification",
+                    calculation_functions.classify_gps_devices,
+                    [data[index] for index in gps_devices_to_classify],
+                    compiled_routes,
+                )
+            else:
+                classifications = calculation_functions.classify_gps_devices(
+                    [data[index] for index in gps_devices_to_classify],
+                    compiled_routes,
                 )
-                route_points = calculation_functions.convert_gpx_file_to_list(gpx_file)
-                gpx_file.close()
-
-                # use the point_is_within_route function to check if the gps device
-                # is within its associated route
-                (
-                    within_route,
-                    device_to_route_distance,
-                ) = calculation_functions.point_is_within_route(
-                    current_gps_device.last_location, route_points
+        for indices, within_route, distances in classifications.values():
+            for index, device_within_route, device_to_route_distance in zip(
+                indices, within_route, distances
+            ):
+                device_classifications[gps_devices_to_classify[index]] = (
+                    bool(device_within_route),
+                    float(device_to_route_distance),
                 )
+    except Exception as error:
+        logging.error(str(error))
 
-                # update the gps device to route distance
-                current_gps_device.distance_to_route = device_to_route_distance
+    classification_stats["full"] += len(device_classifications)
+    classification_stats["skipped"] += len(carried_over_classifications)
+    metrics.count_classifications("full", len(device_classifications))
+    metrics.count_classifications("skipped", len(carried_over_classifications))
 
-                if not within_route:
-                    # if a gps device is not within its associated route
-                    # (i.e. it is farther from the route than the set maximum distance),
-                    # set is_colorum of the gps device to true
-                    current_gps_device.is_colorum = True
-                else:
-                    # if a gps device is within its associated route
-                    # set is_colorum of the gps device to false
-                    current_gps_device.is_colorum = False
+    # update the in-memory fleet state with the payload
+    # GPS devices that were not classified (e.g. their route has no .gpx file) keep their last distance and colorum status
+    # the changes are written to the db in batches by the fleet state write-behind
+    with metrics.time_stage("fleet_update"):
+        for index, gps_device in enumerate(data):
+            if index in device_classifications:
+                current_fleet_state.update_device(
+                    gps_device["gps_device_id"],
+                    gps_device["last_location"],
+                    gps_device["associated_route"],
+                    device_classifications[index],
+                    classified_route=compiled_routes[gps_device["associated_route"]],
+                )
+            else:
+                current_fleet_state.update_device(
+                    gps_device["gps_device_id"],
+                    gps_device["last_location"],
+                    gps_device["associated_route"],
+                    carried_over_classifications.get(index),
+                )
 
-                db.session.commit()
-            except Exception as error:
-                logging.error(str(error))
+    # keep the history of the positions, which is written to the db in batches by the position history writer
+    if position_history.position_writer is not None:
+        position_history.position_writer.put_rows(
+            current_fleet_state.get_position_rows(
+                gps_device["gps_device_id"] for gps_device in data
+            )
+        )
 
-    return "OK"
+
+# find the GPS devices of a payload whose classification cannot have changed since they were last classified
+# a GPS device keeps its classification if it is still on the same compiled route, it has moved less than the set
+# movement epsilon, and its last distance plus or minus the distance it moved is still on the same side of the set maximum distance
+# returns {<index of the GPS device in the payload>: (<within route>, <last distance to route>)}
+def find_unchanged_classifications(data, compiled_routes, current_fleet_state):
+    last_classifications = current_fleet_state.get_last_classifications(
+        gps_device["gps_device_id"] for gps_device in data
+    )
+
+    # GPS devices whose last full classification was against their current compiled route
+    indices = []
+    last_points = []
+    current_points = []
+    last_distances = []
+    max_deviations = []
+    for index, gps_device in enumerate(data):
+        last_classification = last_classifications.get(gps_device["gps_device_id"])
+        compiled_route = compiled_routes.get(gps_device["associated_route"])
+
+        # skip GPS devices that were never classified or that were last classified against another compiled route
+        if last_classification is None or last_classification[2] is not compiled_route:
+            continue
+
+        indices.append(index)
+        last_points.append(last_classification[:2])
+        current_points.append(gps_device["last_location"][:2])
+        last_distances.append(last_classification[3])
+        max_deviations.append(
+            calculation_functions.get_max_distance_error(compiled_route)
+        )
+
+    if not indices:
+        return {}
+
+    max_distance = current_app.config["COLORUM_MAX_DISTANCE"]
+    last_points = np.asarray(last_points, dtype=np.float64)
+    current_points = np.asarray(current_points, dtype=np.float64)
+    last_distances = np.asarray(last_distances, dtype=np.float64)
+
+    movements = calculation_functions.approximate_distances(
+        last_points[:, 0], last_points[:, 1], current_points[:, 0], current_points[:, 1]
+    )
+    unchanged = calculation_functions.classification_is_unchanged(
+        last_distances,
+        movements,
+        max_distance,
+        current_app.config["CLASSIFICATION_MOVEMENT_EPSILON"],
+        max_deviations=np.asarray(max_deviations, dtype=np.float64),
+    )
+
+    return {
+        indices[position]: (
+            bool(last_distances[position] <= max_distance),
+            float(last_distances[position]),
+        )
+        for position in np.flatnonzero(unchanged)
+    }
 
 
 # event handler for when the northbound platform sends over route data
 @main_blueprint.route("/list_of_routes", methods=["POST"])
 def handle_get_routes_from_northbound():
-    data = request.get_json()
-
-    received_routes = [route["route_id"] for route in data]
-    for route_id in received_routes:
-        db_route = Route.query.filter_by(id=route_id).first()
-        if db_route is None:
-            new_route = Route(route_id)
-            db.session.add(new_route)
-            db.session.commit()
-
-    all_routes = Route.query.all()
-    routes_to_delete = []
-    for route in all_routes:
-        if route.id not in received_routes:
-            routes_to_delete.append(route)
-
-    for route in routes_to_delete:
-        db.session.delete(route)
-        db.session.flush()
+    process_routes(request.get_json())
+
+    return "OK"
+
 
+# add the routes of a list_of_routes payload to the db and delete the routes that are no longer available
+# this is called by the HTTP endpoint above and directly by the northbound socketio event handlers
+def process_routes(data):
+    received_routes = set(route["route_id"] for route in data)
+    existing_routes = set(route_id for (route_id,) in db.session.query(Route.id).all())
+
+    for route_id in received_routes - existing_routes:
+        db.session.add(Route(route_id))
+
+    routes_to_delete = existing_routes - received_routes
+    if routes_to_delete:
+        Route.query.filter(Route.id.in_(routes_to_delete)).delete(
+            synchronize_session=False
+        )
+
+    # /get_routes/?refresh=true requests of web workers may be waiting for the routes,
+    # which are notified once the transaction commits (only postgres has notifications, e.g. not the benchmark db)
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute(
+            text("SELECT pg_notify(:channel, '')"),
+            {"channel": NORTHBOUND_ROUTES_RECEIVED_CHANNEL},
+        )
     db.session.commit()
 
-    return "OK"
+    # remove the compiled geometries of the deleted routes from the route cache
+    for route_id in routes_to_delete:
+        route_cache.drop_route(route_id)
+
+    # the route list cache of this process is out of date
+    route_list.invalidate_route_list()
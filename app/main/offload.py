@@ -0,0 +1,82 @@
+from . import metrics
+
+from flask import current_app, has_app_context
+from time import perf_counter
+
+import threading
+import sys
+
+# semaphore that bounds the number of offloaded calls running at once,
+# and function that runs a call outside of the eventlet hub, both set up by get_offload_pool on first use
+# they are set up lazily because gunicorn monkey-patches threading with eventlet after this module may have been imported
+offload_semaphore = None
+offload_execute = None
+
+offload_pool_lock = threading.Lock()
+
+
+# check whether this process runs on eventlet green threads, e.g. in a gunicorn eventlet worker
+def is_eventlet_patched():
+    eventlet = sys.modules.get("eventlet")
+    return eventlet is not None and eventlet.patcher.is_monkey_patched("thread")
+
+
+def run_inline(function, *args, **kwargs):
+    return function(*args, **kwargs)
+
+
+# get the semaphore and the execute function of the offload pool
+# on eventlet, calls run in the OS threads of eventlet's tpool, so that the hub keeps serving the other requests
+# otherwise, calls run in the calling thread, which is already an OS thread
+def get_offload_pool():
+    global offload_semaphore, offload_execute
+
+    with offload_pool_lock:
+        if offload_execute is None:
+            max_workers = current_app.config["OFFLOAD_MAX_WORKERS"]
+            offload_semaphore = threading.BoundedSemaphore(max_workers)
+
+            if is_eventlet_patched():
+                from eventlet import tpool
+
+                tpool.set_num_threads(max_workers)
+                offload_execute = tpool.execute
+            else:
+                offload_execute = run_inline
+
+    return offload_semaphore, offload_execute
+
+
+# run a CPU-bound function (e.g. classification, password hashing or gpx parsing) outside of the eventlet hub
+# at most OFFLOAD_MAX_WORKERS calls run at once, the others wait for their turn
+# the time spent waiting and running is recorded by kind, e.g. run_offloaded("password_hash", pbkdf2_sha256.verify, ...)
+def run_offloaded(kind, function, *args, **kwargs):
+    if not current_app.config["OFFLOAD_MAX_WORKERS"]:
+        return function(*args, **kwargs)
+
+    semaphore, execute = get_offload_pool()
+
+    # the offloaded function runs in another thread, so it gets the app context of the caller
+    if has_app_context():
+        app = current_app._get_current_object()
+
+        def offloaded_function():
+            with app.app_context():
+                return function(*args, **kwargs)
+
+    else:
+
+        def offloaded_function():
+            return function(*args, **kwargs)
+
+    queue_start_time = perf_counter()
+    with semaphore:
+        run_start_time = perf_counter()
+        try:
+            return execute(offloaded_function)
+        finally:
+            metrics.observe_offload(
+                kind,
+                run_start_time - queue_start_time,
+                perf_counter() - run_start_time,
+            )
@@ -0,0 +1,289 @@
+from . import metrics
+from app.models import gps_positions
+from app import db
+
+from sqlalchemy import text
+from datetime import datetime, timedelta
+from collections import deque
+from io import StringIO
+from time import sleep
+
+import threading
+import logging
+import csv
+
+# buffer between the ingest path and the gps_positions table, created by start_position_history
+position_writer = None
+
+# columns of gps_positions, in the order of the rows of the position writer (see DeviceRecord.to_position_row)
+POSITION_COLUMNS = [column.name for column in gps_positions.columns]
+
+# the daily partitions of gps_positions are named after their day, e.g. gps_positions_p20261018
+PARTITION_PREFIX = "gps_positions_p"
+PARTITION_DATE_FORMAT = "%Y%m%d"
+
+
+# bounded buffer of gps_positions rows waiting to be written to the db
+# the ingest path only appends to it, and a background thread takes the rows in batches and writes each batch with one COPY,
+# so that the history adds no db round trips per GPS device to the ingest path
+# the oldest rows are dropped when the buffer is full, e.g. while the db is down,
+# and so are the batches that still cannot be written after GPS_HISTORY_MAX_ATTEMPTS attempts
+class PositionWriter:
+    def __init__(self, max_size, batch_size):
+        # maximum number of buffered rows
+        self.max_size = max_size
+
+        # number of rows that are written as soon as they are buffered
+        self.batch_size = batch_size
+
+        self.rows = deque()
+
+        self.condition = threading.Condition()
+
+        # counters of rows
+        self.buffered_count = 0
+        self.dropped_count = 0
+        self.written_count = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __repr__(self):
+        return "<Position writer with %r buffered rows>" % len(self.rows)
+
+    # add gps_positions rows to the buffer
+    def put_rows(self, rows):
+        with self.condition:
+            self.rows.extend(rows)
+            self.buffered_count += len(rows)
+
+            self.drop_overflow()
+
+            if len(self.rows) >= self.batch_size:
+                self.condition.notify()
+
+    # drop the oldest rows to keep the buffer within max_size rows
+    def drop_overflow(self):
+        overflow = len(self.rows) - self.max_size
+        if overflow > 0:
+            for _ in range(overflow):
+                self.rows.popleft()
+            self.dropped_count += overflow
+
+    # take up to batch_size of the oldest buffered rows
+    # waits up to timeout seconds for a full batch
+    def take_batch(self, timeout=None):
+        with self.condition:
+            if len(self.rows) < self.batch_size:
+                self.condition.wait(timeout)
+
+            return [
+                self.rows.popleft() for _ in range(min(len(self.rows), self.batch_size))
+            ]
+
+    # count the rows of a batch as written
+    def mark_written(self, batch):
+        with self.condition:
+            self.written_count += len(batch)
+
+    # count the rows of a batch that could not be written as dropped
+    def mark_dropped(self, batch):
+        with self.condition:
+            self.dropped_count += len(batch)
+
+
+# get the CSV fields of a gps_positions row, as read by COPY
+# NULLs are written as unquoted empty fields, which is how COPY reads them in CSV format
+def to_csv_row(row):
+    (
+        gps_device_id,
+        recorded_at,
+        latitude,
+        longitude,
+        associated_route,
+        distance_to_route,
+        is_colorum,
+    ) = row
+    return (
+        gps_device_id,
+        recorded_at.isoformat(),
+        repr(latitude),
+        repr(longitude),
+        associated_route,
+        None if distance_to_route is None else repr(distance_to_route),
+        "t" if is_colorum else "f",
+    )
+
+
+# write gps_positions rows to the db in one statement
+# on postgres the rows are sent with COPY as CSV, which is much faster than INSERT for large batches
+def copy_positions(rows):
+    if db.engine.dialect.name != "postgresql":
+        db.session.execute(
+            gps_positions.insert(), [dict(zip(POSITION_COLUMNS, row)) for row in rows]
+        )
+        db.session.commit()
+        return
+
+    csv_file = StringIO()
+    csv.writer(csv_file).writerows(to_csv_row(row) for row in rows)
+    csv_file.seek(0)
+
+    connection = db.engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                "COPY gps_positions (%s) FROM STDIN WITH (FORMAT csv)"
+                % ", ".join(POSITION_COLUMNS),
+                csv_file,
+            )
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+
+# get the name of the partition of gps_positions of a day
+def get_partition_name(day):
+    return PARTITION_PREFIX + day.strftime(PARTITION_DATE_FORMAT)
+
+
+# create the partitions of gps_positions from today up to partitions_ahead days from now,
+# and drop the partitions of the days more than retention_days days ago
+# partitions are only used on postgres
+def maintain_partitions(partitions_ahead, retention_days):
+    if db.engine.dialect.name != "postgresql":
+        return
+
+    today = datetime.utcnow().date()
+    oldest_kept_day = today - timedelta(days=retention_days)
+
+    with db.engine.begin() as connection:
+        # DDL statements take no bind parameters, so the partition names are quoted as identifiers
+        # and the bounds are dates formatted by isoformat
+        quote = connection.dialect.identifier_preparer.quote
+
+        for days_ahead in range(partitions_ahead + 1):
+            day = today + timedelta(days=days_ahead)
+            connection.execute(
+                text(
+                    "CREATE TABLE IF NOT EXISTS %s PARTITION OF gps_positions "
+                    "FOR VALUES FROM ('%s') TO ('%s')"
+                    % (
+                        quote(get_partition_name(day)),
+                        day.isoformat(),
+                        (day + timedelta(days=1)).isoformat(),
+                    )
+                )
+            )
+
+        partition_names = (
+            connection.execute(
+                text(
+                    "SELECT child.relname FROM pg_inherits "
+                    "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+                    "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+                    "WHERE parent.relname = 'gps_positions'"
+                )
+            )
+            .scalars()
+            .all()
+        )
+        for partition_name in partition_names:
+            try:
+                day = datetime.strptime(
+                    partition_name[len(PARTITION_PREFIX) :], PARTITION_DATE_FORMAT
+                ).date()
+            except ValueError:
+                # partitions that were not created by maintain_partitions are left alone
+                continue
+
+            if day < oldest_kept_day:
+                connection.execute(text("DROP TABLE %s" % quote(partition_name)))
+                logging.info(
+                    "Dropped GPS position history partition %s", partition_name
+                )
+
+
+# create the position writer, and start the threads that write its rows to the db and maintain the partitions
+def start_position_history(app):
+    global position_writer
+
+    position_writer = PositionWriter(
+        app.config["GPS_HISTORY_MAX_BUFFER"], app.config["GPS_HISTORY_BATCH_SIZE"]
+    )
+
+    # expose the size and counters of the buffer with the other metrics
+    metrics.register_callback(
+        "colorum_position_history_buffer_rows",
+        "Number of GPS positions waiting to be written to the position history",
+        lambda: len(position_writer),
+    )
+    for counter_name in ("buffered", "dropped", "written"):
+        metrics.register_callback(
+            "colorum_position_history_%s_total" % counter_name,
+            "Number of GPS positions %s by the position history writer" % counter_name,
+            lambda counter_name=counter_name: getattr(
+                position_writer, "%s_count" % counter_name
+            ),
+            metric_type="counter",
+        )
+
+    # a batch that fails to be written is retried on its own, after a pause so that the db is not retried in a tight loop,
+    # until it has failed GPS_HISTORY_MAX_ATTEMPTS times (e.g. because of a row outside of the kept partitions)
+    def write_positions():
+        batch = []
+        failed_attempts = 0
+        while True:
+            if not batch:
+                batch = position_writer.take_batch(
+                    timeout=app.config["GPS_HISTORY_FLUSH_INTERVAL"]
+                )
+                failed_attempts = 0
+                if not batch:
+                    continue
+
+            with app.app_context():
+                try:
+                    with metrics.time_stage("history_copy"):
+                        copy_positions(batch)
+                    position_writer.mark_written(batch)
+                    batch = []
+                except Exception as error:
+                    db.session.rollback()
+                    logging.error(str(error))
+
+                    failed_attempts += 1
+                    if failed_attempts >= app.config["GPS_HISTORY_MAX_ATTEMPTS"]:
+                        logging.error(
+                            "Dropped %d GPS positions after %d failed attempts",
+                            len(batch),
+                            failed_attempts,
+                        )
+                        position_writer.mark_dropped(batch)
+                        batch = []
+                    else:
+                        sleep(app.config["GPS_HISTORY_FLUSH_INTERVAL"])
+
+    def maintain():
+        while True:
+            with app.app_context():
+                try:
+                    maintain_partitions(
+                        app.config["GPS_HISTORY_PARTITIONS_AHEAD"],
+                        app.config["GPS_HISTORY_RETENTION_DAYS"],
+                    )
+                except Exception as error:
+                    logging.error(str(error))
+
+            sleep(app.config["GPS_HISTORY_MAINTENANCE_INTERVAL"])
+
+    maintenance_thread = threading.Thread(target=maintain, daemon=True)
+    maintenance_thread.start()
+
+    position_writer_thread = threading.Thread(target=write_positions, daemon=True)
+    position_writer_thread.start()
+
+    return position_writer_thread
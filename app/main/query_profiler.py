@@ -0,0 +1,196 @@
+from . import metrics
+
+from flask import g, request, current_app, has_app_context
+from sqlalchemy import event
+from contextlib import contextmanager
+from functools import lru_cache
+from time import perf_counter
+
+import re
+
+# whether db queries are profiled, set by configure_query_profiler
+query_profiler_enabled = False
+
+# number of statement fingerprints listed when a unit of work goes over its budget
+LOGGED_FINGERPRINT_COUNT = 5
+
+# maximum length of a logged statement fingerprint
+LOGGED_FINGERPRINT_LENGTH = 300
+
+# replacements that turn a SQL statement into its fingerprint, in order
+# literals and bind parameters become ?, lists of them (e.g. IN lists and multi-row VALUES) are collapsed,
+# so that the statements of an N+1 loop share a single fingerprint
+FINGERPRINT_REPLACEMENTS = (
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"%\(\w+\)s|%s|\$\d+|\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"\s+"), " "),
+    (re.compile(r"\?(?: ?, ?\?)+"), "?, ..."),
+    (
+        re.compile(r"\((?:\?|\?, \.\.\.)\)(?: ?, ?\((?:\?|\?, \.\.\.)\))+"),
+        "(?, ...), ...",
+    ),
+)
+
+
+# db queries of a unit of work, e.g. an HTTP request, a northbound socketio event or an ingest batch
+class QueryProfile:
+    __slots__ = ("name", "start_time", "query_count", "db_time", "statements")
+
+    def __init__(self, name):
+        self.name = name
+        self.start_time = perf_counter()
+        self.query_count = 0
+
+        # total time spent waiting on the db in seconds
+        self.db_time = 0.0
+
+        # format is {<statement>: [<count>, <db time>]}
+        self.statements = {}
+
+    def __repr__(self):
+        return "<Query profile of %s with %r queries>" % (self.name, self.query_count)
+
+    def record_query(self, statement, duration):
+        self.query_count += 1
+        self.db_time += duration
+
+        statement_stats = self.statements.get(statement)
+        if statement_stats is None:
+            self.statements[statement] = [1, duration]
+        else:
+            statement_stats[0] += 1
+            statement_stats[1] += duration
+
+    # get the count and db time of each statement fingerprint, most frequent first
+    def get_fingerprint_stats(self):
+        fingerprint_stats = {}
+        for statement, (count, db_time) in self.statements.items():
+            stats = fingerprint_stats.setdefault(get_fingerprint(statement), [0, 0.0])
+            stats[0] += count
+            stats[1] += db_time
+
+        return sorted(
+            fingerprint_stats.items(), key=lambda item: (-item[1][0], -item[1][1])
+        )
+
+
+# get the fingerprint of a SQL statement, e.g. "SELECT route.id FROM route WHERE route.id = ?"
+@lru_cache(maxsize=1024)
+def get_fingerprint(statement):
+    fingerprint = statement
+    for pattern, replacement in FINGERPRINT_REPLACEMENTS:
+        fingerprint = pattern.sub(replacement, fingerprint)
+
+    return fingerprint.strip()
+
+
+# start profiling the db queries of a unit of work in the current app context
+def start_profile(name):
+    if query_profiler_enabled:
+        g.query_profile = QueryProfile(name)
+
+
+# stop profiling the db queries of the current unit of work, and log it if it went over its query or time budget
+def finish_profile():
+    profile = g.pop("query_profile", None)
+    if profile is None:
+        return None
+
+    duration = perf_counter() - profile.start_time
+    query_budget = current_app.config["QUERY_COUNT_BUDGET"]
+    time_budget = current_app.config["QUERY_TIME_BUDGET"]
+    if (query_budget and profile.query_count > query_budget) or (
+        time_budget and duration > time_budget
+    ):
+        log_profile(profile, duration)
+
+    return profile
+
+
+def log_profile(profile, duration):
+    lines = [
+        "%s made %d db queries in %.1f ms (%.1f ms in the db), over its budget of %s queries or %s s"
+        % (
+            profile.name,
+            profile.query_count,
+            duration * 1e3,
+            profile.db_time * 1e3,
+            current_app.config["QUERY_COUNT_BUDGET"] or "unlimited",
+            current_app.config["QUERY_TIME_BUDGET"] or "unlimited",
+        )
+    ]
+    for fingerprint, (count, db_time) in profile.get_fingerprint_stats()[
+        :LOGGED_FINGERPRINT_COUNT
+    ]:
+        lines.append(
+            "  %dx, %.1f ms: %s"
+            % (count, db_time * 1e3, fingerprint[:LOGGED_FINGERPRINT_LENGTH])
+        )
+
+    current_app.logger.warning("\n".join(lines))
+
+
+def start_request_profile():
+    start_profile("%s %s" % (request.method, request.path))
+
+
+def finish_request_profile(response):
+    profile = finish_profile()
+    if profile is not None:
+        metrics.observe_request_queries(
+            request.endpoint or "unknown", profile.query_count, profile.db_time
+        )
+
+    return response
+
+
+# profile the db queries of a northbound socketio event or an ingest batch, e.g. with profile_event("list_of_routes"): ...
+@contextmanager
+def profile_event(event_name):
+    start_profile("event %s" % event_name)
+    try:
+        yield
+    finally:
+        profile = finish_profile()
+        if profile is not None:
+            metrics.observe_event_queries(
+                event_name, profile.query_count, profile.db_time
+            )
+
+
+def before_cursor_execute(
+    connection, cursor, statement, parameters, context, executemany
+):
+    if context is not None:
+        context.query_start_time = perf_counter()
+
+
+def after_cursor_execute(
+    connection, cursor, statement, parameters, context, executemany
+):
+    if context is None or not has_app_context():
+        return
+
+    profile = g.get("query_profile")
+    if profile is not None:
+        profile.record_query(statement, perf_counter() - context.query_start_time)
+
+
+# profile the db queries of each HTTP request if query budgets or metrics are enabled
+def configure_query_profiler(app, db):
+    global query_profiler_enabled
+
+    query_profiler_enabled = bool(
+        app.config["QUERY_COUNT_BUDGET"]
+        or app.config["QUERY_TIME_BUDGET"]
+        or app.config["METRICS_ENABLED"]
+    )
+    if not query_profiler_enabled:
+        return
+
+    app.before_request(start_request_profile)
+    app.after_request(finish_request_profile)
+
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(db.engine, "after_cursor_execute", after_cursor_execute)
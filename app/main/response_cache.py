@@ -0,0 +1,196 @@
+from . import routes, fleet_state, metrics
+
+from flask import current_app
+from collections import OrderedDict
+from uuid import uuid4
+
+import threading
+import bisect
+import math
+
+# upper bound of the length in kilometers of one degree of latitude or longitude,
+# so that the distances built from it always cover a whole tile
+KM_PER_DEGREE = 111.7
+
+# estimated number of bytes taken by a cached response, and by each colorum vehicle in it
+CACHED_RESPONSE_SIZE = 512
+CACHED_COLORUM_VEHICLE_SIZE = 640
+
+# cache of the colorum vehicle responses of this process, created by get_colorum_vehicle_cache
+colorum_vehicle_cache = None
+
+# tag of this process in the ETags of the colorum vehicle responses
+# the generations of the fleet state are only meaningful within a process, so ETags from other processes never match
+PROCESS_TAG = uuid4().hex[:8]
+
+
+# colorum vehicles of a tile and a search distance bucket, for a generation of the fleet state
+class CachedResponse:
+    __slots__ = ("generation", "colorum_vehicles", "size")
+
+    def __init__(self, generation, colorum_vehicles):
+        self.generation = generation
+        self.colorum_vehicles = colorum_vehicles
+        self.size = CACHED_RESPONSE_SIZE + CACHED_COLORUM_VEHICLE_SIZE * len(
+            colorum_vehicles
+        )
+
+    def __repr__(self):
+        return "<Cached response with %r colorum vehicles>" % len(self.colorum_vehicles)
+
+
+# cache of the colorum vehicles sent back by /get_colorum_vehicles/, keyed by quantized query
+# enforcers at the same terminal send nearly the same queries, so each query is rounded to the tile of its GPS point
+# and to the next search distance bucket, and the cache keeps every colorum vehicle that any query of that key could get
+# (a superset), which is then filtered exactly for each query
+# cached responses are stale once the fleet state generation changes, and the least recently used ones are evicted
+# once the estimated size of the cache goes over max_size bytes
+class ColorumVehicleCache:
+    def __init__(self, tile_size, distance_buckets, max_size):
+        # size of each tile in degrees
+        self.tile_size = tile_size
+
+        # search distances in kilometers that the search distances of queries are rounded up to, in ascending order
+        # queries with larger search distances are not cached
+        self.distance_buckets = sorted(distance_buckets)
+
+        self.max_size = max_size
+        self.size = 0
+
+        # format is {(<tile row>, <tile column>, <search distance bucket>): <cached response>}, least recently used first
+        self.responses = OrderedDict()
+
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.responses)
+
+    def __repr__(self):
+        return "<Colorum vehicle cache with %r responses, %r bytes>" % (
+            len(self.responses),
+            self.size,
+        )
+
+    # get the key of a query, or None if the query is not cached
+    def get_key(self, latitude, longitude, search_distance):
+        bucket = bisect.bisect_left(self.distance_buckets, search_distance)
+        if bucket == len(self.distance_buckets):
+            return None
+
+        return (
+            math.floor(latitude / self.tile_size),
+            math.floor(longitude / self.tile_size),
+            self.distance_buckets[bucket],
+        )
+
+    # get the center of the tile of a key, and the search distance around it that covers every query of the key
+    # any GPS point of the tile is within half of the diagonal of the tile from its center
+    def get_superset_area(self, key):
+        tile_row, tile_column, bucket_distance = key
+        center = [
+            (tile_row + 0.5) * self.tile_size,
+            (tile_column + 0.5) * self.tile_size,
+        ]
+        half_diagonal = self.tile_size / 2 * math.sqrt(2) * KM_PER_DEGREE
+
+        return center, bucket_distance + half_diagonal
+
+    # get the colorum vehicles within search_distance kilometers of a GPS point [lat, long]
+    # for the given generation of the fleet state
+    def get_colorum_vehicles(self, gps_point, search_distance, generation):
+        key = self.get_key(gps_point[0], gps_point[1], search_distance)
+        if key is None:
+            metrics.count_response_cache("uncacheable")
+            return routes.find_colorum_vehicles(gps_point, search_distance)
+
+        with self.lock:
+            cached_response = self.responses.get(key)
+            if cached_response is not None and cached_response.generation == generation:
+                self.responses.move_to_end(key)
+            else:
+                cached_response = None
+
+        if cached_response is not None:
+            metrics.count_response_cache("hit")
+        else:
+            metrics.count_response_cache("miss")
+            cached_response = CachedResponse(
+                generation, routes.find_colorum_vehicles(*self.get_superset_area(key))
+            )
+            self.store(key, cached_response)
+
+        return routes.select_colorum_vehicles(
+            gps_point, cached_response.colorum_vehicles, search_distance
+        )
+
+    # add a response to the cache, evicting the least recently used responses to keep the cache under max_size bytes
+    def store(self, key, cached_response):
+        with self.lock:
+            old_response = self.responses.pop(key, None)
+            if old_response is not None:
+                self.size -= old_response.size
+
+            if cached_response.size > self.max_size:
+                return
+
+            self.responses[key] = cached_response
+            self.size += cached_response.size
+
+            while self.size > self.max_size:
+                evicted_response = self.responses.popitem(last=False)[1]
+                self.size -= evicted_response.size
+                metrics.count_response_cache("eviction")
+
+
+# get the ETag of the response to a /get_colorum_vehicles/ query for a generation of the fleet state
+# the response to the same query is the same as long as the generation does not change
+def get_etag(gps_point, search_distance, generation):
+    return "%s-%x-%r-%r-%r" % (
+        PROCESS_TAG,
+        generation,
+        gps_point[0],
+        gps_point[1],
+        search_distance,
+    )
+
+
+# get the colorum vehicle cache, creating it the first time it is used, or None if COLORUM_CACHE_MAX_SIZE is 0
+def get_colorum_vehicle_cache():
+    global colorum_vehicle_cache
+
+    if colorum_vehicle_cache is None and current_app.config["COLORUM_CACHE_MAX_SIZE"]:
+        cache = ColorumVehicleCache(
+            current_app.config["COLORUM_CACHE_TILE_SIZE"],
+            current_app.config["COLORUM_CACHE_DISTANCE_BUCKETS"],
+            current_app.config["COLORUM_CACHE_MAX_SIZE"],
+        )
+
+        # expose the size of the cache with the other metrics
+        metrics.register_callback(
+            "colorum_response_cache_responses",
+            "Number of colorum vehicle responses in the response cache",
+            lambda: len(cache),
+        )
+        metrics.register_callback(
+            "colorum_response_cache_bytes",
+            "Estimated size in bytes of the response cache",
+            lambda: cache.size,
+        )
+        colorum_vehicle_cache = cache
+
+    return colorum_vehicle_cache
+
+
+# get the colorum vehicles within search_distance kilometers of a GPS point [lat, long],
+# from the response cache if it is enabled
+def get_colorum_vehicles(gps_point, search_distance, generation):
+    cache = get_colorum_vehicle_cache()
+    if cache is None:
+        return routes.find_colorum_vehicles(gps_point, search_distance)
+
+    return cache.get_colorum_vehicles(gps_point, search_distance, generation)
+
+
+# get the generation of the fleet state, which changes whenever a colorum vehicle changes
+def get_generation():
+    return fleet_state.get_fleet_state().colorum_generation
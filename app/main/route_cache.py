@@ -0,0 +1,243 @@
+from . import calculation_functions, metrics
+
+from flask import current_app
+
+import numpy as np
+import struct
+import os
+
+# compiled routes are stored next to their .gpx files, in a compact binary format with this file extension
+ROUTE_FILE_EXTENSION = ".route"
+
+# header of a compiled route file:
+# magic, format version, source .gpx file mtime (ns), source .gpx file size, number of vertices, bounding box (4 floats)
+# it is followed by little-endian float64 arrays of the projected vertices [x, y],
+# the segment vectors [dx, dy] and the inverse squared segment lengths
+ROUTE_FILE_HEADER = struct.Struct("<8sIqqQ4d")
+ROUTE_FILE_MAGIC = b"CLRMROUT"
+ROUTE_FILE_VERSION = 1
+
+# in-process cache of compiled route geometries, so that .gpx files are not re-parsed and re-projected for every GPS point
+# format is {<route id>: (<gpx file key>, <compiled route>)}
+compiled_routes = {}
+
+# number of vertices of each cached route before and after it was simplified
+# format is {<route id>: {"vertices": <number of vertices>, "simplified_vertices": <number of vertices>}}
+route_stats = {}
+
+
+# get the key that identifies the current contents of a .gpx file
+# the key changes whenever the .gpx file is replaced or modified, which invalidates the cached route geometry
+def get_gpx_file_key(gpx_file_path):
+    gpx_file_stat = os.stat(gpx_file_path)
+    return (gpx_file_path, gpx_file_stat.st_mtime_ns, gpx_file_stat.st_size)
+
+
+# write a compiled route to a compiled route file
+# the file is written under a temporary name first so that other processes never load a partially written file
+def save_route_file(route_file_path, compiled_route, gpx_file_key):
+    header = ROUTE_FILE_HEADER.pack(
+        ROUTE_FILE_MAGIC,
+        ROUTE_FILE_VERSION,
+        gpx_file_key[1],
+        gpx_file_key[2],
+        len(compiled_route.coordinates),
+        *compiled_route.bounds
+    )
+
+    temporary_route_file_path = "%s.%s.tmp" % (route_file_path, os.getpid())
+    with open(temporary_route_file_path, "wb") as route_file:
+        route_file.write(header)
+        for array in (
+            compiled_route.coordinates,
+            compiled_route.segment_vectors,
+            compiled_route.segment_inverse_lengths_squared,
+        ):
+            route_file.write(np.ascontiguousarray(array, dtype="<f8").tobytes())
+    os.replace(temporary_route_file_path, route_file_path)
+
+
+# load a compiled route from a compiled route file using a read-only memory map, so that loading does not copy the arrays
+# returns None if the file does not exist or was not compiled from the .gpx file identified by gpx_file_key
+def load_route_file(route_file_path, gpx_file_key):
+    try:
+        with open(route_file_path, "rb") as route_file:
+            header = route_file.read(ROUTE_FILE_HEADER.size)
+    except FileNotFoundError:
+        return None
+
+    if len(header) != ROUTE_FILE_HEADER.size:
+        return None
+
+    (
+        magic,
+        version,
+        gpx_file_mtime,
+        gpx_file_size,
+        vertex_count,
+        *bounds,
+    ) = ROUTE_FILE_HEADER.unpack(header)
+    if (
+        magic != ROUTE_FILE_MAGIC
+        or version != ROUTE_FILE_VERSION
+        or (gpx_file_mtime, gpx_file_size) != gpx_file_key[1:]
+    ):
+        return None
+
+    segment_count = vertex_count - 1
+    route_data = np.memmap(
+        route_file_path,
+        dtype="<f8",
+        mode="r",
+        offset=ROUTE_FILE_HEADER.size,
+        shape=(2 * vertex_count + 3 * segment_count,),
+    )
+
+    coordinates = route_data[: 2 * vertex_count].reshape(vertex_count, 2)
+    segment_vectors = route_data[
+        2 * vertex_count : 2 * vertex_count + 2 * segment_count
+    ].reshape(segment_count, 2)
+    segment_inverse_lengths_squared = route_data[2 * vertex_count + 2 * segment_count :]
+
+    return calculation_functions.CompiledRoute(
+        coordinates, segment_vectors, segment_inverse_lengths_squared, tuple(bounds)
+    )
+
+
+# give a compiled route a segment index if it benefits from one
+# the cells of the index are as large as the set maximum distance between a GPS device and its route
+def index_route(compiled_route):
+    max_distance = current_app.config["COLORUM_MAX_DISTANCE"]
+
+    if (
+        len(compiled_route.segment_starts)
+        >= calculation_functions.SEGMENT_INDEX_MIN_SEGMENTS
+    ):
+        compiled_route.segment_index = calculation_functions.build_segment_index(
+            compiled_route, max_distance
+        )
+        if not calculation_functions.segment_index_is_worthwhile(
+            compiled_route, max_distance
+        ):
+            compiled_route.segment_index = None
+
+    return compiled_route
+
+
+# simplify a compiled route if route simplification is enabled, index it, then build its corridor if route corridors are enabled
+# the exact route is still used for GPS points whose classification is ambiguous on the simplified route
+def prepare_route(route_id, compiled_route):
+    simplification_tolerance = current_app.config["ROUTE_SIMPLIFICATION_TOLERANCE"]
+
+    prepared_route = compiled_route
+    if simplification_tolerance > 0:
+        prepared_route = calculation_functions.simplify_route(
+            compiled_route, simplification_tolerance
+        )
+        if prepared_route.exact_route is not None:
+            index_route(prepared_route.exact_route)
+
+    index_route(prepared_route)
+
+    corridor_cell_size = current_app.config["ROUTE_CORRIDOR_CELL_SIZE"]
+    if corridor_cell_size > 0:
+        prepared_route.corridor = calculation_functions.build_route_corridor(
+            prepared_route,
+            current_app.config["COLORUM_MAX_DISTANCE"],
+            corridor_cell_size,
+            current_app.config["ROUTE_CORRIDOR_MAX_CELLS"],
+        )
+
+    route_stats[route_id] = {
+        "vertices": len(compiled_route.coordinates),
+        "simplified_vertices": len(prepared_route.coordinates),
+        "corridor_cells": (
+            len(prepared_route.corridor.cell_states) if prepared_route.corridor else 0
+        ),
+    }
+    if prepared_route is not compiled_route:
+        current_app.logger.info(
+            "Simplified route %s from %d to %d vertices",
+            route_id,
+            len(compiled_route.coordinates),
+            len(prepared_route.coordinates),
+        )
+
+    return prepared_route
+
+
+# parse and compile a .gpx file and store it as a compiled route file next to the .gpx file
+# route_points can be given if the track points of the .gpx file have already been read, e.g. while validating an upload
+# returns the path of the compiled route file and the key of the .gpx file it was compiled from
+def compile_route_file(gpx_filename, route_points=None):
+    gpx_file_path = os.path.join(current_app.config["UPLOAD_FOLDER"], gpx_filename)
+    gpx_file_key = get_gpx_file_key(gpx_file_path)
+
+    if route_points is None:
+        # stream the track points of the .gpx file into an array
+        with open(gpx_file_path, "rb") as gpx_file, metrics.time_stage("gpx_parse"):
+            route_points = calculation_functions.read_gpx_file(
+                gpx_file,
+                current_app.config["GPX_MAX_FILE_SIZE"],
+                current_app.config["GPX_MAX_POINTS"],
+            )
+
+    route_file_path = gpx_file_path + ROUTE_FILE_EXTENSION
+    with metrics.time_stage("route_compile"):
+        save_route_file(
+            route_file_path,
+            calculation_functions.compile_route(route_points),
+            gpx_file_key,
+        )
+
+    return route_file_path, gpx_file_key
+
+
+# parse and compile the .gpx file associated with a route, store it as a compiled route file next to the .gpx file,
+# then store the compiled route in the cache
+def cache_route(route_id, gpx_filename, route_points=None):
+    route_file_path, gpx_file_key = compile_route_file(
+        gpx_filename, route_points=route_points
+    )
+
+    with metrics.time_stage("route_load"):
+        compiled_route = prepare_route(
+            route_id, load_route_file(route_file_path, gpx_file_key)
+        )
+    compiled_routes[route_id] = (gpx_file_key, compiled_route)
+
+    return compiled_route
+
+
+# get the compiled route of a route from the cache
+# if the route is not in the cache yet, it is loaded from its compiled route file,
+# and it is only recompiled from its .gpx file if the compiled route file is missing or out of date
+def get_compiled_route(route_id, gpx_filename):
+    gpx_file_path = os.path.join(current_app.config["UPLOAD_FOLDER"], gpx_filename)
+    gpx_file_key = get_gpx_file_key(gpx_file_path)
+
+    cached_route = compiled_routes.get(route_id)
+    if cached_route is not None and cached_route[0] == gpx_file_key:
+        return cached_route[1]
+
+    compiled_route = load_route_file(gpx_file_path + ROUTE_FILE_EXTENSION, gpx_file_key)
+    if compiled_route is None:
+        return cache_route(route_id, gpx_filename)
+
+    with metrics.time_stage("route_load"):
+        compiled_route = prepare_route(route_id, compiled_route)
+    compiled_routes[route_id] = (gpx_file_key, compiled_route)
+
+    return compiled_route
+
+
+# remove a route from the cache
+def drop_route(route_id):
+    compiled_routes.pop(route_id, None)
+    route_stats.pop(route_id, None)
+
+
+# remove all routes from the cache
+def clear_routes():
+    compiled_routes.clear()
+    route_stats.clear()
@@ -0,0 +1,104 @@
+from app import (
+    db,
+    NORTHBOUND_ROUTES_REQUEST_CHANNEL,
+    NORTHBOUND_ROUTES_RECEIVED_CHANNEL,
+)
+from app.models import Route
+
+from werkzeug.utils import secure_filename
+from flask import current_app
+from sqlalchemy import text
+from select import select
+from time import monotonic
+
+import threading
+import os
+
+# in-process cache of the routes sent back by /get_routes/, along with whether or not they have associated gpx files
+# format is [{"route_id": <route id>, "gpx_file_associated": <gpx filename or None>}]
+cached_route_list = None
+
+# time the cached route list was built at
+cached_route_list_time = None
+
+route_list_lock = threading.Lock()
+
+
+# build the route list from the routes in the db
+# routes whose gpx file is missing from the upload folder are sent back without a gpx file
+def build_route_list():
+    route_list = []
+    for route_id, gpx_filename in Route.query.with_entities(
+        Route.id, Route.gpx_filename
+    ).all():
+        if gpx_filename is not None and not os.path.exists(
+            os.path.join(
+                current_app.config["UPLOAD_FOLDER"], secure_filename(gpx_filename)
+            )
+        ):
+            gpx_filename = None
+
+        route_list.append({"route_id": route_id, "gpx_file_associated": gpx_filename})
+
+    return route_list
+
+
+# get the route list, rebuilding it if it is older than ROUTE_LIST_CACHE_TTL seconds
+# routes are also written by the ingest process and by other web workers, so the cached route list is at most that old
+def get_route_list():
+    global cached_route_list, cached_route_list_time
+
+    with route_list_lock:
+        if (
+            cached_route_list is not None
+            and monotonic() - cached_route_list_time
+            < current_app.config["ROUTE_LIST_CACHE_TTL"]
+        ):
+            return cached_route_list
+
+    route_list = build_route_list()
+    with route_list_lock:
+        cached_route_list = route_list
+        cached_route_list_time = monotonic()
+
+    return route_list
+
+
+# drop the cached route list, e.g. after a gpx file has been associated with a route
+def invalidate_route_list():
+    global cached_route_list
+
+    with route_list_lock:
+        cached_route_list = None
+
+
+# ask the ingest process, which owns the connection with the Northbound Interface, to request the routes,
+# and wait up to timeout seconds for it to write them to the db
+# returns whether they were written, after which the cached route list is dropped so that it is rebuilt from the db
+def request_routes(timeout):
+    connection = db.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+    try:
+        # listen before sending the request, so that the answer cannot be missed
+        connection.execute(text("LISTEN %s" % NORTHBOUND_ROUTES_RECEIVED_CHANNEL))
+        connection.execute(
+            text("SELECT pg_notify(:channel, '')"),
+            channel=NORTHBOUND_ROUTES_REQUEST_CHANNEL,
+        )
+
+        dbapi_connection = connection.connection
+        deadline = monotonic() + timeout
+        while not dbapi_connection.notifies:
+            remaining_time = deadline - monotonic()
+            if remaining_time <= 0:
+                return False
+
+            select([dbapi_connection], [], [], remaining_time)
+            dbapi_connection.poll()
+    finally:
+        # the connection goes back to the pool, so it must not keep listening
+        connection.execute(text("UNLISTEN *"))
+        del connection.connection.notifies[:]
+        connection.close()
+
+    invalidate_route_list()
+    return True
@@ -1,5 +1,12 @@
-from app.models import ColorumUser, GPSDevice
-from . import main_blueprint
+from app.models import ColorumUser
+from . import (
+    main_blueprint,
+    fleet_state,
+    calculation_functions,
+    metrics,
+    offload,
+    response_cache,
+)
 
 from flask_jwt_extended import (
     get_jwt_identity,
@@ -7,11 +14,13 @@ from flask_jwt_extended import (
     create_access_token,
     create_refresh_token,
 )
-from flask import request, jsonify, current_app
+from flask import request, jsonify, current_app, make_response
 from passlib.hash import pbkdf2_sha256
 from base64 import b64decode
 from geopy import distance
 
+import numpy as np
+
 # login using username and password to get access tokens to be used in other routes
 # login is required because only enforcers with accounts may use the colorum app
 @main_blueprint.route("/app_login/", methods=["POST"])
@@ -36,7 +45,9 @@ def handle_app_login():
     colorum_user = ColorumUser.query.filter_by(id=username).first()
     if colorum_user:
         # if user exists in the db, verify the password used for logging in against the hash in the db
-        if not pbkdf2_sha256.verify(password, colorum_user.password):
+        if not offload.run_offloaded(
+            "password_hash", pbkdf2_sha256.verify, password, colorum_user.password
+        ):
             # if the password and the hash don't match, return error
             current_app.logger.error(
                 "User account %s username and password do not match", username
@@ -122,22 +133,19 @@ def handle_get_colorum_vehicles():
         return "no arguments/incomplete arguments found in request", 400
 
     try:
-        # go through each colorum vehicle and check whether or not it is within the search distance of the given GPS point
-        # if it is, add the colorum vehicle to the list of colorum vehicles to be sent back to the user
-        all_colorum_vehicles = GPSDevice.query.filter_by(is_colorum=True).all()
-        for colorum_vehicle in all_colorum_vehicles:
-            if (
-                distance.distance(gps_point, colorum_vehicle.last_location).km
-                <= search_distance
-            ):
-                colorum_vehicles.append(
-                    {
-                        "gps_device_id": colorum_vehicle.id,
-                        "last_location": colorum_vehicle.last_location,
-                        "associated_route": colorum_vehicle.associated_route,
-                        "distance_from_route": colorum_vehicle.distance_to_route,
-                    }
-                )
+        # the response stays the same until a colorum vehicle changes, so enforcer apps that already have it
+        # are told so instead of being sent it again
+        generation = response_cache.get_generation()
+        etag = response_cache.get_etag(gps_point, search_distance, generation)
+        if etag in request.if_none_match:
+            metrics.count_response_cache("not_modified")
+            response = make_response("", 304)
+            response.set_etag(etag)
+            return response
+
+        colorum_vehicles = response_cache.get_colorum_vehicles(
+            gps_point, search_distance, generation
+        )
 
         # return list of colorum vehicles
         current_app.logger.info(
@@ -146,7 +154,85 @@ def handle_get_colorum_vehicles():
             search_distance,
             colorum_vehicles,
         )
-        return jsonify(colorum_vehicles), 200
+        response = jsonify(colorum_vehicles)
+        response.set_etag(etag)
+        return response, 200
     except Exception as error:
         current_app.logger.error(str(error))
         return str(error), 500
+
+
+# get the colorum vehicles within search_distance kilometers of a GPS point [lat, long]
+# this is used by /get_colorum_vehicles/ and for the colorum vehicles pushed to enforcer apps when they subscribe to an area
+def find_colorum_vehicles(gps_point, search_distance):
+    # use the in-memory fleet state to get the colorum vehicles inside the box around the search area,
+    # so that enforcer queries do not go through the db
+    with metrics.time_stage("colorum_search"):
+        candidate_colorum_vehicles = (
+            fleet_state.get_fleet_state().search_colorum_vehicles(
+                gps_point[0], gps_point[1], search_distance
+            )
+        )
+
+    return select_colorum_vehicles(
+        gps_point, candidate_colorum_vehicles, search_distance
+    )
+
+
+# get the candidate colorum vehicles (e.g. from the box around the search area) that are within search_distance kilometers
+# of a GPS point [lat, long]
+def select_colorum_vehicles(gps_point, candidate_colorum_vehicles, search_distance):
+    # go through each candidate colorum vehicle and check whether or not it is within the search distance of the given GPS point
+    # if it is, add the colorum vehicle to the list of colorum vehicles to be sent back to the user
+    with metrics.time_stage("colorum_filter"):
+        if (
+            candidate_colorum_vehicles
+            and search_distance <= current_app.config["APPROXIMATE_SEARCH_DISTANCE"]
+        ):
+            # short searches check all of the candidates at once using an approximation that is within 1 mm of the geodesic distance
+            candidate_locations = np.array(
+                [
+                    colorum_vehicle["last_location"]
+                    for colorum_vehicle in candidate_colorum_vehicles
+                ],
+                dtype=np.float64,
+            )
+            candidate_distances = calculation_functions.approximate_distances(
+                gps_point[0],
+                gps_point[1],
+                candidate_locations[:, 0],
+                candidate_locations[:, 1],
+            )
+            colorum_vehicles = [
+                colorum_vehicle
+                for colorum_vehicle, candidate_distance in zip(
+                    candidate_colorum_vehicles, candidate_distances
+                )
+                if candidate_distance <= search_distance * 1000
+            ]
+        elif (
+            len(candidate_colorum_vehicles) >= current_app.config["OFFLOAD_MIN_POINTS"]
+        ):
+            colorum_vehicles = offload.run_offloaded(
+                "colorum_filter",
+                filter_colorum_vehicles,
+                gps_point,
+                candidate_colorum_vehicles,
+                search_distance,
+            )
+        else:
+            colorum_vehicles = filter_colorum_vehicles(
+                gps_point, candidate_colorum_vehicles, search_distance
+            )
+
+    return colorum_vehicles
+
+
+# get the colorum vehicles that are within search_distance kilometers of a GPS point, using geodesic distances
+def filter_colorum_vehicles(gps_point, candidate_colorum_vehicles, search_distance):
+    return [
+        colorum_vehicle
+        for colorum_vehicle in candidate_colorum_vehicles
+        if distance.distance(gps_point, colorum_vehicle["last_location"]).km
+        <= search_distance
+    ]
@@ -0,0 +1,209 @@
+import math
+
+# length in kilometers of one degree of latitude, and of one degree of longitude at the equator
+# both are rounded down so that the search boxes built from them always contain the whole search area
+KM_PER_DEGREE_LATITUDE = 110.5
+KM_PER_DEGREE_LONGITUDE = 111.3
+
+
+# get the box (min latitude, min longitude, max latitude, max longitude) that contains the search area
+# formed by a GPS point and a search distance in kilometers, or None if the box wraps around the antimeridian
+def get_search_box(latitude, longitude, search_distance):
+    # get the latitude and longitude spans of the box that contains the search area
+    latitude_delta = search_distance / KM_PER_DEGREE_LATITUDE
+    farthest_latitude = min(abs(latitude) + latitude_delta, 90.0)
+    longitude_scale = KM_PER_DEGREE_LONGITUDE * math.cos(
+        math.radians(farthest_latitude)
+    )
+    if longitude_scale > 0:
+        longitude_delta = search_distance / longitude_scale
+    else:
+        longitude_delta = 360.0
+
+    if longitude - longitude_delta < -180.0 or longitude + longitude_delta > 180.0:
+        return None
+
+    return (
+        latitude - latitude_delta,
+        longitude - longitude_delta,
+        latitude + latitude_delta,
+        longitude + longitude_delta,
+    )
+
+
+# uniform grid of latitude/longitude cells, used to find the keys (e.g. GPS device IDs)
+# whose locations are near a GPS point without going through every key
+class GridIndex:
+    def __init__(self, cell_size):
+        # size of each cell in degrees
+        self.cell_size = cell_size
+
+        # keys in each cell
+        # format is {(<cell row>, <cell column>): {<key>, ...}}
+        self.cells = {}
+
+        # location of each key
+        # format is {<key>: (<latitude>, <longitude>)}
+        self.locations = {}
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __contains__(self, key):
+        return key in self.locations
+
+    def __repr__(self):
+        return "<Grid index with %r keys in %r cells>" % (
+            len(self.locations),
+            len(self.cells),
+        )
+
+    # get the cell that contains a GPS point
+    def get_cell(self, latitude, longitude):
+        return (
+            math.floor(latitude / self.cell_size),
+            math.floor(longitude / self.cell_size),
+        )
+
+    # add a key to the index, or move it if it is already in the index
+    def insert(self, key, latitude, longitude):
+        self.remove(key)
+
+        self.locations[key] = (latitude, longitude)
+        self.cells.setdefault(self.get_cell(latitude, longitude), set()).add(key)
+
+    # remove a key from the index, if it is in the index
+    def remove(self, key):
+        location = self.locations.pop(key, None)
+        if location is None:
+            return
+
+        cell = self.get_cell(*location)
+        cell_keys = self.cells[cell]
+        cell_keys.discard(key)
+        if not cell_keys:
+            del self.cells[cell]
+
+    # get the keys whose locations are inside the box that contains the search area
+    # formed by a GPS point and a search distance in kilometers
+    # these are only candidates: the caller still has to check the exact distance of each of them
+    def search(self, latitude, longitude, search_distance):
+        search_box = get_search_box(latitude, longitude, search_distance)
+
+        # if the box wraps around the antimeridian, every key is a candidate
+        if search_box is None:
+            return list(self.locations)
+        min_latitude, min_longitude, max_latitude, max_longitude = search_box
+
+        min_row, min_column = self.get_cell(min_latitude, min_longitude)
+        max_row, max_column = self.get_cell(max_latitude, max_longitude)
+
+        if (max_row - min_row + 1) * (max_column - min_column + 1) >= len(self.cells):
+            # if the box covers more cells than there are occupied cells, go through the occupied cells instead
+            candidate_keys = self.locations
+        else:
+            candidate_keys = []
+            for row in range(min_row, max_row + 1):
+                for column in range(min_column, max_column + 1):
+                    candidate_keys.extend(self.cells.get((row, column), ()))
+
+        return [
+            key
+            for key in candidate_keys
+            if min_latitude <= self.locations[key][0] <= max_latitude
+            and min_longitude <= self.locations[key][1] <= max_longitude
+        ]
+
+
+# uniform grid of latitude/longitude cells, used to find the keys (e.g. subscriptions of enforcer apps)
+# whose search areas contain a GPS point without going through every key
+# each key is added to every cell that its search box overlaps, or to the keys checked for every GPS point
+# if its search box overlaps more than max_cells cells or wraps around the antimeridian
+class AreaIndex:
+    def __init__(self, cell_size, max_cells):
+        # size of each cell in degrees
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+
+        # keys whose search boxes overlap each cell
+        # format is {(<cell row>, <cell column>): {<key>, ...}}
+        self.cells = {}
+
+        # keys whose search boxes are too large for the cells
+        self.large_area_keys = set()
+
+        # search area and cells of each key
+        # format is {<key>: ((<latitude>, <longitude>, <search distance>), [<cell>, ...])}
+        self.areas = {}
+
+    def __len__(self):
+        return len(self.areas)
+
+    def __contains__(self, key):
+        return key in self.areas
+
+    def __repr__(self):
+        return "<Area index with %r keys in %r cells>" % (
+            len(self.areas),
+            len(self.cells),
+        )
+
+    # get the cell that contains a GPS point
+    def get_cell(self, latitude, longitude):
+        return (
+            math.floor(latitude / self.cell_size),
+            math.floor(longitude / self.cell_size),
+        )
+
+    # add the search area of a key to the index, or replace it if the key is already in the index
+    def insert(self, key, latitude, longitude, search_distance):
+        self.remove(key)
+
+        area_cells = []
+        search_box = get_search_box(latitude, longitude, search_distance)
+        if search_box is not None:
+            min_row, min_column = self.get_cell(search_box[0], search_box[1])
+            max_row, max_column = self.get_cell(search_box[2], search_box[3])
+            if (max_row - min_row + 1) * (
+                max_column - min_column + 1
+            ) <= self.max_cells:
+                area_cells = [
+                    (row, column)
+                    for row in range(min_row, max_row + 1)
+                    for column in range(min_column, max_column + 1)
+                ]
+
+        if area_cells:
+            for cell in area_cells:
+                self.cells.setdefault(cell, set()).add(key)
+        else:
+            self.large_area_keys.add(key)
+
+        self.areas[key] = ((latitude, longitude, search_distance), area_cells)
+
+    # remove the search area of a key from the index, if it is in the index
+    def remove(self, key):
+        area = self.areas.pop(key, None)
+        if area is None:
+            return
+
+        area_cells = area[1]
+        if not area_cells:
+            self.large_area_keys.discard(key)
+        for cell in area_cells:
+            cell_keys = self.cells[cell]
+            cell_keys.discard(key)
+            if not cell_keys:
+                del self.cells[cell]
+
+    # get the search area (<latitude>, <longitude>, <search distance>) of a key
+    def get_area(self, key):
+        return self.areas[key][0]
+
+    # get the keys whose search boxes may contain a GPS point
+    # these are only candidates: the caller still has to check the exact distance of the GPS point to each search area
+    def search(self, latitude, longitude):
+        candidate_keys = set(self.large_area_keys)
+        candidate_keys.update(self.cells.get(self.get_cell(latitude, longitude), ()))
+
+        return candidate_keys
@@ -13,6 +13,16 @@ class GPSDevice(db.Model):
     associated_route = db.Column(db.String())
     distance_to_route = db.Column(db.Float())
     is_colorum = db.Column(db.Boolean(), nullable=False)
+    last_seen = db.Column(db.DateTime())
+
+    # web workers load the online colorum vehicles, which are a small part of all GPS devices
+    __table_args__ = (
+        db.Index(
+            "ix_gps_devices_online_colorum",
+            "id",
+            postgresql_where=db.text("online AND is_colorum"),
+        ),
+    )
 
     def __init__(self, id, last_location, associated_route):
         self.id = id
@@ -21,11 +31,30 @@ class GPSDevice(db.Model):
         self.associated_route = associated_route
         self.distance_to_route = 0
         self.is_colorum = False
+        self.last_seen = datetime.utcnow()
 
     def __repr__(self):
         return "<GPS device %r>" % self.id
 
 
+# append-only history of the reported positions of the GPS devices, partitioned by day of recorded_at (UTC)
+# rows are written in batches by app.main.position_history, which also creates and drops the daily partitions
+gps_positions = db.Table(
+    "gps_positions",
+    db.Column("gps_device_id", db.String(), nullable=False),
+    db.Column("recorded_at", db.DateTime(), nullable=False),
+    db.Column("latitude", db.Float(), nullable=False),
+    db.Column("longitude", db.Float(), nullable=False),
+    db.Column("associated_route", db.String()),
+    db.Column("distance_to_route", db.Float()),
+    db.Column("is_colorum", db.Boolean(), nullable=False),
+    db.Index(
+        "ix_gps_positions_gps_device_id_recorded_at", "gps_device_id", "recorded_at"
+    ),
+    postgresql_partition_by="RANGE (recorded_at)",
+)
+
+
 class Route(db.Model):
     __tablename__ = "puv_routes"
 
@@ -40,6 +69,25 @@ class Route(db.Model):
         return "<GPX Route Association %r: %r>" % (self.id, self.gpx_file)
 
 
+# credentials for the Northbound Interface set by /set_northbound_credentials/, in a single row
+# the ingest process reads them over its own db connection when it is notified that they changed
+class NorthboundCredentials(db.Model):
+    __tablename__ = "northbound_credentials"
+
+    # the password is encrypted with credentials.encrypt_password
+    id = db.Column(db.Integer(), primary_key=True)
+    username = db.Column(db.String(), nullable=False)
+    password = db.Column(db.String(), nullable=False)
+
+    def __init__(self, username, password, id=1):
+        self.id = id
+        self.username = username
+        self.password = password
+
+    def __repr__(self):
+        return "<Northbound credentials %r>" % self.username
+
+
 class ColorumAdmin(db.Model):
     __tablename__ = "colorum_admins"
 
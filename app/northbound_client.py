@@ -0,0 +1,289 @@
+from requests.auth import HTTPBasicAuth
+from requests import Session
+from socketio import Client
+from time import monotonic, time
+from base64 import urlsafe_b64decode
+
+import threading
+import logging
+import random
+import json
+
+
+# error raised when the Northbound Interface rejects a login, with the response text and status code to pass on
+class NorthboundError(Exception):
+    def __init__(self, message, status_code=502):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+# client of the Northbound Interface
+# it owns a pooled HTTP session, caches the access token and refreshes it ahead of its expiry with the refresh token,
+# and keeps the socketio stream connected, reconnecting with exponential backoff when it drops
+class NorthboundClient:
+    def __init__(self):
+        # HTTP session shared by the logins, token refreshes and the socketio connection,
+        # so that they reuse their TCP connections to the Northbound Interface
+        self.session = Session()
+
+        # socketio connection to the Northbound Interface
+        # reconnecting is handled by this client, since a reconnect needs a fresh access token
+        self.connection = Client(reconnection=False, http_session=self.session)
+        self.connection.on("disconnect", self.handle_disconnect)
+
+        # address, credentials and timings of the Northbound Interface, set by configure
+        self.url = None
+        self.username = None
+        self.password = None
+
+        self.access_token = None
+        self.refresh_token = None
+
+        # monotonic time at which the access token expires, and timer that refreshes it ahead of that
+        self.access_token_expiry = 0
+        self.token_refresh_timer = None
+
+        # whether the device location stream should be kept running, i.e. whether to reconnect when it drops
+        # stop_event wakes up a pending reconnect so that it gives up, e.g. when the stream is restarted
+        self.streaming = False
+        self.reconnect_thread = None
+        self.stop_event = threading.Event()
+
+        self.lock = threading.RLock()
+        self.logger = logging.getLogger(__name__)
+
+    def __repr__(self):
+        return "<Northbound client for %s>" % self.url
+
+    # take the address, credentials and timings of the Northbound Interface from the config of an app
+    def configure(self, app):
+        self.url = "http://%s:%s" % (
+            app.config["NORTHBOUND_ADDRESS"],
+            app.config["NORTHBOUND_PORT"],
+        )
+        self.refresh_path = app.config["NORTHBOUND_REFRESH_PATH"]
+        self.http_timeout = app.config["NORTHBOUND_HTTP_TIMEOUT"]
+        self.token_lifetime = app.config["NORTHBOUND_TOKEN_LIFETIME"]
+        self.token_refresh_margin = app.config["NORTHBOUND_TOKEN_REFRESH_MARGIN"]
+        self.reconnect_delay = app.config["NORTHBOUND_RECONNECT_DELAY"]
+        self.reconnect_max_delay = app.config["NORTHBOUND_RECONNECT_MAX_DELAY"]
+        self.logger = app.logger
+
+        self.set_credentials(
+            app.config["NORTHBOUND_USERNAME"], app.config["NORTHBOUND_PASSWORD"]
+        )
+
+    def has_credentials(self):
+        return bool(self.username and self.password)
+
+    # use new credentials, dropping the tokens of the old ones
+    def set_credentials(self, username, password):
+        with self.lock:
+            self.username = username
+            self.password = password
+            self.access_token = None
+            self.refresh_token = None
+            self.cancel_token_refresh()
+
+    # send a login request to the Northbound Interface and get its response
+    def login(self, username, password):
+        return self.session.post(
+            "%s/login/" % self.url,
+            auth=HTTPBasicAuth(username, password),
+            timeout=self.http_timeout,
+        )
+
+    # get an access token, refreshing it if it expires within NORTHBOUND_TOKEN_REFRESH_MARGIN seconds,
+    # or logging in again if there is no refresh token or it was rejected
+    def get_access_token(self):
+        with self.lock:
+            if (
+                self.access_token is not None
+                and monotonic() < self.access_token_expiry - self.token_refresh_margin
+            ):
+                return self.access_token
+
+            if self.refresh_token is not None and self.refresh_access_token():
+                return self.access_token
+
+            northbound_login = self.login(self.username, self.password)
+            if northbound_login.status_code != 200:
+                raise NorthboundError(
+                    northbound_login.text, northbound_login.status_code
+                )
+
+            self.store_tokens(northbound_login.json())
+            return self.access_token
+
+    # get a new access token with the refresh token, returning whether it worked
+    def refresh_access_token(self):
+        try:
+            northbound_refresh = self.session.post(
+                "%s%s" % (self.url, self.refresh_path),
+                headers={"Authorization": "Bearer %s" % self.refresh_token},
+                timeout=self.http_timeout,
+            )
+        except Exception as error:
+            self.logger.error(str(error))
+            return False
+
+        if northbound_refresh.status_code != 200:
+            self.logger.info(
+                "Northbound Interface refresh token was rejected, logging in again"
+            )
+            self.refresh_token = None
+            return False
+
+        self.store_tokens(northbound_refresh.json())
+        return True
+
+    # store the access and refresh tokens of a login or refresh response
+    def store_tokens(self, northbound_response_json):
+        self.access_token = northbound_response_json["access_token"]
+        self.refresh_token = northbound_response_json.get(
+            "refresh_token", self.refresh_token
+        )
+        self.access_token_expiry = self.get_token_expiry(self.access_token)
+        self.schedule_token_refresh()
+
+    # refresh the access token NORTHBOUND_TOKEN_REFRESH_MARGIN seconds before it expires, while the stream is running,
+    # so that reconnects do not have to wait for a refresh or a login
+    # tokens that expire within the margin are refreshed every NORTHBOUND_TOKEN_REFRESH_MARGIN seconds at most
+    def schedule_token_refresh(self):
+        self.cancel_token_refresh()
+
+        refresh_delay = max(
+            self.access_token_expiry - self.token_refresh_margin - monotonic(),
+            self.token_refresh_margin,
+            1,
+        )
+        self.token_refresh_timer = threading.Timer(
+            refresh_delay, self.refresh_token_ahead
+        )
+        self.token_refresh_timer.daemon = True
+        self.token_refresh_timer.start()
+
+    def cancel_token_refresh(self):
+        if self.token_refresh_timer is not None:
+            self.token_refresh_timer.cancel()
+            self.token_refresh_timer = None
+
+    def refresh_token_ahead(self):
+        if not self.streaming:
+            return
+
+        try:
+            self.get_access_token()
+        except Exception as error:
+            self.logger.error(
+                "Could not refresh the Northbound Interface access token: %s", error
+            )
+
+    # get the monotonic time at which a token expires, from its exp claim if it is a JWT,
+    # or NORTHBOUND_TOKEN_LIFETIME seconds from now otherwise
+    def get_token_expiry(self, token):
+        try:
+            payload = token.split(".")[1]
+            claims = json.loads(urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+            return monotonic() + (float(claims["exp"]) - time())
+        except Exception:
+            return monotonic() + self.token_lifetime
+
+    # connect the socketio connection to the Northbound Interface with an access token
+    def connect(self):
+        with self.lock:
+            access_token = self.get_access_token()
+            try:
+                self.connection.connect(
+                    self.url, headers={"Authorization": "Bearer %s" % access_token}
+                )
+            except Exception:
+                # the access token may have been revoked, so get a new one for the next attempt
+                self.access_token = None
+                raise
+
+    def disconnect(self):
+        if self.connection.connected:
+            self.connection.disconnect()
+
+    # connect and start the device location stream, and keep it running until stop_stream
+    def start_stream(self):
+        self.streaming = True
+        self.stop_event.clear()
+        try:
+            self.connect()
+
+            # send the start stream event to the northbound server
+            self.connection.emit("start_device_location_stream")
+        except Exception as error:
+            self.logger.error(
+                "Could not connect to the Northbound Interface: %s", error
+            )
+            self.schedule_reconnect()
+
+    def stop_stream(self):
+        self.streaming = False
+        self.stop_event.set()
+        self.cancel_token_refresh()
+        if self.connection.connected:
+            # send the stop stream event to the northbound server
+            self.connection.emit("stop_device_location_stream")
+            self.connection.disconnect()
+
+    # restart the device location stream, e.g. with new credentials
+    # a pending reconnect is stopped first, so that it cannot connect with the old credentials after the restart
+    def restart_stream(self):
+        self.streaming = False
+        self.stop_reconnect()
+        self.disconnect()
+        self.start_stream()
+
+    # stop a pending reconnect and wait for it to give up
+    def stop_reconnect(self):
+        self.stop_event.set()
+
+        reconnect_thread = self.reconnect_thread
+        if (
+            reconnect_thread is not None
+            and reconnect_thread is not threading.current_thread()
+        ):
+            reconnect_thread.join()
+
+        self.stop_event.clear()
+
+    def handle_disconnect(self):
+        if self.streaming:
+            self.logger.error("Disconnected from the Northbound Interface")
+            self.schedule_reconnect()
+
+    # reconnect in the background, unless a reconnect is already in progress
+    def schedule_reconnect(self):
+        with self.lock:
+            if self.reconnect_thread is not None and self.reconnect_thread.is_alive():
+                return
+
+            self.reconnect_thread = threading.Thread(
+                target=self.reconnect_with_backoff, daemon=True
+            )
+            self.reconnect_thread.start()
+
+    # keep trying to reconnect and restart the device location stream,
+    # doubling the delay between attempts up to NORTHBOUND_RECONNECT_MAX_DELAY seconds
+    # the delays are randomized so that many clients do not reconnect all at once
+    def reconnect_with_backoff(self):
+        delay = self.reconnect_delay
+        while self.streaming and not self.connection.connected:
+            if self.stop_event.wait(random.uniform(delay / 2, delay)):
+                return
+
+            try:
+                self.connect()
+                self.connection.emit("start_device_location_stream")
+
+                self.logger.info("Reconnected to the Northbound Interface")
+                return
+            except Exception as error:
+                self.logger.error(
+                    "Could not reconnect to the Northbound Interface: %s", error
+                )
+                delay = min(delay * 2, self.reconnect_max_delay)
@@ -0,0 +1,119 @@
+from sqlalchemy import event
+from time import perf_counter
+
+import numpy as np
+import resource
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_server, db
+import config
+
+
+# create the colorum app against a benchmark db and upload folder
+# sqlite is supported as a stand-in for postgres: the postgres ARRAY column of the GPS devices is stored as JSON instead
+# the tables are created if they do not exist yet, so a postgres db should be a scratch db used only for benchmarking
+def create_benchmark_app(database_url, upload_folder):
+    benchmark_config = {
+        "SQLALCHEMY_DATABASE_URI": database_url,
+        "UPLOAD_FOLDER": upload_folder,
+        "JWT_SECRET_KEY": "benchmark",
+    }
+    if database_url.startswith("sqlite"):
+        # sqlite does not take the postgres pool settings
+        benchmark_config["SQLALCHEMY_ENGINE_OPTIONS"] = {}
+
+    app = create_server(type("BenchmarkConfig", (config.Config,), benchmark_config))
+
+    with app.app_context():
+        if db.engine.dialect.name == "sqlite":
+            from app.models import GPSDevice
+
+            GPSDevice.__table__.c.last_location.type = db.JSON()
+
+        db.create_all()
+
+    return app
+
+
+# count of the SQL statements sent to the db by an app, e.g. to get the number of db round-trips of a benchmark
+class QueryCounter:
+    def __init__(self, app):
+        self.count = 0
+
+        with app.app_context():
+            event.listen(db.engine, "before_cursor_execute", self.count_query)
+
+    def count_query(self, *args):
+        self.count += 1
+
+
+# latencies of a benchmarked operation, in seconds
+class LatencyRecorder:
+    def __init__(self):
+        self.latencies = []
+        self.item_count = 0
+
+    def __len__(self):
+        return len(self.latencies)
+
+    # time one call of a function, counting item_count items (e.g. the GPS devices of a payload) for the throughput
+    def time_call(self, function, *args, item_count=1, **kwargs):
+        start_time = perf_counter()
+        result = function(*args, **kwargs)
+        self.latencies.append(perf_counter() - start_time)
+        self.item_count += item_count
+
+        return result
+
+    # get the total time, throughput and latency percentiles of the recorded calls
+    def get_summary(self):
+        latencies = np.array(self.latencies)
+        total_time = latencies.sum()
+
+        return {
+            "calls": len(latencies),
+            "items": self.item_count,
+            "total_seconds": float(total_time),
+            "items_per_second": (
+                float(self.item_count / total_time) if total_time else 0.0
+            ),
+            "p50_ms": float(np.percentile(latencies, 50) * 1e3),
+            "p99_ms": float(np.percentile(latencies, 99) * 1e3),
+            "max_ms": float(latencies.max() * 1e3),
+        }
+
+
+# get the peak resident memory of this process in megabytes
+def get_peak_memory():
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        return peak_memory / 2**20
+    return peak_memory / 2**10
+
+
+# print the summary of a benchmarked operation
+def print_summary(name, summary, db_round_trips=None):
+    print(name)
+    print(
+        "  %d calls, %d items in %.2f s (%.0f items/s)"
+        % (
+            summary["calls"],
+            summary["items"],
+            summary["total_seconds"],
+            summary["items_per_second"],
+        )
+    )
+    print(
+        "  latency p50 %.2f ms, p99 %.2f ms, max %.2f ms"
+        % (summary["p50_ms"], summary["p99_ms"], summary["max_ms"])
+    )
+    if db_round_trips is not None:
+        print(
+            "  %d db round-trips (%.2f per call)"
+            % (db_round_trips, db_round_trips / max(summary["calls"], 1))
+        )
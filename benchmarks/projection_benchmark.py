@@ -0,0 +1,170 @@
+from flask import Flask
+from pyproj import Geod, Transformer
+from time import perf_counter
+
+import numpy as np
+import argparse
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.main import calculation_functions
+
+# bounding box of Metro Manila (min latitude, min longitude, max latitude, max longitude)
+METRO_MANILA_BOUNDS = (14.35, 120.90, 14.80, 121.15)
+
+
+# generate random GPS points [lat, long] inside Metro Manila
+def generate_gps_points(point_count, rng):
+    min_latitude, min_longitude, max_latitude, max_longitude = METRO_MANILA_BOUNDS
+    return np.column_stack(
+        (
+            rng.uniform(min_latitude, max_latitude, point_count),
+            rng.uniform(min_longitude, max_longitude, point_count),
+        )
+    )
+
+
+# run a function repeat times and get its best time in seconds
+def time_function(function, repeat):
+    best_time = float("inf")
+    for _ in range(repeat):
+        start_time = perf_counter()
+        function()
+        best_time = min(best_time, perf_counter() - start_time)
+
+    return best_time
+
+
+# compare the ways of projecting GPS points onto the Philippine map projection
+def benchmark_projections(app, gps_points, repeat):
+    latitudes = np.ascontiguousarray(gps_points[:, 0])
+    longitudes = np.ascontiguousarray(gps_points[:, 1])
+    transformer = Transformer.from_crs(
+        app.config["WGS84"], app.config["PSEUDO_MERCATOR"]
+    )
+
+    benchmarks = {
+        "transform each point": lambda: [
+            transformer.transform(latitude, longitude)
+            for latitude, longitude in gps_points.tolist()
+        ],
+        "transform arrays": lambda: transformer.transform(latitudes, longitudes),
+        "project_points": lambda: calculation_functions.project_points(gps_points),
+    }
+
+    # the projection used to go through shapely.ops.transform one point at a time
+    try:
+        from shapely.geometry import Point
+        from shapely.ops import transform
+
+        benchmarks["shapely transform each point"] = lambda: [
+            transform(transformer.transform, Point(latitude, longitude))
+            for latitude, longitude in gps_points.tolist()
+        ]
+    except ImportError:
+        pass
+
+    return {
+        name: time_function(function, repeat) for name, function in benchmarks.items()
+    }
+
+
+# compare the ways of getting the distance between pairs of nearby GPS points,
+# and get the maximum error of approximate_distances against the geodesic distance
+def benchmark_distances(gps_points, max_distance, repeat, rng):
+    geod = Geod(ellps="WGS84")
+    longitudes, latitudes, _ = geod.fwd(
+        gps_points[:, 1],
+        gps_points[:, 0],
+        rng.uniform(0, 360, len(gps_points)),
+        rng.uniform(0, max_distance, len(gps_points)),
+    )
+    other_points = np.column_stack((latitudes, longitudes))
+
+    benchmarks = {
+        "geodesic distances": lambda: geod.inv(
+            gps_points[:, 1], gps_points[:, 0], other_points[:, 1], other_points[:, 0]
+        )[2],
+        "approximate_distances": lambda: calculation_functions.approximate_distances(
+            gps_points[:, 0], gps_points[:, 1], other_points[:, 0], other_points[:, 1]
+        ),
+    }
+
+    # the exact search of /get_colorum_vehicles/ used to go through geopy one pair at a time
+    try:
+        from geopy import distance
+
+        benchmarks["geopy distance each pair"] = lambda: [
+            distance.distance(gps_point, other_point).m
+            for gps_point, other_point in zip(
+                gps_points.tolist(), other_points.tolist()
+            )
+        ]
+    except ImportError:
+        pass
+
+    timings = {
+        name: time_function(function, repeat) for name, function in benchmarks.items()
+    }
+    max_error = np.abs(
+        benchmarks["approximate_distances"]() - benchmarks["geodesic distances"]()
+    ).max()
+
+    return timings, max_error
+
+
+# print the timings of a benchmark, fastest first
+def print_timings(title, timings, point_count):
+    print(title)
+    for name, seconds in sorted(timings.items(), key=lambda timing: timing[1]):
+        print(
+            "  %-32s %10.2f ms %10.3f us/point"
+            % (name, seconds * 1e3, seconds * 1e6 / point_count)
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the ways of projecting GPS points and getting distances between them"
+    )
+    parser.add_argument("--points", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--max-distance",
+        type=float,
+        default=1000,
+        help="maximum distance in meters between the pairs of GPS points of the distance benchmark",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args()
+
+    # the calculation functions only need the app config, so the app does not connect to the db
+    app = Flask(__name__)
+    app.config.from_object("config.Config")
+
+    rng = np.random.default_rng(arguments.seed)
+    gps_points = generate_gps_points(arguments.points, rng)
+
+    with app.app_context():
+        print_timings(
+            "Projection of %d GPS points" % arguments.points,
+            benchmark_projections(app, gps_points, arguments.repeat),
+            arguments.points,
+        )
+
+        timings, max_error = benchmark_distances(
+            gps_points, arguments.max_distance, arguments.repeat, rng
+        )
+        print_timings(
+            "Distance between %d pairs of GPS points up to %g m apart"
+            % (arguments.points, arguments.max_distance),
+            timings,
+            arguments.points,
+        )
+        print("  approximate_distances maximum error: %.6f m" % max_error)
+
+
+if __name__ == "__main__":
+    main()
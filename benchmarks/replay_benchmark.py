@@ -0,0 +1,207 @@
+from flask_jwt_extended import create_access_token
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import argparse
+import json
+import io
+import os
+
+from harness import (
+    create_benchmark_app,
+    QueryCounter,
+    LatencyRecorder,
+    get_peak_memory,
+    print_summary,
+)
+from synthetic_fleet import SyntheticFleet, generate_route_points, write_gpx_file
+from app import db
+
+
+# upload the .gpx file of each route with /associate_file_to_route/, like an admin would
+def upload_routes(client, headers, routes, upload_folder, recorder):
+    for route_id, route_points in routes.items():
+        gpx_filename = "%s.gpx" % route_id
+        gpx_file_path = os.path.join(upload_folder, "source-" + gpx_filename)
+        write_gpx_file(gpx_file_path, route_points)
+
+        with open(gpx_file_path, "rb") as gpx_file:
+            response = recorder.time_call(
+                client.post,
+                "/associate_file_to_route/",
+                data={
+                    "body": repr({"route_id": route_id}),
+                    "file": (io.BytesIO(gpx_file.read()), gpx_filename),
+                },
+                headers=headers,
+            )
+        if response.status_code != 200:
+            raise RuntimeError(
+                "could not upload route %s: %s" % (route_id, response.data)
+            )
+
+
+# replay list_of_gps_devices payloads through process_gps_devices, like the ingest worker does with its batches
+def replay_payloads(app, payloads, recorder):
+    from app.main import northbound_handler
+
+    for payload in payloads:
+        with app.app_context():
+            recorder.time_call(
+                northbound_handler.process_gps_devices,
+                payload,
+                item_count=len(payload),
+            )
+
+
+# query /get_colorum_vehicles/ around random GPS devices of the fleet, like enforcers would
+def query_colorum_vehicles(client, headers, fleet, query_count, rng, recorder):
+    colorum_vehicle_count = 0
+    for _ in range(query_count):
+        latitude, longitude = fleet.get_device_location(rng.integers(len(fleet)))
+        response = recorder.time_call(
+            client.get,
+            "/get_colorum_vehicles/",
+            query_string={
+                "latitude": latitude,
+                "longitude": longitude,
+                "search_distance": rng.choice([0.5, 1, 2, 5]),
+            },
+            headers=headers,
+        )
+        if response.status_code != 200:
+            raise RuntimeError("could not query colorum vehicles: %s" % response.data)
+        colorum_vehicle_count += len(response.get_json())
+
+    return colorum_vehicle_count
+
+
+# delete the GPS devices and routes created by the benchmark from the db
+def clean_up(app, fleet):
+    from app.models import GPSDevice, Route
+
+    with app.app_context():
+        GPSDevice.query.filter(GPSDevice.id.in_(fleet.device_ids)).delete(
+            synchronize_session=False
+        )
+        Route.query.filter(Route.id.in_(list(fleet.routes))).delete(
+            synchronize_session=False
+        )
+        db.session.commit()
+
+
+def run_benchmark(arguments, upload_folder):
+    rng = np.random.default_rng(arguments.seed)
+
+    database_url = arguments.database_url or "sqlite:///%s" % os.path.join(
+        upload_folder, "benchmark.db"
+    )
+    app = create_benchmark_app(database_url, upload_folder)
+    query_counter = QueryCounter(app)
+    client = app.test_client()
+
+    with app.app_context():
+        headers = {
+            "Authorization": "Bearer %s" % create_access_token(identity="benchmark")
+        }
+
+    routes = {}
+    for index in range(arguments.routes):
+        routes["bench-route-%d" % index] = generate_route_points(
+            rng, arguments.route_length, arguments.vertex_spacing
+        )
+    fleet = SyntheticFleet(routes, arguments.devices, arguments.colorum_ratio, rng)
+
+    # generate all of the payloads first, so that generating them is not part of the measurements
+    payloads = [
+        fleet.next_payload(arguments.payload_size) for _ in range(arguments.payloads)
+    ]
+
+    results = {
+        "database": database_url.split(":")[0],
+        "arguments": vars(arguments),
+    }
+
+    try:
+        upload_recorder = LatencyRecorder()
+        upload_routes(client, headers, routes, upload_folder, upload_recorder)
+        results["route_uploads"] = upload_recorder.get_summary()
+
+        query_count = query_counter.count
+        replay_recorder = LatencyRecorder()
+        replay_payloads(app, payloads, replay_recorder)
+
+        # write the remaining changes of the fleet state, so that the db writes of the replay are counted
+        from app.main import fleet_state
+
+        with app.app_context():
+            fleet_state.flush_fleet_state()
+        results["payload_replay"] = replay_recorder.get_summary()
+        results["payload_replay"]["db_round_trips"] = query_counter.count - query_count
+
+        query_count = query_counter.count
+        colorum_recorder = LatencyRecorder()
+        colorum_vehicle_count = query_colorum_vehicles(
+            client, headers, fleet, arguments.queries, rng, colorum_recorder
+        )
+        results["colorum_queries"] = colorum_recorder.get_summary()
+        results["colorum_queries"]["db_round_trips"] = query_counter.count - query_count
+        results["colorum_queries"]["colorum_vehicles"] = colorum_vehicle_count
+
+        results["peak_memory_mb"] = get_peak_memory()
+    finally:
+        clean_up(app, fleet)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a synthetic fleet through the colorum app and measure throughput, latency, db round-trips and memory"
+    )
+    parser.add_argument(
+        "--database-url",
+        help="db to run against, e.g. a scratch postgres db (default: a temporary sqlite db)",
+    )
+    parser.add_argument("--devices", type=int, default=5000)
+    parser.add_argument("--routes", type=int, default=50)
+    parser.add_argument(
+        "--route-length", type=float, default=15000, help="route length in meters"
+    )
+    parser.add_argument(
+        "--vertex-spacing",
+        type=float,
+        default=10,
+        help="distance in meters between route vertices",
+    )
+    parser.add_argument("--colorum-ratio", type=float, default=0.1)
+    parser.add_argument("--payloads", type=int, default=50)
+    parser.add_argument("--payload-size", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this .json file")
+    arguments = parser.parse_args()
+
+    with TemporaryDirectory() as upload_folder:
+        results = run_benchmark(arguments, upload_folder)
+
+    print_summary("Route uploads", results["route_uploads"])
+    print_summary(
+        "Payload replay (items are GPS devices)",
+        results["payload_replay"],
+        results["payload_replay"]["db_round_trips"],
+    )
+    print_summary(
+        "Colorum vehicle queries",
+        results["colorum_queries"],
+        results["colorum_queries"]["db_round_trips"],
+    )
+    print("Peak memory: %.1f MB" % results["peak_memory_mb"])
+
+    if arguments.output:
+        with open(arguments.output, "w") as output_file:
+            json.dump(results, output_file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import numpy as np
+import math
+
+# bounding box of Metro Manila (min latitude, min longitude, max latitude, max longitude)
+METRO_MANILA_BOUNDS = (14.35, 120.90, 14.80, 121.15)
+
+# approximate length in meters of one degree of latitude and of one degree of longitude in Metro Manila
+METERS_PER_DEGREE_LATITUDE = 110580.0
+METERS_PER_DEGREE_LONGITUDE = 107720.0
+
+
+# generate the GPS points [lat, long] of a route of about route_length meters, with a vertex every vertex_spacing meters
+# the route wanders like a street route: its heading drifts slowly, with an occasional sharp turn at an intersection,
+# and it bounces off the edges of Metro Manila
+def generate_route_points(rng, route_length, vertex_spacing):
+    min_latitude, min_longitude, max_latitude, max_longitude = METRO_MANILA_BOUNDS
+    vertex_count = max(2, int(route_length // vertex_spacing) + 1)
+
+    headings = rng.uniform(0, 2 * math.pi) + np.cumsum(
+        rng.normal(0, 0.03, vertex_count)
+        + rng.choice(
+            [0.0, math.pi / 2, -math.pi / 2], vertex_count, p=[0.996, 0.002, 0.002]
+        )
+    )
+
+    route_points = np.empty((vertex_count, 2))
+    route_points[0] = (
+        rng.uniform(min_latitude, max_latitude),
+        rng.uniform(min_longitude, max_longitude),
+    )
+    for index in range(1, vertex_count):
+        latitude = (
+            route_points[index - 1, 0]
+            + vertex_spacing * math.sin(headings[index]) / METERS_PER_DEGREE_LATITUDE
+        )
+        longitude = (
+            route_points[index - 1, 1]
+            + vertex_spacing * math.cos(headings[index]) / METERS_PER_DEGREE_LONGITUDE
+        )
+
+        # turn around at the edges of Metro Manila
+        if not (min_latitude <= latitude <= max_latitude) or not (
+            min_longitude <= longitude <= max_longitude
+        ):
+            headings[index:] += math.pi
+            latitude, longitude = route_points[index - 1]
+
+        route_points[index] = (latitude, longitude)
+
+    return route_points
+
+
+# write the GPS points [lat, long] of a route as the single track of a .gpx file
+def write_gpx_file(gpx_file_path, route_points):
+    with open(gpx_file_path, "w") as gpx_file:
+        gpx_file.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<gpx version="1.1" creator="colorum-benchmarks" xmlns="http://www.topografix.com/GPX/1/1">\n'
+            "<trk><trkseg>\n"
+        )
+        for latitude, longitude in route_points.tolist():
+            gpx_file.write(
+                '<trkpt lat="%.7f" lon="%.7f"></trkpt>\n' % (latitude, longitude)
+            )
+        gpx_file.write("</trkseg></trk>\n</gpx>\n")
+
+
+# fleet of GPS devices driving along routes, which generates list_of_gps_devices payloads like the northbound platform
+# colorum vehicles drive along their route too, but offset far enough from it to be outside of the set maximum distance
+class SyntheticFleet:
+    def __init__(
+        self, routes, device_count, colorum_ratio, rng, id_prefix="bench-device-"
+    ):
+        self.rng = rng
+
+        # format is {<route id>: <array of GPS points [lat, long]>}
+        self.routes = routes
+        route_ids = list(routes)
+
+        self.device_ids = ["%s%d" % (id_prefix, index) for index in range(device_count)]
+        self.device_routes = [
+            route_ids[index] for index in rng.integers(0, len(route_ids), device_count)
+        ]
+
+        # position of each GPS device along its route, as a fractional vertex index,
+        # and the number of vertices it moves along its route between two reports
+        self.device_positions = np.array(
+            [
+                rng.uniform(0, len(routes[route_id]) - 1)
+                for route_id in self.device_routes
+            ]
+        )
+        self.device_speeds = rng.uniform(0.5, 3.0, device_count)
+
+        # offset of each GPS device from its route in meters [north, east]
+        # vehicles that follow their route stay within a lane or two of it, colorum vehicles are 200 m to 2 km away
+        offset_distances = np.abs(rng.normal(0, 10, device_count))
+        colorum_devices = rng.random(device_count) < colorum_ratio
+        offset_distances[colorum_devices] = rng.uniform(
+            200, 2000, colorum_devices.sum()
+        )
+        offset_headings = rng.uniform(0, 2 * math.pi, device_count)
+        self.device_offsets = np.column_stack(
+            (
+                offset_distances * np.sin(offset_headings) / METERS_PER_DEGREE_LATITUDE,
+                offset_distances
+                * np.cos(offset_headings)
+                / METERS_PER_DEGREE_LONGITUDE,
+            )
+        )
+        self.colorum_devices = colorum_devices
+
+    def __len__(self):
+        return len(self.device_ids)
+
+    def __repr__(self):
+        return "<Synthetic fleet with %r devices on %r routes>" % (
+            len(self.device_ids),
+            len(self.routes),
+        )
+
+    # get the current GPS point [lat, long] of a GPS device, with a few meters of GPS noise
+    def get_device_location(self, device):
+        route_points = self.routes[self.device_routes[device]]
+        position = self.device_positions[device]
+        vertex = min(int(position), len(route_points) - 2)
+        fraction = position - vertex
+
+        location = (
+            route_points[vertex] * (1 - fraction)
+            + route_points[vertex + 1] * fraction
+            + self.device_offsets[device]
+        )
+        location += self.rng.normal(0, 3, 2) / (
+            METERS_PER_DEGREE_LATITUDE,
+            METERS_PER_DEGREE_LONGITUDE,
+        )
+
+        return [float(location[0]), float(location[1])]
+
+    # move payload_size random GPS devices along their routes and get the list_of_gps_devices payload that reports them
+    # GPS devices turn around at the ends of their routes
+    def next_payload(self, payload_size):
+        devices = self.rng.choice(
+            len(self.device_ids), min(payload_size, len(self.device_ids)), replace=False
+        )
+
+        payload = []
+        for device in devices.tolist():
+            route_length = len(self.routes[self.device_routes[device]]) - 1
+            position = self.device_positions[device] + self.device_speeds[device]
+            if not (0 <= position <= route_length):
+                self.device_speeds[device] = -self.device_speeds[device]
+                position = min(max(position, 0), route_length)
+            self.device_positions[device] = position
+
+            payload.append(
+                {
+                    "gps_device_id": self.device_ids[device],
+                    "last_location": self.get_device_location(device),
+                    "associated_route": self.device_routes[device],
+                }
+            )
+
+        return payload
@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-from pyproj import CRS, Transformer
+from pyproj import CRS
 from dotenv import load_dotenv
 from datetime import timedelta
 import os
@@ -43,8 +43,159 @@ class Config:
     CORS_HEADERS = "Content-Type"
 
     # for colorum app
-    COLORUM_MAX_DISTANCE = os.getenv("COLORUM_MAX_DISTANCE", default=100)
+    COLORUM_MAX_DISTANCE = float(os.getenv("COLORUM_MAX_DISTANCE", default=100))
     UPLOAD_FOLDER = os.getenv("UPLOAD_FOLDER", default="gpx_files")
+
+    # maximum distance in meters between a route and its simplified version (e.g. 5), or 0 to classify against the exact routes
+    # GPS devices within this distance of the set maximum distance are still classified against the exact routes
+    ROUTE_SIMPLIFICATION_TOLERANCE = float(
+        os.getenv("ROUTE_SIMPLIFICATION_TOLERANCE", default=0)
+    )
+
+    # size in meters of the cells of the route corridors (e.g. 10), or 0 to not build route corridors
+    # GPS points in cells entirely within the set maximum distance of their route are classified by a single lookup,
+    # and routes whose corridors would have more than the set maximum number of cells do not get one
+    ROUTE_CORRIDOR_CELL_SIZE = float(os.getenv("ROUTE_CORRIDOR_CELL_SIZE", default=0))
+    ROUTE_CORRIDOR_MAX_CELLS = int(
+        os.getenv("ROUTE_CORRIDOR_MAX_CELLS", default=4000000)
+    )
+
+    # .gpx files larger than this many bytes or with more track points than this are rejected
+    GPX_MAX_FILE_SIZE = int(os.getenv("GPX_MAX_FILE_SIZE", default=16 * 1024 * 1024))
+    GPX_MAX_POINTS = int(os.getenv("GPX_MAX_POINTS", default=1000000))
+
+    # requests larger than this many bytes are rejected with 413 before they are read,
+    # which leaves 1 MiB over the largest .gpx file for the rest of an upload form by default
+    MAX_CONTENT_LENGTH = int(
+        os.getenv("MAX_CONTENT_LENGTH", default=GPX_MAX_FILE_SIZE + 1024 * 1024)
+    )
+
+    # GPS devices that moved less than this many meters since they were last classified
+    # are not reclassified if their last distance shows that they are still clearly within or outside of their route
+    CLASSIFICATION_MOVEMENT_EPSILON = float(
+        os.getenv("CLASSIFICATION_MOVEMENT_EPSILON", default=20)
+    )
+
+    # size in degrees of the cells of the colorum vehicle index (0.01 degrees is about 1.1 km)
+    COLORUM_GRID_CELL_SIZE = float(os.getenv("COLORUM_GRID_CELL_SIZE", default=0.01))
+
+    # maximum number of GPS devices waiting in the ingest queue, and taken from it at once
+    INGEST_QUEUE_MAX_SIZE = int(os.getenv("INGEST_QUEUE_MAX_SIZE", default=20000))
+    INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", default=5000))
+
+    # interval in seconds between writes of the in-memory fleet state to the db
+    FLEET_STATE_FLUSH_INTERVAL = float(
+        os.getenv("FLEET_STATE_FLUSH_INTERVAL", default=1)
+    )
+
+    # interval in seconds between loads of the colorum vehicles from the db by web workers
+    FLEET_STATE_REFRESH_INTERVAL = float(
+        os.getenv("FLEET_STATE_REFRESH_INTERVAL", default=2)
+    )
+
+    # GPS devices that have not been reported for OFFLINE_TIMEOUT seconds are marked as offline by the ingest process,
+    # which checks for them every OFFLINE_CHECK_INTERVAL seconds, or never if the timeout is 0
+    # offline GPS devices are not sent back as colorum vehicles until they are reported again
+    OFFLINE_TIMEOUT = float(os.getenv("OFFLINE_TIMEOUT", default=300))
+    OFFLINE_CHECK_INTERVAL = float(os.getenv("OFFLINE_CHECK_INTERVAL", default=5))
+
+    # the ingest process keeps every reported position in gps_positions, buffering up to GPS_HISTORY_MAX_BUFFER rows
+    # (the oldest are dropped beyond that) and writing them with COPY every GPS_HISTORY_FLUSH_INTERVAL seconds
+    # or as soon as GPS_HISTORY_BATCH_SIZE rows are buffered
+    GPS_HISTORY_ENABLED = (
+        os.getenv("GPS_HISTORY_ENABLED", default="true").lower() == "true"
+    )
+    GPS_HISTORY_BATCH_SIZE = int(os.getenv("GPS_HISTORY_BATCH_SIZE", default=5000))
+    GPS_HISTORY_MAX_BUFFER = int(os.getenv("GPS_HISTORY_MAX_BUFFER", default=100000))
+    GPS_HISTORY_FLUSH_INTERVAL = float(
+        os.getenv("GPS_HISTORY_FLUSH_INTERVAL", default=1)
+    )
+
+    # a batch of positions that still cannot be written after this many attempts is dropped,
+    # so that it does not hold back the newer positions
+    GPS_HISTORY_MAX_ATTEMPTS = int(os.getenv("GPS_HISTORY_MAX_ATTEMPTS", default=5))
+
+    # gps_positions has one partition per day (UTC), created GPS_HISTORY_PARTITIONS_AHEAD days in advance
+    # and dropped once older than GPS_HISTORY_RETENTION_DAYS days, checked every GPS_HISTORY_MAINTENANCE_INTERVAL seconds
+    GPS_HISTORY_PARTITIONS_AHEAD = int(
+        os.getenv("GPS_HISTORY_PARTITIONS_AHEAD", default=2)
+    )
+    GPS_HISTORY_RETENTION_DAYS = int(
+        os.getenv("GPS_HISTORY_RETENTION_DAYS", default=30)
+    )
+    GPS_HISTORY_MAINTENANCE_INTERVAL = float(
+        os.getenv("GPS_HISTORY_MAINTENANCE_INTERVAL", default=3600)
+    )
+
+    # postgres advisory lock key held by the ingest process that owns the northbound stream,
+    # and intervals in seconds between attempts to acquire it and checks that it is still held
+    INGEST_LOCK_KEY = int(os.getenv("INGEST_LOCK_KEY", default=1668246639))
+    INGEST_LOCK_RETRY_INTERVAL = float(
+        os.getenv("INGEST_LOCK_RETRY_INTERVAL", default=5)
+    )
+    INGEST_LOCK_CHECK_INTERVAL = float(
+        os.getenv("INGEST_LOCK_CHECK_INTERVAL", default=1)
+    )
+
+    # record timing histograms, payload sizes, db query counts and northbound stream lag, and expose them on /metrics
+    # when this is off, the instrumented code paths skip recording altogether
+    METRICS_ENABLED = os.getenv("METRICS_ENABLED", default="false").lower() == "true"
+
+    # bearer token that Prometheus must send to scrape /metrics, or empty to only serve /metrics from the ingest process,
+    # whose HTTP server is only reachable on INGEST_HTTP_HOST
+    METRICS_TOKEN = os.getenv("METRICS_TOKEN", default="")
+
+    # CPU-bound calls (classification, password hashing, gpx parsing, geodesic searches) run in a pool of this many threads,
+    # so that they do not stall the other requests of an eventlet worker, or in the calling thread if 0
+    OFFLOAD_MAX_WORKERS = int(os.getenv("OFFLOAD_MAX_WORKERS", default=4))
+
+    # payloads and searches with fewer GPS points than this are handled in the calling thread,
+    # since handing them over to the offload pool would take longer than handling them
+    OFFLOAD_MIN_POINTS = int(os.getenv("OFFLOAD_MIN_POINTS", default=200))
+
+    # /get_colorum_vehicles/ responses are cached by tile of this size in degrees and by search distance bucket in kilometers,
+    # up to an estimated COLORUM_CACHE_MAX_SIZE bytes per process, or not at all if it is 0
+    # queries with search distances over the largest bucket are not cached
+    COLORUM_CACHE_TILE_SIZE = float(os.getenv("COLORUM_CACHE_TILE_SIZE", default=0.005))
+    COLORUM_CACHE_DISTANCE_BUCKETS = [
+        float(bucket)
+        for bucket in os.getenv(
+            "COLORUM_CACHE_DISTANCE_BUCKETS", default="0.5,1,2,5,10"
+        ).split(",")
+    ]
+    COLORUM_CACHE_MAX_SIZE = int(
+        os.getenv("COLORUM_CACHE_MAX_SIZE", default=32 * 1024 * 1024)
+    )
+
+    # serve a socketio server on COLORUM_PUSH_PATH that pushes the changes of the colorum vehicles
+    # within the areas that enforcer apps subscribe to, every COLORUM_PUSH_INTERVAL seconds
+    # with several web workers, enforcer apps must use the websocket transport, or the load balancer must use sticky sessions
+    COLORUM_PUSH_ENABLED = (
+        os.getenv("COLORUM_PUSH_ENABLED", default="false").lower() == "true"
+    )
+    COLORUM_PUSH_PATH = os.getenv("COLORUM_PUSH_PATH", default="socket.io")
+    COLORUM_PUSH_INTERVAL = float(os.getenv("COLORUM_PUSH_INTERVAL", default=1))
+
+    # size in degrees of the cells of the index of subscribed areas,
+    # and maximum number of cells of a subscribed area before it is checked against every change instead
+    SUBSCRIPTION_GRID_CELL_SIZE = float(
+        os.getenv("SUBSCRIPTION_GRID_CELL_SIZE", default=0.01)
+    )
+    SUBSCRIPTION_MAX_CELLS = int(os.getenv("SUBSCRIPTION_MAX_CELLS", default=400))
+
+    # HTTP requests, northbound socketio events and ingest batches that make more than this many db queries,
+    # or that take longer than this many seconds, are logged with the fingerprints of their SQL statements
+    # e.g. to catch N+1 query patterns, 0 disables either budget
+    QUERY_COUNT_BUDGET = int(os.getenv("QUERY_COUNT_BUDGET", default=20))
+    QUERY_TIME_BUDGET = float(os.getenv("QUERY_TIME_BUDGET", default=1))
+
+    # the ingest process does not serve the HTTP requests of the web workers, so it serves /metrics, /get_ingest_stats/
+    # and /list_of_gps_devices on this port, or not at all if the port is 0
+    # web workers forward the GPS devices sent to their /list_of_gps_devices there, waiting up to INGEST_HTTP_TIMEOUT seconds,
+    # or refuse them if the port is 0
+    INGEST_HTTP_HOST = os.getenv("INGEST_HTTP_HOST", default="127.0.0.1")
+    INGEST_HTTP_PORT = int(os.getenv("INGEST_HTTP_PORT", default=34569))
+    INGEST_HTTP_TIMEOUT = float(os.getenv("INGEST_HTTP_TIMEOUT", default=5))
     ALLOWED_EXTENSIONS = ["gpx"]
 
     # for access tokens
@@ -67,13 +218,58 @@ class Config:
     NORTHBOUND_ADDRESS = os.getenv("NORTHBOUND_ADDRESS", default="127.0.0.1")
     NORTHBOUND_PORT = os.getenv("NORTHBOUND_PORT", default=23456)
 
+    # path of the northbound server endpoint that issues new tokens for a refresh token
+    NORTHBOUND_REFRESH_PATH = os.getenv("NORTHBOUND_REFRESH_PATH", default="/refresh/")
+
+    # northbound access tokens are refreshed this many seconds before they expire
+    # tokens that are not JWTs with an exp claim are assumed to expire this many seconds after they are issued
+    NORTHBOUND_TOKEN_REFRESH_MARGIN = float(
+        os.getenv("NORTHBOUND_TOKEN_REFRESH_MARGIN", default=60)
+    )
+    NORTHBOUND_TOKEN_LIFETIME = float(
+        os.getenv("NORTHBOUND_TOKEN_LIFETIME", default=900)
+    )
+
+    # timeout in seconds of the HTTP requests to the northbound server
+    NORTHBOUND_HTTP_TIMEOUT = float(os.getenv("NORTHBOUND_HTTP_TIMEOUT", default=10))
+
+    # the connection with the northbound server is retried after this many seconds,
+    # doubling after each failed attempt up to the maximum
+    NORTHBOUND_RECONNECT_DELAY = float(
+        os.getenv("NORTHBOUND_RECONNECT_DELAY", default=1)
+    )
+    NORTHBOUND_RECONNECT_MAX_DELAY = float(
+        os.getenv("NORTHBOUND_RECONNECT_MAX_DELAY", default=60)
+    )
+
+    # the ingest process requests the routes from the Northbound Interface every this many seconds, or never if 0
+    NORTHBOUND_ROUTES_REFRESH_INTERVAL = float(
+        os.getenv("NORTHBOUND_ROUTES_REFRESH_INTERVAL", default=60)
+    )
+
+    # /get_routes/?refresh=true waits up to this many seconds for the routes from the Northbound Interface
+    NORTHBOUND_ROUTES_TIMEOUT = float(os.getenv("NORTHBOUND_ROUTES_TIMEOUT", default=5))
+
+    # /get_routes/ answers from a route list cached for up to this many seconds
+    ROUTE_LIST_CACHE_TTL = float(os.getenv("ROUTE_LIST_CACHE_TTL", default=5))
+
     # secret key
     SECRET_KEY = os.getenv("SECRET_KEY")
 
+    # Fernet key (e.g. from cryptography.fernet.Fernet.generate_key()) that encrypts the northbound password stored in the db,
+    # or empty to derive it from SECRET_KEY; web workers and the ingest process must use the same key
+    NORTHBOUND_CREDENTIALS_KEY = os.getenv("NORTHBOUND_CREDENTIALS_KEY", default="")
+
     # projection for projecting GPS coordinates onto a map projection suitable for the Philipines
+    # each thread creates its own transformer between these CRSs (see calculation_functions.get_projection)
     WGS84 = CRS("EPSG:4326")
     PSEUDO_MERCATOR = CRS("EPSG:32651")
-    PROJECTION = Transformer.from_crs(WGS84, PSEUDO_MERCATOR).transform
+
+    # /get_colorum_vehicles/ searches up to this many kilometers use the equirectangular approximation
+    # of calculation_functions.approximate_distances instead of geodesic distances, or 0 to always use geodesic distances
+    APPROXIMATE_SEARCH_DISTANCE = float(
+        os.getenv("APPROXIMATE_SEARCH_DISTANCE", default=10)
+    )
 
 
 class DevelopmentConfig(Config):
@@ -0,0 +1,20 @@
+from app import create_server
+from time import sleep
+import signal
+import sys
+
+# the ingest process owns the northbound stream, classifies the GPS devices and writes them to the db
+# only one ingest process is active at a time: others wait on the ingest lock as standbys
+ingester = create_server(ingest=True)
+
+
+# exit on SIGTERM like on Ctrl+C, so that the atexit handlers flush the fleet state and stop the northbound stream
+def handle_sigterm(signum, frame):
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    while True:
+        sleep(60)
@@ -1,7 +1,13 @@
 #!/bin/sh
 
+# the ingest process owns the northbound stream, so the web workers can scale out
+# it is started again whenever it exits, e.g. after losing the ingest lock, and then waits for the lock as a standby
+until python ingester.py; do
+    sleep 1
+done &
+
 gunicorn --worker-class eventlet \
-    --workers 1 \
+    --workers ${WEB_WORKERS:-4} \
     --bind 0.0.0.0:34568 \
     --max-requests 10000 \
     --timeout 60 \